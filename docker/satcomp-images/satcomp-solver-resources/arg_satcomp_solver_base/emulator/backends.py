@@ -0,0 +1,421 @@
+"""
+In-process stand-ins for the AWS services used by the leader, the workers and the solver driver.
+The SQS and S3 emulations have the shape of the boto3 queue resource and S3 client/resource, so that
+SqsQueue, S3FileSystem and S3ProblemStore run unchanged on top of them. The node manifest and the
+task end notifier are emulated at the level of DynamodbManifest and TaskEndNotifier.
+Every emulated API call is counted, and messages that carry a request id are time-stamped, so that
+a benchmark can report API usage and per-phase latencies.
+"""
+import hashlib
+import io
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+from botocore.exceptions import ClientError
+
+from arg_satcomp_solver_base.node_manifest.dynamodb_manifest import DynamodbManifest, NodeStatus
+from arg_satcomp_solver_base.sqs_queue.sqs_queue import MESSAGE_TYPE_ATTRIBUTE, REQUEST_ID_ATTRIBUTE
+from arg_satcomp_solver_base.task_end_notification.task_end_notifier import TaskEndNotifier
+
+# VisibilityTimeout of the SatComp queues in solver-infrastructure.yaml
+DEFAULT_VISIBILITY_TIMEOUT = 5
+
+
+class EmulatorException(Exception):
+    """Exception for emulator errors"""
+
+
+def client_error(code: str, operation: str, message: str = ""):
+    return ClientError({"Error": {"Code": code, "Message": message or code}}, operation)
+
+
+class ApiCallCounter:
+    """Thread-safe count of emulated API calls, keyed by "<service>.<operation>" """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def count(self, service: str, operation: str, calls: int = 1):
+        with self.lock:
+            self.calls[f"{service}.{operation}"] += calls
+
+    def snapshot(self):
+        with self.lock:
+            return dict(sorted(self.calls.items()))
+
+
+class RequestTimeline:
+    """First time each event (e.g. "problems.sent") was seen for each request id"""
+
+    def __init__(self):
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def mark(self, request_id: str, event: str):
+        if request_id is None:
+            return
+        with self.lock:
+            self.events.setdefault(request_id, {}).setdefault(event, time.time())
+
+    def durations(self, start_event: str, end_event: str):
+        """Seconds from start_event to end_event of every request that saw both"""
+        with self.lock:
+            return [events[end_event] - events[start_event] for events in self.events.values()
+                    if start_event in events and end_event in events]
+
+    def get(self, request_id: str):
+        with self.lock:
+            return dict(self.events.get(request_id, {}))
+
+
+class _StoredMessage:
+    def __init__(self, message_id: str, body: str, message_attributes: dict):
+        self.message_id = message_id
+        self.body = body
+        self.message_attributes = message_attributes or None
+        self.receive_count = 0
+        self.visible_at = 0
+        self.receipt_handle = None
+
+    @property
+    def request_id(self):
+        return (self.message_attributes or {}).get(REQUEST_ID_ATTRIBUTE, {}).get("StringValue")
+
+    @property
+    def message_type(self):
+        return (self.message_attributes or {}).get(MESSAGE_TYPE_ATTRIBUTE, {}).get("StringValue")
+
+
+class EmulatedSqsMessage:
+    """A received message, as returned by the boto3 Queue.receive_messages"""
+
+    def __init__(self, queue, stored: _StoredMessage):
+        self.queue = queue
+        self.message_id = stored.message_id
+        self.body = stored.body
+        self.receipt_handle = stored.receipt_handle
+        self.attributes = {"ApproximateReceiveCount": str(stored.receive_count)}
+        self.message_attributes = stored.message_attributes
+
+    def change_visibility(self, VisibilityTimeout: int):
+        self.queue.change_message_visibility(self.receipt_handle, VisibilityTimeout)
+
+
+class EmulatedSqsQueue:
+    """Standard SQS queue with visibility timeouts and long polling, shaped like a boto3 Queue resource"""
+
+    def __init__(self, name: str, api_calls: ApiCallCounter, timeline: RequestTimeline = None,
+                 visibility_timeout: int = DEFAULT_VISIBILITY_TIMEOUT):
+        self.name = name
+        self.api_calls = api_calls
+        self.timeline = timeline or RequestTimeline()
+        self.visibility_timeout = visibility_timeout
+        self.messages = OrderedDict()
+        self.condition = threading.Condition()
+
+    def _mark(self, stored: _StoredMessage, event: str):
+        # e.g. results.started.sent for the started notification, results.sent for the result
+        prefix = self.name if stored.message_type is None else f"{self.name}.{stored.message_type}"
+        self.timeline.mark(stored.request_id, f"{prefix}.{event}")
+
+    def _enqueue(self, body: str, message_attributes: dict = None):
+        stored = _StoredMessage(str(uuid.uuid4()), body, message_attributes)
+        self.messages[stored.message_id] = stored
+        self._mark(stored, "sent")
+        self.condition.notify_all()
+        return stored.message_id
+
+    def _visible_messages(self, now: float):
+        return [stored for stored in self.messages.values() if stored.visible_at <= now]
+
+    def _next_visibility_change(self):
+        return min((stored.visible_at for stored in self.messages.values()), default=None)
+
+    def send_message(self, MessageBody: str, MessageAttributes: dict = None, **kwargs):
+        self.api_calls.count("sqs", "SendMessage")
+        with self.condition:
+            return {"MessageId": self._enqueue(MessageBody, MessageAttributes)}
+
+    def send_messages(self, Entries: list):
+        self.api_calls.count("sqs", "SendMessageBatch")
+        with self.condition:
+            successful = [{"Id": entry["Id"], "MessageId": self._enqueue(entry["MessageBody"],
+                                                                         entry.get("MessageAttributes"))}
+                          for entry in Entries]
+        return {"Successful": successful, "Failed": []}
+
+    def receive_messages(self, MaxNumberOfMessages: int = 1, WaitTimeSeconds: int = 0, VisibilityTimeout: int = None,
+                         **kwargs):
+        self.api_calls.count("sqs", "ReceiveMessage")
+        visibility_timeout = self.visibility_timeout if VisibilityTimeout is None else VisibilityTimeout
+        deadline = time.time() + WaitTimeSeconds
+        with self.condition:
+            while True:
+                now = time.time()
+                visible = self._visible_messages(now)
+                if visible or now >= deadline:
+                    break
+                next_change = self._next_visibility_change()
+                wake_up = deadline if next_change is None else min(deadline, max(next_change, now + 0.01))
+                self.condition.wait(wake_up - now)
+            received = []
+            for stored in visible[:MaxNumberOfMessages]:
+                stored.receive_count += 1
+                stored.visible_at = now + visibility_timeout
+                stored.receipt_handle = str(uuid.uuid4())
+                self._mark(stored, "received")
+                received.append(EmulatedSqsMessage(self, stored))
+        return received
+
+    def _find_receipt(self, receipt_handle: str, operation: str):
+        for stored in self.messages.values():
+            if stored.receipt_handle == receipt_handle:
+                return stored
+        raise client_error("ReceiptHandleIsInvalid", operation, f"Receipt handle {receipt_handle} is not current")
+
+    def change_message_visibility(self, receipt_handle: str, visibility_timeout: int):
+        self.api_calls.count("sqs", "ChangeMessageVisibility")
+        with self.condition:
+            stored = self._find_receipt(receipt_handle, "ChangeMessageVisibility")
+            stored.visible_at = time.time() + visibility_timeout
+            self.condition.notify_all()
+
+    def delete_messages(self, Entries: list):
+        self.api_calls.count("sqs", "DeleteMessageBatch")
+        successful = []
+        failed = []
+        with self.condition:
+            for entry in Entries:
+                stored = next((stored for stored in self.messages.values()
+                               if stored.receipt_handle == entry["ReceiptHandle"]), None)
+                if stored is None:
+                    failed.append({"Id": entry["Id"], "Code": "ReceiptHandleIsInvalid", "SenderFault": True})
+                    continue
+                del self.messages[stored.message_id]
+                self._mark(stored, "deleted")
+                successful.append({"Id": entry["Id"]})
+        return {"Successful": successful, "Failed": failed}
+
+    def purge(self):
+        self.api_calls.count("sqs", "PurgeQueue")
+        with self.condition:
+            self.messages.clear()
+
+    def depth(self):
+        """Number of visible and in-flight messages (ApproximateNumberOfMessages + NotVisible)"""
+        with self.condition:
+            return len(self.messages)
+
+    def reload(self):
+        self.api_calls.count("sqs", "GetQueueAttributes")
+
+    @property
+    def attributes(self):
+        with self.condition:
+            now = time.time()
+            visible = len(self._visible_messages(now))
+            return {
+                "ApproximateNumberOfMessages": str(visible),
+                "ApproximateNumberOfMessagesNotVisible": str(len(self.messages) - visible),
+                "VisibilityTimeout": str(self.visibility_timeout)
+            }
+
+
+class EmulatedS3Client:
+    """S3 client storing every bucket as a directory below root"""
+
+    def __init__(self, root: str, api_calls: ApiCallCounter):
+        self.root = root
+        self.api_calls = api_calls
+
+    def _path(self, bucket: str, key: str):
+        path = os.path.normpath(os.path.join(self.root, bucket, key.lstrip("/")))
+        if not path.startswith(os.path.join(self.root, bucket)):
+            raise EmulatorException(f"Key {key} escapes bucket {bucket}")
+        return path
+
+    def _existing_path(self, bucket: str, key: str, operation: str):
+        path = self._path(bucket, key)
+        if not os.path.isfile(path):
+            raise client_error("404", operation, f"Key {key} does not exist in bucket {bucket}")
+        return path
+
+    def put_object(self, Bucket: str, Key: str, Body=b"", **kwargs):
+        self.api_calls.count("s3", "PutObject")
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(Body, str):
+            Body = Body.encode("UTF-8")
+        with open(path, "wb") as object_file:
+            object_file.write(Body if isinstance(Body, bytes) else Body.read())
+        return {"ETag": self._etag(path)}
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str, Config=None, **kwargs):
+        self.api_calls.count("s3", "PutObject")
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(Filename, path)
+
+    def download_file(self, Bucket: str, Key: str, Filename: str, Config=None, **kwargs):
+        self.api_calls.count("s3", "GetObject")
+        shutil.copyfile(self._existing_path(Bucket, Key, "GetObject"), Filename)
+
+    def get_object(self, Bucket: str, Key: str, **kwargs):
+        self.api_calls.count("s3", "GetObject")
+        path = self._existing_path(Bucket, Key, "GetObject")
+        with open(path, "rb") as object_file:
+            body = object_file.read()
+        return {"Body": io.BytesIO(body), "ContentLength": len(body), "ETag": self._etag(path)}
+
+    def head_object(self, Bucket: str, Key: str, **kwargs):
+        self.api_calls.count("s3", "HeadObject")
+        path = self._existing_path(Bucket, Key, "HeadObject")
+        return {"ContentLength": os.path.getsize(path), "ETag": self._etag(path)}
+
+    @staticmethod
+    def _etag(path: str):
+        digest = hashlib.md5()
+        with open(path, "rb") as object_file:
+            for chunk in iter(lambda: object_file.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return f'"{digest.hexdigest()}"'
+
+
+class _EmulatedS3Object:
+    def __init__(self, key: str, size: int):
+        self.key = key
+        self.size = size
+
+
+class _EmulatedObjectCollection:
+    def __init__(self, s3_client: EmulatedS3Client, bucket: str, prefix: str = "", page_size: int = 1000):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.page_size_value = page_size
+
+    def filter(self, Prefix: str = "", **kwargs):
+        return _EmulatedObjectCollection(self.s3_client, self.bucket, Prefix, self.page_size_value)
+
+    def page_size(self, count: int):
+        return _EmulatedObjectCollection(self.s3_client, self.bucket, self.prefix, count)
+
+    def all(self):
+        return self
+
+    def __iter__(self):
+        bucket_root = os.path.join(self.s3_client.root, self.bucket)
+        keys = []
+        for directory, _, files in os.walk(bucket_root):
+            for file_name in files:
+                key = os.path.relpath(os.path.join(directory, file_name), bucket_root).replace(os.sep, "/")
+                if key.startswith(self.prefix):
+                    keys.append(key)
+        # S3 lists keys in lexicographic order, one ListObjectsV2 call per page
+        keys.sort()
+        for page_start in range(0, max(len(keys), 1), self.page_size_value):
+            self.s3_client.api_calls.count("s3", "ListObjectsV2")
+            for key in keys[page_start:page_start + self.page_size_value]:
+                yield _EmulatedS3Object(key, os.path.getsize(os.path.join(bucket_root, key)))
+
+
+class _EmulatedBucket:
+    def __init__(self, s3_client: EmulatedS3Client, name: str):
+        self.name = name
+        self.objects = _EmulatedObjectCollection(s3_client, name)
+
+
+class EmulatedS3Resource:
+    """The part of the boto3 S3 resource used to list problems"""
+
+    def __init__(self, s3_client: EmulatedS3Client):
+        self.meta = type("Meta", (), {"client": s3_client})()
+        self.s3_client = s3_client
+
+    def Bucket(self, name: str):
+        return _EmulatedBucket(self.s3_client, name)
+
+
+class InMemoryManifest(DynamodbManifest):
+    """Node manifest kept in a dict. API calls are counted as the DynamoDB calls DynamodbManifest would make."""
+
+    def __init__(self, api_calls: ApiCallCounter, node_expiration_time=120, node_ttl=3600):
+        DynamodbManifest.__init__(self, None, node_expiration_time, node_ttl)
+        self.api_calls = api_calls
+        self.nodes = {}
+        self.lock = threading.Lock()
+
+    def register_node(self, node_id: str, ip_address: str, status: str, node_type: str):
+        self.api_calls.count("dynamodb", "UpdateItem")
+        current_time = int(time.time())
+        with self.lock:
+            node = self.nodes.setdefault(node_id, {"nodeId": node_id})
+            node.update({
+                "nodeIp": ip_address,
+                "status": status,
+                "nodeType": node_type,
+                "lastModified": current_time,
+                "nodeTypeStatus": f"{node_type}#{status}",
+                "expiresAt": current_time + self.node_ttl
+            })
+
+    def get_all_ready_nodes(self, nodeTypeVal):
+        self.api_calls.count("dynamodb", "Query")
+        expiration_time = int(time.time() - self.node_expiration_time)
+        with self.lock:
+            return [dict(node) for node in self.nodes.values()
+                    if node["nodeTypeStatus"] == f"{nodeTypeVal}#{NodeStatus.READY.value}"
+                    and node["lastModified"] > expiration_time]
+
+    def reserve_node(self, node_id: str, task_id: str, reservation_seconds: int):
+        self.api_calls.count("dynamodb", "UpdateItem")
+        current_time = int(time.time())
+        with self.lock:
+            node = self.nodes.get(node_id)
+            if node is None or ("reservedBy" in node and node["reservedUntil"] >= current_time):
+                return False
+            node["reservedBy"] = task_id
+            node["reservedUntil"] = current_time + reservation_seconds
+            return True
+
+    def release_node(self, node_id: str, task_id: str):
+        self.api_calls.count("dynamodb", "UpdateItem")
+        with self.lock:
+            node = self.nodes.get(node_id)
+            if node is not None and node.get("reservedBy") == task_id:
+                del node["reservedBy"]
+                del node["reservedUntil"]
+
+
+class InMemoryTaskEndNotifier(TaskEndNotifier):
+    """Task end notifications kept in a dict keyed by leader IP, pushed to the notification server if there is one"""
+
+    def __init__(self, api_calls: ApiCallCounter, notification_expiration_time=5, notification_server=None):
+        TaskEndNotifier.__init__(self, None, notification_expiration_time, notification_server)
+        self.api_calls = api_calls
+        self.notifications = {}
+        self.lock = threading.Lock()
+
+    def notify_task_end(self, leader_ip: str):
+        self.api_calls.count("dynamodb", "UpdateItem")
+        notification_id = str(uuid.uuid4())
+        with self.lock:
+            self.notifications[leader_ip] = {"notificationId": notification_id, "lastModified": int(time.time())}
+        if self.notification_server is not None:
+            self.notification_server.publish(notification_id)
+        return notification_id
+
+    def check_for_task_end(self, previous_notification_id=None):
+        self.api_calls.count("dynamodb", "Scan")
+        expiration_time = int(time.time() - self.node_expiration_time)
+        with self.lock:
+            for notification in self.notifications.values():
+                if notification["lastModified"] > expiration_time and \
+                        notification["notificationId"] != previous_notification_id:
+                    return notification["notificationId"]
+        return None
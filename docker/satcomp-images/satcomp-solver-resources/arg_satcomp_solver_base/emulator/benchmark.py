@@ -0,0 +1,194 @@
+"""
+Benchmark harness running a synthetic workload through an emulated cluster on one machine.
+The solver driver (ProblemRunner) submits every problem of an emulated bucket to the leader's pollers,
+which solve them with a synthetic solver script. The report gives throughput, latency per phase and
+the number of AWS API calls the run would have made.
+
+    python3 -m arg_satcomp_solver_base.emulator.benchmark --tasks 200 --pollers 4 --solve-seconds 0.1
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from arg_satcomp_solver_base.emulator.cluster import EmulatedCluster, PROBLEM_QUEUE_NAME, RESULT_QUEUE_NAME, \
+    write_script
+from arg_satcomp_solver_base.satcomp_solver_driver import ProblemRunner
+
+SYNTHETIC_SOLVER = """#!/bin/sh
+# synthetic solver: works for a fixed time, then reports a result like a real solver would
+sleep {solve_seconds}
+echo '{{"return_code": 10, "result": "SATISFIABLE", "artifacts": {{}}}}' > "$1/solver_out.json"
+"""
+SYNTHETIC_CLEANUP = """#!/bin/sh
+exit 0
+"""
+
+
+def synthetic_problem(problem_bytes: int):
+    """Trivially satisfiable DIMACS formula, padded with a comment line to about problem_bytes"""
+    formula = b"p cnf 1 1\n1 0\n"
+    padding = problem_bytes - len(formula) - len(b"c \n")
+    if padding < 0:
+        return formula
+    return b"c " + b"x" * padding + b"\n" + formula
+
+
+def summarize(values: list):
+    """count, mean and percentiles (in seconds) of a list of durations"""
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def percentile(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))], 6)
+
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 6),
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": round(values[-1], 6)
+    }
+
+
+def phase_latencies(cluster: EmulatedCluster, results: dict):
+    """
+    Per-request latencies from the message timeline:
+    queue_wait (problem sent to picked up by a poller), leader (picked up to result sent),
+    solve (solver runtime reported in the result), leader_overhead (leader minus solve: worker
+    reservation, download, upload of the result), result_delivery (result sent to received by the
+    driver) and end_to_end (problem sent to result received).
+    The leader's own phase spans, as reported in the result trace, are added as "leader.<phase>".
+    """
+    phases = {"queue_wait": [], "leader": [], "solve": [], "leader_overhead": [], "result_delivery": [],
+              "end_to_end": []}
+    for result_json in results.values():
+        events = cluster.timeline.get(result_json.get("request_id"))
+        problem_sent = events.get(f"{PROBLEM_QUEUE_NAME}.sent")
+        problem_received = events.get(f"{PROBLEM_QUEUE_NAME}.received")
+        result_sent = events.get(f"{RESULT_QUEUE_NAME}.sent")
+        result_received = events.get(f"{RESULT_QUEUE_NAME}.deleted")
+        if None in (problem_sent, problem_received, result_sent, result_received):
+            continue
+        solve = (result_json["driver"].get("solver_runtime_millis") or 0) / 1000
+        phases["queue_wait"].append(problem_received - problem_sent)
+        phases["leader"].append(result_sent - problem_received)
+        phases["solve"].append(solve)
+        phases["leader_overhead"].append(result_sent - problem_received - solve)
+        phases["result_delivery"].append(result_received - result_sent)
+        phases["end_to_end"].append(result_received - problem_sent)
+        for phase, duration in (result_json.get("trace") or {}).get("phases", {}).items():
+            phases.setdefault(f"leader.{phase}", []).append(duration)
+    return {phase: summarize(durations) for phase, durations in phases.items()}
+
+
+def run_benchmark(args, work_directory: str, logger):
+    solver_command = write_script(os.path.join(work_directory, "solver"),
+                                  SYNTHETIC_SOLVER.format(solve_seconds=args.solve_seconds))
+    cleanup_command = write_script(os.path.join(work_directory, "cleanup"), SYNTHETIC_CLEANUP)
+    cluster = EmulatedCluster(work_directory, solver_command, cleanup_command, args.pollers, args.workers,
+                              lease_seconds=args.lease_seconds, async_upload=args.async_upload,
+                              trace_file=args.trace_file)
+    problem = synthetic_problem(args.problem_bytes)
+    for index in range(args.tasks):
+        cluster.put_problem(f"problems/problem-{index:06d}.cnf", problem)
+    cluster.start()
+
+    runner_args = SimpleNamespace(num_workers=args.workers_per_task, clean_first=True,
+                                  json_file=os.path.join(work_directory, "results.json"), journal_file=None,
+                                  max_in_flight=args.max_in_flight, task_timeout=args.task_timeout,
+                                  queue_timeout=args.queue_timeout, format="DIMACS")
+    problem_runner = ProblemRunner(cluster.problem_queue(), cluster.result_queue(),
+                                   cluster.problem_store(logger, suffixes=[".cnf"]), runner_args, logger)
+    api_calls_before = cluster.api_calls.snapshot()
+    start = time.monotonic()
+    # the driver prints every result; only the report goes to stdout
+    with contextlib.redirect_stdout(sys.stderr if args.verbose else io.StringIO()):
+        problem_runner.run_problems()
+    wall_seconds = time.monotonic() - start
+    api_calls_after = cluster.api_calls.snapshot()
+    cluster.stop()
+
+    with open(runner_args.json_file) as result_file:
+        results = json.load(result_file)
+    api_calls = {call: count - api_calls_before.get(call, 0) for call, count in api_calls_after.items()
+                 if count > api_calls_before.get(call, 0)}
+    return {
+        "workload": {
+            "tasks": args.tasks,
+            "pollers": args.pollers,
+            "workers": args.workers,
+            "workers_per_task": args.workers_per_task,
+            "max_in_flight": args.max_in_flight,
+            "solve_seconds": args.solve_seconds,
+            "problem_bytes": args.problem_bytes,
+            "lease_seconds": args.lease_seconds,
+            "async_upload": args.async_upload
+        },
+        "completed": len(results),
+        "wall_seconds": round(wall_seconds, 3),
+        "tasks_per_second": round(len(results) / wall_seconds, 3) if wall_seconds > 0 else 0,
+        "latency_seconds": phase_latencies(cluster, results),
+        "api_calls": api_calls,
+        "api_calls_per_task": {call: round(count / max(1, len(results)), 3) for call, count in api_calls.items()}
+    }
+
+
+def init_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Run a synthetic workload through an emulated satcomp cluster and report throughput, "
+                    "per-phase latency and API call counts"
+    )
+    parser.add_argument('--tasks', type=int, default=100, help='Number of problems to solve (default: 100)')
+    parser.add_argument('--pollers', type=int, default=1, help='Number of leader pollers (default: 1)')
+    parser.add_argument('--workers', type=int, default=0, help='Number of emulated worker nodes (default: 0)')
+    parser.add_argument('--workers-per-task', type=int, default=0, help='Worker nodes requested by every problem (default: 0)')
+    parser.add_argument('--max-in-flight', type=int, default=1, help='Problems outstanding in the driver at once (default: 1)')
+    parser.add_argument('--solve-seconds', type=float, default=0.1, help='Time the synthetic solver takes per problem (default: 0.1)')
+    parser.add_argument('--problem-bytes', type=int, default=1024, help='Size of every synthetic problem file (default: 1024)')
+    parser.add_argument('--task-timeout', type=int, default=60, help='Solver timeout per problem in seconds (default: 60)')
+    parser.add_argument('--queue-timeout', type=int, help='Seconds a problem may wait for a leader to start it, as in the driver (default: derived from --task-timeout)')
+    parser.add_argument('--lease-seconds', type=int, default=0, help='Lease input messages while they are solved, as SATCOMP_SQS_LEASE_SECONDS (default: 0)')
+    parser.add_argument('--async-upload', action='store_true', help='Upload task directories in the background, as SATCOMP_ASYNC_UPLOAD')
+    parser.add_argument('--work-dir', type=str, help='Directory holding the emulated bucket and worker files (default: a temporary directory that is removed afterwards)')
+    parser.add_argument('--trace-file', type=str, help='Write the complete phase trace of every task to this JSON-lines file')
+    parser.add_argument('--report', type=str, help='Also write the JSON report to this file')
+    parser.add_argument('--verbose', action='store_true', help='Show the logs of every component')
+    return parser
+
+
+def main():
+    parser = init_argparse()
+    args = parser.parse_args()
+    if args.workers_per_task > args.workers:
+        parser.error("--workers-per-task cannot exceed --workers")
+    logger = logging.getLogger("Benchmark")
+    logger.setLevel(logging.DEBUG)
+    if not args.verbose:
+        # every component logs each message and task at INFO
+        logging.disable(logging.INFO)
+
+    work_directory = args.work_dir or tempfile.mkdtemp(prefix="satcomp-emulator-")
+    os.makedirs(work_directory, exist_ok=True)
+    try:
+        report = run_benchmark(args, work_directory, logger)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_directory, ignore_errors=True)
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=4)
+    print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+A whole satcomp cluster in one process, running on the emulated backends: a leader with its pollers,
+status checker and task end notification server, and N worker nodes with their status checkers and
+task end notification pollers. Components are wired the way leader_entrypoint and worker_entrypoint
+wire them; only the AWS clients are replaced.
+"""
+import json
+import logging
+import os
+import socket
+import stat
+import threading
+import time
+
+from arg_satcomp_solver_base.emulator.backends import ApiCallCounter, EmulatedS3Client, EmulatedS3Resource, \
+    EmulatedSqsQueue, InMemoryManifest, InMemoryTaskEndNotifier, RequestTimeline
+from arg_satcomp_solver_base.leader.leader import LeaderStatusChecker
+from arg_satcomp_solver_base.poller.poller import Poller
+from arg_satcomp_solver_base.s3_file_system.s3_file_system import S3FileSystem
+from arg_satcomp_solver_base.satcomp_solver_driver import S3ProblemStore
+from arg_satcomp_solver_base.solver.command_line_solver import CommandLineSolver
+from arg_satcomp_solver_base.solver.run_command import CommandRunner
+from arg_satcomp_solver_base.sqs_queue.sqs_queue import SqsQueue
+from arg_satcomp_solver_base.task_end_notification.task_end_notification_poller import TaskEndNotificationPoller
+from arg_satcomp_solver_base.task_end_notification.task_end_notification_server import TaskEndNotificationClient, \
+    TaskEndNotificationServer
+from arg_satcomp_solver_base.tracing.task_trace import TaskTracer
+from arg_satcomp_solver_base.worker.worker import WorkerStatusChecker
+
+PROBLEM_QUEUE_NAME = "problems"
+RESULT_QUEUE_NAME = "results"
+
+
+def write_script(path: str, body: str):
+    """Write an executable shell script"""
+    with open(path, "w") as script:
+        script.write(body)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+class EmulatedWorkerScript(threading.Thread):
+    """Stand-in for the participant's worker script: keeps worker_node_status.json of every emulated worker fresh"""
+    update_interval = 1
+
+    def __init__(self, worker_directories: list, status: str = "READY"):
+        threading.Thread.__init__(self)
+        self.worker_directories = worker_directories
+        self.status = status
+        self.stopped = threading.Event()
+        self.setDaemon(True)
+
+    def write_status(self):
+        for directory in self.worker_directories:
+            status_file = os.path.join(directory, "worker_node_status.json")
+            with open(status_file + ".tmp", "w") as status_handle:
+                json.dump({"status": self.status, "timestamp": int(time.time())}, status_handle)
+            # the status checker must never read a half written file
+            os.replace(status_file + ".tmp", status_file)
+
+    def run(self):
+        while not self.stopped.wait(self.update_interval):
+            self.write_status()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class EmulatedCluster:
+    """Leader and workers of one cluster, sharing emulated queues, bucket, node manifest and notifier"""
+
+    def __init__(self, work_directory: str, solver_command: str, cleanup_command: str, num_pollers: int = 1,
+                 num_workers: int = 0, bucket: str = "satcomp-emulator", lease_seconds: int = 0,
+                 async_upload: bool = False, trace_file: str = None):
+        self.work_directory = work_directory
+        self.solver_command = solver_command
+        self.cleanup_command = cleanup_command
+        self.num_pollers = num_pollers
+        self.num_workers = num_workers
+        self.bucket = bucket
+        self.lease_seconds = lease_seconds
+        self.async_upload = async_upload
+        self.task_tracer = TaskTracer.get_task_tracer(trace_file)
+        self.api_calls = ApiCallCounter()
+        self.timeline = RequestTimeline()
+        self.problem_queue_resource = EmulatedSqsQueue(PROBLEM_QUEUE_NAME, self.api_calls, self.timeline)
+        self.result_queue_resource = EmulatedSqsQueue(RESULT_QUEUE_NAME, self.api_calls, self.timeline)
+        self.s3_client = EmulatedS3Client(os.path.join(work_directory, "s3"), self.api_calls)
+        os.makedirs(os.path.join(work_directory, "s3", bucket), exist_ok=True)
+        self.node_manifest = InMemoryManifest(self.api_calls)
+        self.notification_server = None
+        self.pollers = []
+        self.worker_status_checkers = []
+        self.task_end_notification_pollers = []
+        self.worker_script = None
+        self.logger = logging.getLogger("EmulatedCluster")
+        self.logger.setLevel(logging.DEBUG)
+
+    def problem_queue(self):
+        return SqsQueue(self.problem_queue_resource, PROBLEM_QUEUE_NAME)
+
+    def result_queue(self):
+        return SqsQueue(self.result_queue_resource, RESULT_QUEUE_NAME)
+
+    def problem_store(self, logger, **listing_options):
+        return S3ProblemStore(EmulatedS3Resource(self.s3_client), self.bucket, logger, **listing_options)
+
+    def put_problem(self, key: str, body: bytes):
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body)
+        return f"s3://{self.bucket}/{key}"
+
+    def _start_leader(self, local_ip_address: str):
+        self.notification_server = TaskEndNotificationServer(port=0)
+        self.notification_server.start()
+        task_end_notifier = InMemoryTaskEndNotifier(self.api_calls, notification_server=self.notification_server)
+        LeaderStatusChecker(self.node_manifest).start()
+
+        input_queue = SqsQueue(self.problem_queue_resource, PROBLEM_QUEUE_NAME, self.lease_seconds)
+        solver = CommandLineSolver(self.solver_command)
+        s3_file_system = S3FileSystem(self.s3_client)
+        for thread_id in range(1, self.num_pollers + 1):
+            poller = Poller(thread_id, local_ip_address, input_queue, self.result_queue(), self.node_manifest,
+                            task_end_notifier, solver, self.bucket, async_upload=self.async_upload,
+                            task_tracer=self.task_tracer)
+            poller.s3_file_system = s3_file_system
+            poller.setDaemon(True)
+            poller.start()
+            self.pollers.append(poller)
+        self.logger.info(f"Started leader {local_ip_address} with {self.num_pollers} pollers")
+
+    def _start_workers(self, leader_ip: str):
+        worker_directories = []
+        for worker_id in range(1, self.num_workers + 1):
+            directory = os.path.join(self.work_directory, f"worker-{worker_id}")
+            os.makedirs(directory, exist_ok=True)
+            worker_directories.append(directory)
+        self.worker_script = EmulatedWorkerScript(worker_directories)
+        self.worker_script.write_status()
+        self.worker_script.start()
+
+        for directory in worker_directories:
+            worker_status = WorkerStatusChecker(self.node_manifest, 5, directory)
+            worker_status.setDaemon(True)
+            worker_status.start()
+            self.worker_status_checkers.append(worker_status)
+
+            task_end_notification_poller = TaskEndNotificationPoller(
+                InMemoryTaskEndNotifier(self.api_calls), CommandRunner("stdout.log", "stderr.log"),
+                TaskEndNotificationClient(leader_ip, self.notification_server.port),
+                lambda: TaskEndNotificationPoller.latest_leader_ip(self.node_manifest))
+            task_end_notification_poller.cleanup_command = self.cleanup_command
+            task_end_notification_poller.cleanup_output_directory = directory
+            task_end_notification_poller.setDaemon(True)
+            task_end_notification_poller.start()
+            self.task_end_notification_pollers.append(task_end_notification_poller)
+        self.logger.info(f"Started {self.num_workers} workers")
+
+    def start(self, ready_timeout: float = 30):
+        """Start the leader and the workers, and wait until every worker is registered as READY"""
+        local_ip_address = socket.gethostbyname(socket.gethostname())
+        self._start_leader(local_ip_address)
+        if self.num_workers > 0:
+            self._start_workers(local_ip_address)
+        deadline = time.monotonic() + ready_timeout
+        while len(self.node_manifest.get_all_ready_worker_nodes()) < self.num_workers:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Only {len(self.node_manifest.get_all_ready_worker_nodes())} of "
+                                   f"{self.num_workers} emulated workers reported READY")
+            time.sleep(0.1)
+
+    def stop(self):
+        """Stop serving task end notifications and refreshing worker status; the daemon threads die with the process"""
+        if self.worker_script is not None:
+            self.worker_script.stop()
+        if self.notification_server is not None:
+            self.notification_server.http_server.shutdown()
@@ -11,6 +11,7 @@ import uuid
 import time
 
 from arg_satcomp_solver_base.node_manifest.dynamodb_manifest import DynamodbManifest, NodeType
+from arg_satcomp_solver_base.node_manifest.heartbeat import Heartbeat
 from arg_satcomp_solver_base.utils import FileOperations
 
 
@@ -19,8 +20,8 @@ class LeaderTimeoutException(Exception):
 
 
 class LeaderStatusChecker(threading.Thread):
-    """Thread that runs in the background publishing leader READY status & IP address by
-    updating manifest every second"""
+    """Thread that runs in the background publishing leader READY status & IP address.
+    The manifest is only written once per heartbeat lease interval"""
 
     leader_poll_sleep_time = 1
     file_operations: FileOperations = FileOperations()
@@ -31,6 +32,7 @@ class LeaderStatusChecker(threading.Thread):
         self.logger = logging.getLogger("LeaderPoller")
         self.logger.setLevel(logging.DEBUG)
         self.setDaemon(True)
+        self.heartbeat = None
 
     def update_manifest(self, uuid: str, local_ip_address: str, status: str):
         self.logger.info(f"Giving node heartbeat for node {uuid} with ip {local_ip_address}")
@@ -42,10 +44,8 @@ class LeaderStatusChecker(threading.Thread):
         local_ip_address = socket.gethostbyname(socket.gethostname())
         node_uuid = uuid.uuid4()
         self.logger.info(f"Registering leader node {node_uuid} with ip {local_ip_address}")
+        self.heartbeat = Heartbeat(self.node_manifest, str(node_uuid), local_ip_address, NodeType.LEADER.name)
         while True:
-            current_timestamp = int(time.time())
-            
-            self.update_manifest(node_uuid, local_ip_address, "READY")
-
-            self.logger.info("Leader updated status")
+            if self.heartbeat.beat("READY"):
+                self.logger.info("Leader updated status")
             time.sleep(self.leader_poll_sleep_time)
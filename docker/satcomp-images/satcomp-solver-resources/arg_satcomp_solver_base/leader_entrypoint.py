@@ -11,16 +11,60 @@ from time import sleep
 sys.path.append('/opt/amazon/lib/python3.8/site-packages/')
 
 from arg_satcomp_solver_base.solver.command_line_solver import CommandLineSolver
-from arg_satcomp_solver_base.sqs_queue.sqs_queue import SqsQueue
+from arg_satcomp_solver_base.solver.cgroup import CgroupException, CgroupManager
+from arg_satcomp_solver_base.solver.log_storage import LogStoragePolicy
+from arg_satcomp_solver_base.solver.run_command import CommandRunner
+from arg_satcomp_solver_base.sqs_queue.sqs_queue import PrefetchingSqsQueue, SqsQueue
 from arg_satcomp_solver_base.poller.poller import Poller
 from arg_satcomp_solver_base.node_manifest.dynamodb_manifest import DynamodbManifest
 from arg_satcomp_solver_base.task_end_notification.task_end_notifier import TaskEndNotifier
+from arg_satcomp_solver_base.task_end_notification.task_end_notification_server import TaskEndNotificationServer
 from arg_satcomp_solver_base.leader.leader import LeaderStatusChecker
+from arg_satcomp_solver_base.resources.core_allocator import CoreAllocator
+from arg_satcomp_solver_base.resources.resource_pool import ResourcePool
+from arg_satcomp_solver_base.tracing.task_trace import TaskTracer
+from arg_satcomp_solver_base.metrics.metrics import start_metrics_publishing
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 QUEUE_NAME = os.getenv('SQS_QUEUE_NAME')
 OUTPUT_QUEUE_NAME = os.getenv('SQS_OUTPUT_QUEUE_NAME')
 SATCOMP_BUCKET_NAME = os.getenv('SATCOMP_BUCKET_NAME')
+# Number of tasks the leader solves concurrently; each task reserves cores/memory from a shared pool
+POLLER_COUNT = int(os.getenv('SATCOMP_POLLER_COUNT', '1'))
+# Visibility timeout (seconds) kept on input messages while they are solved; 0 deletes them on receipt
+SQS_LEASE_SECONDS = int(os.getenv('SATCOMP_SQS_LEASE_SECONDS', '0'))
+# Number of input messages received ahead of time and buffered for the pollers; 0 disables prefetching
+SQS_PREFETCH = int(os.getenv('SATCOMP_SQS_PREFETCH', '0'))
+# Upload task artifacts in the background so that pollers can start the next problem right away
+ASYNC_UPLOAD = os.getenv('SATCOMP_ASYNC_UPLOAD', 'false').lower() == 'true'
+# Decompress .xz/.gz/.bz2/.zst formulas while downloading them
+DECOMPRESS_FORMULAS = os.getenv('SATCOMP_DECOMPRESS_FORMULAS', 'false').lower() == 'true'
+# How solver output is captured: lines (log every line), chunks or direct (see CommandRunner)
+LOG_CAPTURE_MODE = os.getenv('SATCOMP_LOG_CAPTURE', 'lines')
+# Lines per second of solver output mirrored to the container log in chunks/direct capture mode
+LOG_MIRROR_LINES_PER_SECOND = float(os.getenv('SATCOMP_LOG_MIRROR_LINES_PER_SECOND', '10'))
+# Keep only the first/last this many MB of each solver log; 0 keeps the whole log
+LOG_HEAD_MB = float(os.getenv('SATCOMP_LOG_HEAD_MB', '0'))
+LOG_TAIL_MB = float(os.getenv('SATCOMP_LOG_TAIL_MB', '0'))
+# Compression applied to solver logs before upload: none, gzip or zstd
+LOG_COMPRESSION = os.getenv('SATCOMP_LOG_COMPRESSION', 'none').lower()
+# Run every solve in its own cgroup with memory and cpu limits taken from the task's resource request
+CGROUP_ISOLATION = os.getenv('SATCOMP_CGROUP_ISOLATION', 'false').lower() == 'true'
+# Pin every solve to its own set of physical cores, within one NUMA node where possible
+CPU_PINNING = os.getenv('SATCOMP_CPU_PINNING', 'false').lower() == 'true'
+# Signals sent to a solver that exceeds its timeout, each followed by a grace period, before SIGKILL
+TIMEOUT_ESCALATION = CommandRunner.parse_timeout_escalation(os.getenv('SATCOMP_TIMEOUT_ESCALATION', 'TERM:10'))
+# Long-lived solver wrapper that solves tasks sent over its stdin (see persistent_solver); used if it exists.
+# Empty always runs the solver script per task
+SOLVER_SERVER = os.getenv('SATCOMP_SOLVER_SERVER', '/competition/solver_server')
+# Append the phase timings of every task to this JSON-lines file; empty disables the trace file
+TRACE_FILE = os.getenv('SATCOMP_TRACE_FILE', '')
+# Also export the phase timings as OpenTelemetry spans (needs opentelemetry-api and a configured tracer provider)
+TRACE_OPENTELEMETRY = os.getenv('SATCOMP_TRACE_OPENTELEMETRY', 'false').lower() == 'true'
+# Port of the Prometheus /metrics endpoint; 0 disables the endpoint
+METRICS_PORT = int(os.getenv('SATCOMP_METRICS_PORT', '0'))
+# Seconds between CloudWatch embedded metric format lines written to stdout; 0 disables them
+METRICS_EMF_INTERVAL = float(os.getenv('SATCOMP_METRICS_EMF_INTERVAL', '0'))
 
 def run_leader(path):
     cmd = os.path.join(path, "leader")
@@ -39,23 +83,56 @@ if __name__ == "__main__":
     run_leader(dir)  # Run script to save status to leader_node_status.json
     sleep(1)  # Wait for creation of leader_node_status.json file
 
+    logger.info("Starting metrics publishing")
+    metrics_registry = start_metrics_publishing(METRICS_PORT, METRICS_EMF_INTERVAL, "SatComp", {"NodeType": "LEADER"})
+
     logger.info("Getting input queue: %s", QUEUE_NAME)
-    sqs_input_queue = SqsQueue.get_sqs_queue(QUEUE_NAME)
+    sqs_input_queue = SqsQueue.get_sqs_queue(QUEUE_NAME, SQS_LEASE_SECONDS)
+    if METRICS_PORT > 0 or METRICS_EMF_INTERVAL > 0:
+        queue_messages = metrics_registry.gauge("satcomp_sqs_queue_messages",
+                                                "Approximate number of messages in the input queue")
+        # one GetQueueAttributes call per collection for both states
+        queue_messages.set_labelled_function(sqs_input_queue.message_counts, "state", queue=QUEUE_NAME)
+    if SQS_PREFETCH > 0:
+        logger.info(f"Prefetching up to {SQS_PREFETCH} messages from input queue")
+        sqs_input_queue = PrefetchingSqsQueue(sqs_input_queue, SQS_PREFETCH)
+        sqs_input_queue.start()
 
     logger.info("Getting output queue: %s", QUEUE_NAME)
     sqs_output_queue = SqsQueue.get_sqs_queue(OUTPUT_QUEUE_NAME)
 
     logger.info(f"Bucket name: {SATCOMP_BUCKET_NAME}")
 
+    logger.info("Starting task end notification server")
+    task_end_notification_server = TaskEndNotificationServer()
+    task_end_notification_server.start()
+
     logger.info("Getting task end notifier")
-    task_end_notifier = TaskEndNotifier.get_task_end_notifier()
+    task_end_notifier = TaskEndNotifier.get_task_end_notifier(task_end_notification_server)
 
     logger.info("Getting node manifest")
     node_manifest = DynamodbManifest.get_dynamodb_manifest()
 
     logger.info("Building command line solver to run solver script /competition/solver")
 
-    solver = CommandLineSolver(f"{dir}/solver")
+    log_storage = LogStoragePolicy(int(LOG_HEAD_MB * 1024 * 1024), int(LOG_TAIL_MB * 1024 * 1024),
+                                   None if LOG_COMPRESSION == 'none' else LOG_COMPRESSION)
+    cgroup_manager = None
+    if CGROUP_ISOLATION:
+        try:
+            cgroup_manager = CgroupManager.get_cgroup_manager()
+            cgroup_manager.setup()
+        except CgroupException as e:
+            logger.error("Failed to set up cgroup isolation, running solvers without limits")
+            logger.exception(e)
+            cgroup_manager = None
+    core_allocator = None
+    if CPU_PINNING:
+        core_allocator = CoreAllocator.get_core_allocator()
+        logger.info(f"Pinning solvers to disjoint sets of the {core_allocator.total_cpus} available CPUs")
+    solver = CommandLineSolver(f"{dir}/solver", LOG_CAPTURE_MODE, LOG_MIRROR_LINES_PER_SECOND, log_storage,
+                               cgroup_manager, core_allocator, TIMEOUT_ESCALATION, SOLVER_SERVER)
+    solver.warm(POLLER_COUNT)
 
     logger.info("Getting local IP address")
     local_ip_address = socket.gethostbyname(socket.gethostname())
@@ -64,7 +141,22 @@ if __name__ == "__main__":
     leader_status = LeaderStatusChecker(node_manifest)
     leader_status.start()
 
+    resource_pool = None
+    if POLLER_COUNT > 1:
+        resource_pool = ResourcePool.get_resource_pool(POLLER_COUNT)
+        logger.info(f"Pool mode: {POLLER_COUNT} pollers sharing {resource_pool.total_cores} cores "
+                    f"and {resource_pool.total_memory_mb} MB of memory, "
+                    f"{resource_pool.default_cores} cores for tasks that do not request any")
+
+    task_tracer = TaskTracer.get_task_tracer(TRACE_FILE, TRACE_OPENTELEMETRY)
+
     logger.info("starting poller")
-    poller = Poller(1, local_ip_address, sqs_input_queue, sqs_output_queue, node_manifest, task_end_notifier, solver, SATCOMP_BUCKET_NAME)
-    poller.start()
-    poller.join()
+    pollers = []
+    for thread_id in range(1, POLLER_COUNT + 1):
+        poller = Poller(thread_id, local_ip_address, sqs_input_queue, sqs_output_queue, node_manifest,
+                        task_end_notifier, solver, SATCOMP_BUCKET_NAME, resource_pool, ASYNC_UPLOAD,
+                        DECOMPRESS_FORMULAS, task_tracer)
+        poller.start()
+        pollers.append(poller)
+    for poller in pollers:
+        poller.join()
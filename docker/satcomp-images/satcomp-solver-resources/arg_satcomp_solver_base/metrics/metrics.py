@@ -0,0 +1,348 @@
+"""
+Lightweight metrics shared by the components of the leader and worker containers.
+Components record counters, gauges and histograms in the process-wide registry; the registry is
+published on a Prometheus text endpoint (MetricsServer) and/or as batched CloudWatch embedded metric
+format log lines (EmfMetricsPublisher).
+"""
+import json
+import logging
+import math
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds (seconds) of the default histogram buckets, from sub-second API calls to long solves
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1000, 3600)
+
+
+class MetricsException(Exception):
+    """Exception for metrics registry errors"""
+
+
+def _label_key(labels: dict):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(label_key: tuple, extra: tuple = ()):
+    pairs = label_key + extra
+    if not pairs:
+        return ""
+    escaped = (name + '="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for name, value in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """A named metric with one value (or histogram) per label combination"""
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, unit: str = "None"):
+        self.name = name
+        self.documentation = documentation
+        # CloudWatch unit of the metric, e.g. Count, Seconds or Bytes
+        self.unit = unit
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def samples(self):
+        """(suffix, label key, extra labels, value) of every time series of the metric"""
+        with self.lock:
+            return [("", label_key, (), value) for label_key, value in self.values.items()]
+
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if amount < 0:
+            raise MetricsException(f"Counter {self.name} cannot decrease")
+        label_key = _label_key(labels)
+        with self.lock:
+            self.values[label_key] = self.values.get(label_key, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(_label_key(labels), 0)
+
+
+class Gauge(Metric):
+    """Value that goes up and down; may be computed by a callback when the metrics are collected"""
+    metric_type = "gauge"
+
+    def __init__(self, name: str, documentation: str, unit: str = "None"):
+        Metric.__init__(self, name, documentation, unit)
+        self.callbacks = {}
+        # (function, label name, other labels) of callbacks computing several label values at once
+        self.labelled_callbacks = []
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[_label_key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        label_key = _label_key(labels)
+        with self.lock:
+            self.values[label_key] = self.values.get(label_key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(_label_key(labels), 0)
+
+    def set_function(self, function, **labels):
+        """Compute the value with function() every time the metrics are collected"""
+        with self.lock:
+            self.callbacks[_label_key(labels)] = function
+
+    def set_labelled_function(self, function, label: str, **labels):
+        """
+        Compute the values of several time series with a single function() call every time the metrics
+        are collected. function returns a dict from values of the label named label to gauge values.
+        """
+        with self.lock:
+            self.labelled_callbacks.append((function, label, labels))
+
+    def _call(self, function):
+        try:
+            return function()
+        except Exception as e:
+            # a failing callback (e.g. an AWS call) must not break the whole endpoint
+            logging.getLogger("Metrics").error(f"Failed to compute gauge {self.name}: {e}")
+            return None
+
+    def samples(self):
+        with self.lock:
+            callbacks = list(self.callbacks.items())
+            labelled_callbacks = list(self.labelled_callbacks)
+        for label_key, function in callbacks:
+            value = self._call(function)
+            if value is not None:
+                with self.lock:
+                    self.values[label_key] = value
+        for function, label, labels in labelled_callbacks:
+            values = self._call(function)
+            if values is not None:
+                with self.lock:
+                    for label_value, value in values.items():
+                        self.values[_label_key(dict(labels, **{label: label_value}))] = value
+        return Metric.samples(self)
+
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets, with their sum and count"""
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, unit: str = "Seconds", buckets: tuple = DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, unit)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        label_key = _label_key(labels)
+        with self.lock:
+            state = self.values.get(label_key)
+            if state is None:
+                state = self.values[label_key] = {"counts": [0] * len(self.buckets), "sum": 0, "count": 0}
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    state["counts"][index] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    def get(self, **labels):
+        """(sum, count) of the observations with these labels"""
+        with self.lock:
+            state = self.values.get(_label_key(labels))
+            return (state["sum"], state["count"]) if state else (0, 0)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for label_key, state in self.values.items():
+                cumulative = 0
+                for upper_bound, count in zip(self.buckets, state["counts"]):
+                    cumulative += count
+                    samples.append(("_bucket", label_key, (("le", _format_value(upper_bound)),), cumulative))
+                samples.append(("_bucket", label_key, (("le", "+Inf"),), state["count"]))
+                samples.append(("_sum", label_key, (), state["sum"]))
+                samples.append(("_count", label_key, (), state["count"]))
+        return samples
+
+
+class MetricsRegistry:
+    """Named metrics of a process. Asking for an existing name returns the existing metric."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get_or_create(self, metric_class, name: str, documentation: str, **options):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, documentation, **options)
+            elif type(metric) is not metric_class:
+                raise MetricsException(f"Metric {name} is already registered as a {metric.metric_type}")
+            return metric
+
+    def counter(self, name: str, documentation: str, unit: str = "Count"):
+        return self._get_or_create(Counter, name, documentation, unit=unit)
+
+    def gauge(self, name: str, documentation: str, unit: str = "None"):
+        return self._get_or_create(Gauge, name, documentation, unit=unit)
+
+    def histogram(self, name: str, documentation: str, unit: str = "Seconds", buckets: tuple = DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, unit=unit, buckets=buckets)
+
+    def collect(self):
+        with self.lock:
+            return list(self.metrics.values())
+
+    def render_prometheus(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.collect():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+            for suffix, label_key, extra, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(label_key, extra)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def get_registry():
+        """The registry shared by every component of this process"""
+        return _REGISTRY
+
+
+_REGISTRY = MetricsRegistry()
+
+
+class MetricsServer(threading.Thread):
+    """Thread serving the registry on GET /metrics in the Prometheus text format"""
+
+    def __init__(self, registry: MetricsRegistry, port: int):
+        threading.Thread.__init__(self)
+        self.registry = registry
+        self.logger = logging.getLogger("MetricsServer")
+        self.logger.setLevel(logging.DEBUG)
+        self.setDaemon(True)
+        self.http_server = ThreadingHTTPServer(("", port), self._make_handler())
+        self.http_server.daemon_threads = True
+        # port 0 binds an ephemeral port
+        self.port = self.http_server.server_address[1]
+
+    def _make_handler(self):
+        server = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = server.registry.render_prometheus().encode("UTF-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                server.logger.debug(format, *args)
+
+        return MetricsRequestHandler
+
+    def run(self):
+        self.logger.info(f"Serving metrics on port {self.port}")
+        self.http_server.serve_forever()
+
+
+class EmfMetricsPublisher(threading.Thread):
+    """
+    Thread writing the registry as CloudWatch embedded metric format (EMF) lines every interval seconds:
+    one JSON line per label combination of each metric. Counters are reported as the increase since
+    the previous line, histograms as the sum and count of the observations since then, gauges as
+    their current value.
+    """
+
+    def __init__(self, registry: MetricsRegistry, namespace: str, interval: float, dimensions: dict = None,
+                 stream=None):
+        threading.Thread.__init__(self)
+        self.registry = registry
+        self.namespace = namespace
+        self.interval = interval
+        self.dimensions = dimensions or {}
+        self.stream = stream or sys.stdout
+        self.previous = {}
+        self.stopped = threading.Event()
+        self.setDaemon(True)
+
+    def _delta(self, key: tuple, value: float):
+        previous = self.previous.get(key, 0)
+        self.previous[key] = value
+        return value - previous
+
+    def records(self):
+        """EMF records of every metric that has something to report"""
+        records = []
+        timestamp = int(time.time() * 1000)
+        for metric in self.registry.collect():
+            series = {}
+            for suffix, label_key, extra, value in metric.samples():
+                if suffix == "_bucket":
+                    continue
+                key = (metric.name, suffix, label_key)
+                if metric.metric_type in ("counter", "histogram"):
+                    value = self._delta(key, value)
+                name = metric.name + suffix
+                unit = "Count" if suffix == "_count" else metric.unit
+                series.setdefault(label_key, []).append((name, unit, value))
+            for label_key, values in series.items():
+                if metric.metric_type != "gauge" and not any(value for _, _, value in values):
+                    continue
+                dimensions = dict(self.dimensions, **dict(label_key))
+                record = {
+                    "_aws": {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [{
+                            "Namespace": self.namespace,
+                            "Dimensions": [sorted(dimensions)],
+                            "Metrics": [{"Name": name, "Unit": unit} for name, unit, _ in values]
+                        }]
+                    }
+                }
+                record.update(dimensions)
+                record.update({name: value for name, _, value in values})
+                records.append(record)
+        return records
+
+    def publish(self):
+        lines = "".join(json.dumps(record) + "\n" for record in self.records())
+        self.stream.write(lines)
+        self.stream.flush()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.publish()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_metrics_publishing(port: int, emf_interval: float, namespace: str, dimensions: dict = None):
+    """Start the Prometheus endpoint (if port > 0) and the EMF publisher (if emf_interval > 0) for the shared registry"""
+    registry = MetricsRegistry.get_registry()
+    if port > 0:
+        MetricsServer(registry, port).start()
+    if emf_interval > 0:
+        EmfMetricsPublisher(registry, namespace, emf_interval, dimensions).start()
+    return registry
@@ -3,6 +3,18 @@ import time
 from enum import Enum
 
 import boto3
+from botocore.exceptions import ClientError
+
+from arg_satcomp_solver_base.metrics.metrics import MetricsRegistry
+
+# Global secondary index keyed by "<nodeType>#<status>" with lastModified as sort key
+NODE_TYPE_STATUS_INDEX = "NodeTypeStatusIndex"
+# Errors of queries on an index the table does not have
+MISSING_INDEX_ERRORS = ("ValidationException", "ResourceNotFoundException")
+
+DYNAMODB_REQUESTS = MetricsRegistry.get_registry().counter(
+    "satcomp_dynamodb_requests_total", "DynamoDB API calls (one per result page) by table and operation")
+MANIFEST_TABLE = "SatCompNodeManifest"
 
 
 class NodeStatus(Enum):
@@ -20,9 +32,12 @@ class DynamodbManifest:
     """
     Node manifest for storing IP and status of satcomp nodes based on a DynamoDB Table
     """
-    def __init__(self, table, node_expiration_time=120):
+    def __init__(self, table, node_expiration_time=120, node_ttl=3600):
         self.table = table
         self.node_expiration_time = node_expiration_time
+        # rows of nodes that stopped heartbeating are removed by DynamoDB TTL after node_ttl seconds
+        self.node_ttl = node_ttl
+        self.use_index = True
         self.logger = logging.getLogger(__name__)
 
     def register_node(self, node_id: str, ip_address: str, status: str, node_type: str):
@@ -35,12 +50,14 @@ class DynamodbManifest:
         :return:
         """
         current_time = int(time.time())
+        DYNAMODB_REQUESTS.inc(table=MANIFEST_TABLE, operation="UpdateItem")
         self.table.update_item(
             Key={
                 'nodeId': node_id
             },
             UpdateExpression="set nodeIp = :ipVal, #stskey = :stsVal, nodeType = :nodeTypeVal,"
-                             " lastModified = :lastModifiedVal",
+                             " lastModified = :lastModifiedVal, nodeTypeStatus = :nodeTypeStatusVal,"
+                             " expiresAt = :expiresAtVal",
             ExpressionAttributeNames={
                 "#stskey": "status"
             },
@@ -48,7 +65,9 @@ class DynamodbManifest:
                 ":ipVal": ip_address,
                 ":stsVal": status,
                 ":nodeTypeVal": node_type,
-                ":lastModifiedVal": current_time
+                ":lastModifiedVal": current_time,
+                ":nodeTypeStatusVal": f"{node_type}#{status}",
+                ":expiresAtVal": current_time + self.node_ttl
             }
         )
 
@@ -58,7 +77,36 @@ class DynamodbManifest:
         :return:
         """
         expiration_time = int(time.time() - self.node_expiration_time)
-        nodes = self.table.scan(
+        if self.use_index:
+            try:
+                return self._query_ready_nodes(nodeTypeVal, expiration_time)
+            except ClientError as e:
+                # tables created before the index was added to the template; other errors such as
+                # throttling are transient (and already retried by boto3), so they reach the caller
+                if e.response.get("Error", {}).get("Code") not in MISSING_INDEX_ERRORS:
+                    raise
+                self.logger.warning(f"Cannot query index {NODE_TYPE_STATUS_INDEX}, falling back to table scans: {e}")
+                self.use_index = False
+        return self._scan_ready_nodes(nodeTypeVal, expiration_time)
+
+    def _query_ready_nodes(self, nodeTypeVal, expiration_time):
+        return self._paginate(
+            self.table.query, "Query",
+            IndexName=NODE_TYPE_STATUS_INDEX,
+            KeyConditionExpression="#nodeTypeStatusKey = :nodeTypeStatusVal and #lastModifiedKey > :lastModifiedVal",
+            ExpressionAttributeNames={
+                "#nodeTypeStatusKey": "nodeTypeStatus",
+                "#lastModifiedKey": "lastModified"
+            },
+            ExpressionAttributeValues={
+                ":nodeTypeStatusVal": f"{nodeTypeVal}#{NodeStatus.READY.value}",
+                ":lastModifiedVal": expiration_time
+            }
+        )
+
+    def _scan_ready_nodes(self, nodeTypeVal, expiration_time):
+        return self._paginate(
+            self.table.scan, "Scan",
             Select="ALL_ATTRIBUTES",
             FilterExpression="#nodeStatusKey = :nodeStatusVal and #nodeTypeKey = :nodeTypeVal and "
                              "#lastModifiedKey > :lastModifiedVal",
@@ -74,7 +122,75 @@ class DynamodbManifest:
             },
             ConsistentRead=True
         )
-        return nodes["Items"]
+
+    @staticmethod
+    def _paginate(operation, operation_name: str, **kwargs):
+        """Run a query or scan to completion, following LastEvaluatedKey across pages"""
+        items = []
+        while True:
+            DYNAMODB_REQUESTS.inc(table=MANIFEST_TABLE, operation=operation_name)
+            response = operation(**kwargs)
+            items.extend(response["Items"])
+            if "LastEvaluatedKey" not in response:
+                return items
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def get_all_available_worker_nodes(self):
+        """
+        Returns all READY worker nodes that are not currently reserved by a task
+        :return:
+        """
+        current_time = int(time.time())
+        return [node for node in self.get_all_ready_worker_nodes()
+                if "reservedBy" not in node or node.get("reservedUntil", 0) < current_time]
+
+    def reserve_node(self, node_id: str, task_id: str, reservation_seconds: int):
+        """
+        Atomically reserve a node for a task, so that concurrent tasks cannot claim the same node.
+        The reservation expires after reservation_seconds in case the reserving leader dies.
+        :return: True if the node was reserved, False if another task holds it
+        """
+        current_time = int(time.time())
+        DYNAMODB_REQUESTS.inc(table=MANIFEST_TABLE, operation="UpdateItem")
+        try:
+            self.table.update_item(
+                Key={
+                    'nodeId': node_id
+                },
+                UpdateExpression="set reservedBy = :taskIdVal, reservedUntil = :reservedUntilVal",
+                ConditionExpression="attribute_exists(nodeId) and "
+                                    "(attribute_not_exists(reservedBy) or reservedUntil < :currentTimeVal)",
+                ExpressionAttributeValues={
+                    ":taskIdVal": task_id,
+                    ":reservedUntilVal": current_time + reservation_seconds,
+                    ":currentTimeVal": current_time
+                }
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    def release_node(self, node_id: str, task_id: str):
+        """
+        Release a node reserved by task_id; reservations held by other tasks are left untouched
+        """
+        DYNAMODB_REQUESTS.inc(table=MANIFEST_TABLE, operation="UpdateItem")
+        try:
+            self.table.update_item(
+                Key={
+                    'nodeId': node_id
+                },
+                UpdateExpression="remove reservedBy, reservedUntil",
+                ConditionExpression="reservedBy = :taskIdVal",
+                ExpressionAttributeValues={
+                    ":taskIdVal": task_id
+                }
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
 
     def get_all_ready_worker_nodes(self):
         """
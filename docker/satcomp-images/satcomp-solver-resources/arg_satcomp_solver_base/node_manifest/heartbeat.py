@@ -0,0 +1,73 @@
+"""
+Heartbeat that keeps a node registered in the node manifest while writing as little as possible.
+A write is sent immediately when the node status changes; otherwise the registration is only
+renewed once per lease interval (with jitter so that nodes do not write in lockstep).
+"""
+import logging
+import os
+import random
+import threading
+import time
+
+from arg_satcomp_solver_base.metrics.metrics import MetricsRegistry
+from arg_satcomp_solver_base.node_manifest.dynamodb_manifest import DynamodbManifest
+
+HEARTBEAT_BEATS = MetricsRegistry.get_registry().counter(
+    "satcomp_heartbeat_beats_total", "Node heartbeats by node type and whether they were written to the manifest")
+
+
+class Heartbeat:
+    """Change-only, lease-based node heartbeat with counters of sent and suppressed writes"""
+
+    def __init__(self, node_manifest: DynamodbManifest, node_id: str, ip_address: str, node_type: str,
+                 lease_interval: float = None, jitter: float = 0.1):
+        self.node_manifest = node_manifest
+        self.node_id = node_id
+        self.ip_address = ip_address
+        self.node_type = node_type
+        if lease_interval is None:
+            lease_interval = Heartbeat.get_lease_interval(node_manifest)
+        self.lease_interval = lease_interval
+        self.jitter = jitter
+        self.last_status = None
+        self.next_write_time = 0
+        self.writes_sent = 0
+        self.writes_suppressed = 0
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("Heartbeat")
+        self.logger.setLevel(logging.DEBUG)
+
+    def beat(self, status: str):
+        """Report the current status; returns True if it was written to the manifest"""
+        with self.lock:
+            now = time.time()
+            if status == self.last_status and now < self.next_write_time:
+                self.writes_suppressed += 1
+                HEARTBEAT_BEATS.inc(node_type=self.node_type, outcome="suppressed")
+                return False
+            self.logger.info(f"Giving node heartbeat for node {self.node_id} with ip {self.ip_address} "
+                             f"and status {status} (previous status {self.last_status})")
+            self.node_manifest.register_node(str(self.node_id), self.ip_address, status, self.node_type)
+            self.last_status = status
+            self.next_write_time = now + self.lease_interval * random.uniform(1 - self.jitter, 1)
+            self.writes_sent += 1
+            HEARTBEAT_BEATS.inc(node_type=self.node_type, outcome="sent")
+            self.logger.debug(f"Heartbeat writes sent: {self.writes_sent}, suppressed: {self.writes_suppressed}")
+            return True
+
+    def counters(self):
+        with self.lock:
+            return {
+                "writes_sent": self.writes_sent,
+                "writes_suppressed": self.writes_suppressed
+            }
+
+    @staticmethod
+    def get_lease_interval(node_manifest: DynamodbManifest):
+        """
+        Lease interval from SATCOMP_HEARTBEAT_INTERVAL, defaulting to a quarter of the node expiration
+        time. It is capped at half the expiration time so that a live node never looks expired.
+        """
+        max_interval = node_manifest.node_expiration_time / 2
+        interval = float(os.getenv("SATCOMP_HEARTBEAT_INTERVAL", node_manifest.node_expiration_time / 4))
+        return min(interval, max_interval)
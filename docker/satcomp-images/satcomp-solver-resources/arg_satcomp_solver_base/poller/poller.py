@@ -7,18 +7,29 @@ import logging
 import threading
 from enum import Enum
 from json import JSONDecodeError
-from time import sleep
+from time import monotonic, sleep, time
 import os
 
+from botocore.exceptions import ClientError
+
+from arg_satcomp_solver_base.metrics.metrics import MetricsRegistry
 from arg_satcomp_solver_base.node_manifest.dynamodb_manifest import DynamodbManifest
+from arg_satcomp_solver_base.resources.resource_pool import ResourcePool, ResourcePoolException, TaskResources
 from arg_satcomp_solver_base.s3_file_system.s3_file_system import S3FileSystem, S3FileSystemException
-from arg_satcomp_solver_base.solver.command_line_solver import Solver, SolverException
-from arg_satcomp_solver_base.sqs_queue.sqs_queue import SqsQueue, SqsQueueException
+from arg_satcomp_solver_base.solver.command_line_solver import CommandLineSolver, Solver, SolverException
+from arg_satcomp_solver_base.sqs_queue.sqs_queue import MESSAGE_TYPE_ATTRIBUTE, REQUEST_ID_ATTRIBUTE, \
+    STARTED_MESSAGE_TYPE, SqsQueue, SqsQueueException
 from arg_satcomp_solver_base.task_end_notification.task_end_notifier import TaskEndNotifier
+from arg_satcomp_solver_base.tracing.task_trace import TaskTrace, TaskTracer
 from arg_satcomp_solver_base.utils import FileOperations
 
 MOUNT_POINT = '/tmp'
 
+METRICS = MetricsRegistry.get_registry()
+TASKS_IN_FLIGHT = METRICS.gauge("satcomp_tasks_in_flight", "Tasks currently being solved by the leader's pollers")
+TASK_RESULTS = METRICS.counter("satcomp_task_results_total", "Published task results by task state")
+TASK_FAILURES = METRICS.counter("satcomp_task_failures_total", "Tasks that failed without publishing a result, by error")
+
 
 class PollerStatus(Enum):
     HEALTHY = "HEALTHY"
@@ -31,8 +42,14 @@ class PollerTimeoutException(Exception):
 class Poller(threading.Thread):
     """Thread that runs in the background trying to pull work off of an SQS
     queue and submitting that work to a solver"""
-    worker_poll_timeout = 120
+    worker_poll_timeout = int(os.getenv('SATCOMP_WORKER_WAIT_TIMEOUT', '120'))
+    # the manifest is checked immediately, then with exponential backoff up to worker_poll_sleep_time
+    worker_poll_initial_sleep_time = 0.25
     worker_poll_sleep_time = 5
+    # reserved workers are released automatically this long after the task timeout if the leader dies
+    worker_reservation_grace_seconds = 600
+    # In lease mode a message that keeps crashing the leader is dropped after this many deliveries
+    max_receive_count = 3
     queue: SqsQueue
     output_queue: SqsQueue
     node_manifest: DynamodbManifest
@@ -44,6 +61,10 @@ class Poller(threading.Thread):
     s3_file_system: S3FileSystem = S3FileSystem.get_s3_file_system()
     s3_bucket: str
     task_end_notifier: TaskEndNotifier
+    resource_pool: ResourcePool
+    async_upload: bool
+    decompress_formulas: bool
+    task_tracer: TaskTracer
 
     def __init__(self, thread_id: int,
                  ip_address: str,
@@ -52,7 +73,11 @@ class Poller(threading.Thread):
                  node_manifest: DynamodbManifest,
                  task_end_notifier: TaskEndNotifier,
                  solver: Solver, 
-                 s3_bucket: str):
+                 s3_bucket: str,
+                 resource_pool: ResourcePool = None,
+                 async_upload: bool = False,
+                 decompress_formulas: bool = False,
+                 task_tracer: TaskTracer = None):
         threading.Thread.__init__(self)
         self.queue = queue
         self.output_queue = output_queue
@@ -61,10 +86,14 @@ class Poller(threading.Thread):
         self.solver = solver
         self.thread_id = thread_id
         self.ip_address = ip_address
-        self.logger = logging.getLogger("Poller")
+        self.logger = logging.getLogger(f"Poller-{thread_id}")
         self.logger.setLevel(logging.DEBUG)
         self.health_status = PollerStatus.HEALTHY
         self.s3_bucket = s3_bucket
+        self.resource_pool = resource_pool
+        self.async_upload = async_upload
+        self.decompress_formulas = decompress_formulas
+        self.task_tracer = task_tracer or TaskTracer()
 
     def _is_valid_solver_request(self, solver_request):
         # TODO improve message validation
@@ -79,7 +108,8 @@ class Poller(threading.Thread):
                 "solverOptions" : [],
                 "taskTimeoutSeconds" : 5
             },
-            "num_workers": 0
+            "num_workers": 0,
+            "requestId": "" (optional, echoed as request_id in the result)
         }"""
         """ {
             "formula": {
@@ -115,100 +145,326 @@ class Poller(threading.Thread):
         return True
 
     def run(self):
-        # TODO: In the future we should make this more testable by separating the while loop
-        #  from the thread code itself
         # TODO: How do we want to handle client errors/internal server errors
         while True:
             # TODO: For now we are only handling problems that will fit in SQS message.
             #  In the future this will have to change
-            leader_working_directory = None
-            efs_shared_directory = None
+            message = None
+            msg_json = None
+            trace = None
+            # whether the message can never be processed, so that redelivering it is pointless
+            discard = False
+            # why the problem will never get a result from this leader, which is posted to the client in its place
+            failure = None
             try:
                 self.logger.info("Trying to get messages from queue: %s", self.queue.queue_name)
+                receive_start = time()
                 message = self.queue.get_message()
                 if message is None:
                     continue 
-                
+                trace = self.task_tracer.start()
+                trace.add_span("sqs_receive", receive_start, time())
+
                 msg_json = json.loads(message.read())
                 message_handle = message.msg.receipt_handle
                 self.logger.info("Got problem to solve from message with receipt handle: %s", message_handle)
 
-                message.delete()
-                self.logger.info("Deleted message from queue")
+                if not self.queue.lease_mode:
+                    message.delete()
+                    self.logger.info("Deleted message from queue")
+                elif message.receive_count() > self.max_receive_count:
+                    self.logger.error(f"Message with receipt handle {message_handle} was received "
+                                      f"{message.receive_count()} times.  Skipping processing.")
+                    discard = True
+                    failure = f"Message was received {message.receive_count()} times without producing a result"
+                    continue
 
                 if not self._is_valid_solver_request(msg_json):
                     self.logger.error(f"Message {message.read()} is invalid.  Skipping processing.")
+                    discard = True
+                    failure = "Message is not a valid solver request"
                     continue
-                
-                s3_uri = msg_json.get("formula").get("value")
-                timeout = msg_json.get("solverConfig").get("taskTimeoutSeconds")
-                formula_language = msg_json.get("formula").get("language")
-                solver_options = msg_json.get("solverConfig").get("solverOptions")
-                num_workers = msg_json.get("num_workers", 0)
-
-                self.logger.info("Waiting for worker nodes to come up")
-                self.logger.info(f"Task requests {num_workers} worker nodes")
-                workers = self.wait_for_worker_nodes(num_workers)
-                workers.append({"nodeIp": self.ip_address})
-
-                task_uuid = self.file_operations.generate_uuid()
-                efs_uuid_directory = self.file_operations.create_custom_directory(MOUNT_POINT, task_uuid)
-                self.logger.info("Created uuid directory in local container %s", efs_uuid_directory)
-                download_location = self.s3_file_system.download_file(s3_uri, efs_uuid_directory)
-                self.logger.info("Download problem to location: %s", download_location)
-                
-                solver_response = self.solver.solve(download_location, efs_uuid_directory, workers, task_uuid, timeout, formula_language, solver_options)
-                solver_response["driver"]["s3_uri"] = s3_uri
-                self.logger.info("Solver response:")
-                self.logger.info(solver_response)
-
-                self.logger.info("Writing response to output queue")
-                self.output_queue.put_message(json.dumps(solver_response))
-                
-                self.logger.info(f"Writing all files in request directory path: {efs_uuid_directory} to S3 bucket: {self.s3_bucket}")
-                s3_uri = "s3://" + self.s3_bucket + efs_uuid_directory
-                self.logger.info(f"S3 URI is: {s3_uri} and S3 bucket is: {self.s3_bucket}")
-                self.s3_file_system.upload_directory_tree(efs_uuid_directory, s3_uri)
-
-                self.logger.info(
-                    "Cleaning up solver output directory %s",
-                    solver_response["solver"].get("request_directory_path")
-                )
-                self.file_operations.remove_directory(solver_response["solver"].get("request_directory_path"))
-
-
 
-                self.logger.info("Cleaning up uuid directory: %s", efs_uuid_directory)
-                self.file_operations.remove_directory(efs_uuid_directory)
-
-                self.logger.info("Sending notification that solving is complete")
-                self.task_end_notifier.notify_task_end(self.ip_address)
+                resources = self._task_resources(msg_json)
+                if self.resource_pool is not None:
+                    self.logger.info(f"Waiting for task resources: {resources}")
+                    with trace.span("resource_wait"):
+                        self.resource_pool.acquire(resources)
+                TASKS_IN_FLIGHT.inc()
+                try:
+                    self.run_task(msg_json, message, trace)
+                finally:
+                    TASKS_IN_FLIGHT.dec()
+                    if self.resource_pool is not None:
+                        self.resource_pool.release(resources)
 
             except SolverException as e:
+                TASK_FAILURES.inc(error=type(e).__name__)
                 self.logger.error("Failed to run solver on message with receipt handle %s", message.msg.receipt_handle)
                 self.logger.exception(e)
             except SqsQueueException as e:
+                TASK_FAILURES.inc(error=type(e).__name__)
                 self.logger.error("Failed to read from SQS queue: %s", self.queue.queue_name)
                 self.logger.exception(e)
             except JSONDecodeError as e:
+                discard = True
+                failure = "Message is not valid Json"
+                TASK_FAILURES.inc(error=type(e).__name__)
                 self.logger.error("Failed to run solver on message with receipt handle %s", message.msg.receipt_handle)
                 self.logger.error("Message is not valid Json: %s", message.read())
                 self.logger.exception(e)
             except S3FileSystemException as e:
+                TASK_FAILURES.inc(error=type(e).__name__)
                 self.logger.error("Failed to download file from s3")
                 self.logger.exception(e)
+            except ResourcePoolException as e:
+                discard = True
+                failure = f"Invalid resource request: {e}"
+                TASK_FAILURES.inc(error=type(e).__name__)
+                self.logger.error(f"Message {message.read()} has an invalid resource request.  Skipping processing.")
+                self.logger.exception(e)
+            except PollerTimeoutException as e:
+                TASK_FAILURES.inc(error=type(e).__name__)
+                self.logger.error("Timed out waiting for worker nodes on message with receipt handle %s",
+                                  message.msg.receipt_handle)
+                self.logger.exception(e)
+                if not self.queue.lease_mode:
+                    # the message was deleted on receipt, so nobody will retry the problem
+                    failure = f"Timed out waiting for worker nodes: {e}"
+            finally:
+                if failure is not None:
+                    self._post_failure(msg_json, message, failure)
+                if discard:
+                    self._complete_message(message)
+                else:
+                    self._release_message(message)
+                if trace is not None:
+                    self.task_tracer.finish(trace)
+
+    def _complete_message(self, message):
+        """In lease mode the message is only deleted once its result has been posted or it turned out
+        to be unprocessable. If the leader dies before that, SQS redelivers the message."""
+        if message is None or message.lease is None:
+            return
+        try:
+            message.delete()
+            self.logger.info("Deleted message from queue")
+        except ClientError as e:
+            self.logger.error("Failed to delete message with receipt handle %s", message.msg.receipt_handle)
+            self.logger.exception(e)
+
+    def _release_message(self, message):
+        """In lease mode a message whose result was not posted is made visible again, so that it is retried
+        until it exceeds max_receive_count. Messages that were already deleted are left alone."""
+        if message is None or message.lease is None:
+            return
+        try:
+            message.release()
+        except ClientError as e:
+            # the message becomes visible again once its last lease extension expires
+            self.logger.error("Failed to release message with receipt handle %s", message.msg.receipt_handle)
+            self.logger.exception(e)
 
+    def run_task(self, msg_json: dict, message=None, trace: TaskTrace = None):
+        """Solve a single validated solver request and publish its result.
+        The phases of the task are recorded as spans of trace (a new, unexported trace if none is given)."""
+        trace = trace or TaskTrace()
+        timeout = msg_json.get("solverConfig").get("taskTimeoutSeconds")
+        num_workers = msg_json.get("num_workers", 0)
+
+        task_uuid = self.file_operations.generate_uuid()
+        trace.set_attribute("task_id", task_uuid)
+        trace.set_attribute("request_id", self._get_request_id(msg_json, message))
+        trace.set_attribute("num_workers", num_workers)
+        self.logger.info("Waiting for worker nodes to come up")
+        self.logger.info(f"Task requests {num_workers} worker nodes")
+        reservation_seconds = (timeout or CommandLineSolver.DEFAULT_TIMEOUT_SECONDS) + self.worker_reservation_grace_seconds
+        with trace.span("worker_wait"):
+            workers = self.wait_for_worker_nodes(num_workers, task_uuid, reservation_seconds)
+        try:
+            self._solve_task(msg_json, task_uuid, workers, message, trace)
+        finally:
+            with trace.span("worker_release"):
+                self.release_worker_nodes(workers, task_uuid)
+
+    def _solve_task(self, msg_json: dict, task_uuid: str, workers: list, message=None, trace: TaskTrace = None):
+        trace = trace or TaskTrace()
+        s3_uri = msg_json.get("formula").get("value")
+        timeout = msg_json.get("solverConfig").get("taskTimeoutSeconds")
+        formula_language = msg_json.get("formula").get("language")
+        solver_options = msg_json.get("solverConfig").get("solverOptions")
+        workers = workers + [{"nodeIp": self.ip_address}]
+
+        self._notify_started(self._get_request_id(msg_json, message))
+        efs_uuid_directory = self.file_operations.create_custom_directory(MOUNT_POINT, task_uuid)
+        self.logger.info("Created uuid directory in local container %s", efs_uuid_directory)
+        with trace.span("s3_download") as download_span:
+            if self.decompress_formulas:
+                original_location, download_location = self.s3_file_system.download_and_decompress_file(s3_uri, efs_uuid_directory)
+            else:
+                download_location = self.s3_file_system.download_file(s3_uri, efs_uuid_directory)
+                original_location = download_location
+            download_span.attributes["bytes"] = os.path.getsize(original_location)
+        self.logger.info("Download problem to location: %s", download_location)
 
-    def wait_for_worker_nodes(self, num_workers):
-        worker_nodes = []
-        wait_time = 0
+        with trace.span("solve") as solve_span:
+            solver_response = self.solver.solve(download_location, efs_uuid_directory, workers, task_uuid, timeout, formula_language, solver_options,
+                                                original_location, self._task_resources(msg_json))
+        # the rest of the solve span is spent setting up the run and reading the solver output
+        solve_span.attributes["solver_runtime_millis"] = solver_response["driver"].get("solver_runtime_millis")
+        solve_span.attributes["timed_out"] = solver_response["driver"].get("timed_out")
+        solver_response["driver"]["s3_uri"] = s3_uri
+        request_id = self._get_request_id(msg_json, message)
+        solver_response["request_id"] = request_id
+        # the phases up to here; the complete trace goes to the task tracer's exporters
+        solver_response["trace"] = trace.to_dict()
+        self.logger.info("Solver response:")
+        self.logger.info(solver_response)
+
+        self.logger.info(f"Writing response to request {request_id} to output queue")
+        attributes = {REQUEST_ID_ATTRIBUTE: request_id} if request_id else None
+        with trace.span("result_publish"):
+            self.output_queue.put_message(json.dumps(solver_response), attributes)
+            self._complete_message(message)
+        TASK_RESULTS.inc(state=(solver_response.get("task_state") or {}).get("status", "COMPLETED"))
+
+        self.logger.info(f"Writing all files in request directory path: {efs_uuid_directory} to S3 bucket: {self.s3_bucket}")
+        s3_uri = "s3://" + self.s3_bucket + efs_uuid_directory
+        self.logger.info(f"S3 URI is: {s3_uri} and S3 bucket is: {self.s3_bucket}")
+        request_directory_path = solver_response["solver"].get("request_directory_path")
+        if self.async_upload:
+            trace.defer()
+            upload_start = time()
+            upload = self.s3_file_system.upload_directory_tree_async(efs_uuid_directory, s3_uri)
+            upload.add_done_callback(
+                lambda future: self._finish_upload(future, request_directory_path, efs_uuid_directory, trace, upload_start))
+        else:
+            try:
+                with trace.span("artifact_upload") as upload_span:
+                    upload_report = self.s3_file_system.upload_directory_tree(efs_uuid_directory, s3_uri)
+                    upload_span.attributes["bytes"] = upload_report["total_bytes"]
+            finally:
+                with trace.span("cleanup"):
+                    self._cleanup_task_directories(request_directory_path, efs_uuid_directory)
+
+        self.logger.info("Sending notification that solving is complete")
+        with trace.span("task_end_notify"):
+            self.task_end_notifier.notify_task_end(self.ip_address)
+
+    def _task_resources(self, msg_json: dict):
+        # tasks sharing the node through the pool are held to the cores they reserve, requested or not
+        default_cores = self.resource_pool.default_cores if self.resource_pool is not None else None
+        return TaskResources.from_request(msg_json, default_cores)
+
+    def _notify_started(self, request_id: str):
+        """Tell the client that the problem left the queue, so that it starts the clock on its result"""
+        if not request_id:
+            return
+        try:
+            self.output_queue.put_message(json.dumps({"request_id": request_id, "status": "STARTED"}),
+                                          {REQUEST_ID_ATTRIBUTE: request_id, MESSAGE_TYPE_ATTRIBUTE: STARTED_MESSAGE_TYPE})
+        except SqsQueueException as e:
+            # the client then waits for the result without a deadline
+            self.logger.error(f"Failed to send started notification for request {request_id}")
+            self.logger.exception(e)
+
+    def _post_failure(self, msg_json: dict, message, reason: str):
+        """Post a FAILED result for a problem that this leader gives up on, so that its client stops waiting.
+        Problems without a request id cannot be matched to a client and are only logged."""
+        # the body of an unprocessable message may be anything
+        msg_json = msg_json if isinstance(msg_json, dict) else {}
+        request_id = self._get_request_id(msg_json, message)
+        if not request_id:
+            return
+        formula = msg_json.get("formula")
+        self.logger.info(f"Writing failure of request {request_id} to output queue: {reason}")
+        failure_response = {
+            "task_id": None,
+            "request_id": request_id,
+            "driver": {
+                "s3_uri": formula.get("value") if isinstance(formula, dict) else None,
+                "timed_out": False
+            },
+            "solver": {
+                "output": None
+            },
+            "task_state": {
+                "status": "FAILED",
+                "message": reason
+            }
+        }
+        try:
+            self.output_queue.put_message(json.dumps(failure_response), {REQUEST_ID_ATTRIBUTE: request_id})
+            TASK_RESULTS.inc(state="FAILED")
+        except SqsQueueException as e:
+            self.logger.error(f"Failed to send failure of request {request_id}")
+            self.logger.exception(e)
+
+    @staticmethod
+    def _get_request_id(msg_json: dict, message=None):
+        """Id assigned by the client when it submitted the problem, from the message body or attributes"""
+        request_id = msg_json.get("requestId")
+        if request_id is None and message is not None:
+            request_id = message.attribute(REQUEST_ID_ATTRIBUTE)
+        return request_id
+
+    def _finish_upload(self, upload, request_directory_path: str, efs_uuid_directory: str, trace: TaskTrace = None,
+                       upload_start: float = None):
+        """Callback run once a background upload of the task directory is done"""
+        traced = trace is not None
+        trace = trace or TaskTrace()
+        upload_span = trace.add_span("artifact_upload", upload_start or time(), time(), background=True)
+        try:
+            upload_span.attributes["bytes"] = upload.result()["total_bytes"]
+        except Exception as e:
+            upload_span.attributes["error"] = type(e).__name__
+            self.logger.error("Failed to upload task directory %s to s3", efs_uuid_directory)
+            self.logger.exception(e)
+        with trace.span("cleanup"):
+            self._cleanup_task_directories(request_directory_path, efs_uuid_directory)
+        if traced:
+            self.task_tracer.finish(trace)
+
+    def _cleanup_task_directories(self, request_directory_path: str, efs_uuid_directory: str):
+        self.logger.info("Cleaning up solver output directory %s", request_directory_path)
+        self.file_operations.remove_directory(request_directory_path)
+
+        self.logger.info("Cleaning up uuid directory: %s", efs_uuid_directory)
+        self.file_operations.remove_directory(efs_uuid_directory)
+
+    def wait_for_worker_nodes(self, num_workers, task_id: str, reservation_seconds: int):
+        """Reserve num_workers READY worker nodes for a task, returning as soon as enough are available"""
+        if num_workers == 0:
+            return []
+        deadline = monotonic() + self.worker_poll_timeout
+        sleep_time = self.worker_poll_initial_sleep_time
         self.logger.info(f"Waiting for {num_workers} worker nodes")
-        while len(worker_nodes) < num_workers:
-            worker_nodes = self.node_manifest.get_all_ready_worker_nodes()
-            sleep(self.worker_poll_sleep_time)
-            wait_time += self.worker_poll_sleep_time
-            if wait_time > self.worker_poll_timeout:
+        while True:
+            worker_nodes = self.node_manifest.get_all_available_worker_nodes()
+            if len(worker_nodes) >= num_workers:
+                reserved_nodes = self._reserve_worker_nodes(worker_nodes, num_workers, task_id, reservation_seconds)
+                if reserved_nodes is not None:
+                    self.logger.info(f"Workers reserved: {reserved_nodes}")
+                    return reserved_nodes
+            if monotonic() + sleep_time > deadline:
                 raise PollerTimeoutException(f"Timed out waiting for {num_workers} to report. "
                                              f"Only {len(worker_nodes)} reported")
-        self.logger.info(f"Workers reported: {worker_nodes}")
-        return worker_nodes
+            sleep(sleep_time)
+            sleep_time = min(sleep_time * 2, self.worker_poll_sleep_time)
+
+    def _reserve_worker_nodes(self, worker_nodes: list, num_workers: int, task_id: str, reservation_seconds: int):
+        """Try to reserve num_workers of worker_nodes. All-or-nothing: partial reservations are released
+        so that two tasks cannot deadlock each holding part of the cluster."""
+        reserved_nodes = []
+        for node in worker_nodes:
+            if self.node_manifest.reserve_node(node["nodeId"], task_id, reservation_seconds):
+                reserved_nodes.append(node)
+                if len(reserved_nodes) == num_workers:
+                    return reserved_nodes
+        self.logger.info(f"Only reserved {len(reserved_nodes)} of {num_workers} worker nodes, releasing them")
+        self.release_worker_nodes(reserved_nodes, task_id)
+        return None
+
+    def release_worker_nodes(self, worker_nodes: list, task_id: str):
+        for node in worker_nodes:
+            self.node_manifest.release_node(node["nodeId"], task_id)
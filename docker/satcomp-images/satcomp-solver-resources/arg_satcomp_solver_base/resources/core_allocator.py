@@ -0,0 +1,170 @@
+"""
+Placement of concurrent solves on disjoint sets of CPUs.
+Each task gets its own logical CPUs, handed out as whole physical cores (all hyperthread siblings)
+and from a single NUMA node whenever the request fits in one, so that portfolio threads of one
+solver keep their caches and memory local and do not compete with other tasks.
+"""
+import glob
+import logging
+import os
+import sys
+import threading
+from dataclasses import dataclass
+
+SYSFS_SYSTEM = "/sys/devices/system"
+
+
+class CoreAllocatorException(Exception):
+    """Exception for CoreAllocator errors"""
+
+
+def parse_cpu_list(cpu_list: str):
+    """Parse a kernel cpu list such as "0-3,8,10-11" """
+    cpus = []
+    for part in cpu_list.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def pin_command(cmd: list, cpus: list):
+    """Command that restricts itself to cpus before exec'ing cmd, so the solver and every process
+    it starts inherit the affinity"""
+    return [sys.executable, "-c",
+            "import os, sys; os.sched_setaffinity(0, map(int, sys.argv[1].split(','))); "
+            "os.execvp(sys.argv[2], sys.argv[2:])",
+            ",".join(map(str, cpus))] + cmd
+
+
+@dataclass(frozen=True)
+class LogicalCpu:
+    cpu: int
+    core: tuple
+    numa_node: int
+
+
+class CpuTopology:
+    """Logical CPUs this process may run on, with their physical core and NUMA node"""
+
+    def __init__(self, cpus: list):
+        self.cpus = {cpu.cpu: cpu for cpu in cpus}
+
+    def siblings(self, core: tuple):
+        return [cpu.cpu for cpu in self.cpus.values() if cpu.core == core]
+
+    @staticmethod
+    def _read_int(path: str, default: int):
+        try:
+            with open(path) as sysfs_file:
+                return int(sysfs_file.read())
+        except (OSError, ValueError):
+            return default
+
+    @staticmethod
+    def detect(sysfs_system: str = SYSFS_SYSTEM):
+        numa_nodes = {}
+        for node_path in glob.glob(os.path.join(sysfs_system, "node", "node[0-9]*")):
+            node = int(os.path.basename(node_path)[len("node"):])
+            try:
+                with open(os.path.join(node_path, "cpulist")) as cpulist:
+                    for cpu in parse_cpu_list(cpulist.read()):
+                        numa_nodes[cpu] = node
+            except OSError:
+                pass
+        cpus = []
+        for cpu in sorted(os.sched_getaffinity(0)):
+            topology = os.path.join(sysfs_system, "cpu", f"cpu{cpu}", "topology")
+            package = CpuTopology._read_int(os.path.join(topology, "physical_package_id"), 0)
+            core = CpuTopology._read_int(os.path.join(topology, "core_id"), cpu)
+            cpus.append(LogicalCpu(cpu, (package, core), numa_nodes.get(cpu, 0)))
+        return CpuTopology(cpus)
+
+
+class CoreAllocator:
+    """Hands out disjoint sets of logical CPUs to tasks and takes them back when the tasks end"""
+
+    def __init__(self, topology: CpuTopology):
+        self.topology = topology
+        self.free_cpus = set(topology.cpus)
+        self.allocations = {}
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("CoreAllocator")
+        self.logger.setLevel(logging.DEBUG)
+
+    @property
+    def total_cpus(self):
+        return len(self.topology.cpus)
+
+    def _free_cpus_by_node(self):
+        nodes = {}
+        for cpu in self.free_cpus:
+            nodes.setdefault(self.topology.cpus[cpu].numa_node, []).append(cpu)
+        return nodes
+
+    def _take_from(self, cpus: list, count: int):
+        """Take count of cpus, preferring physical cores that are entirely free"""
+        cores = {}
+        for cpu in cpus:
+            cores.setdefault(self.topology.cpus[cpu].core, []).append(cpu)
+        ordered_cores = sorted(cores.items(), key=lambda item: (
+            len(item[1]) < len(self.topology.siblings(item[0])), -len(item[1]), item[0]))
+        taken = []
+        for _, core_cpus in ordered_cores:
+            taken.extend(sorted(core_cpus)[:count - len(taken)])
+            if len(taken) == count:
+                break
+        return taken
+
+    def allocate(self, task_id: str, count: int):
+        """
+        Reserve count logical CPUs for a task. The smallest NUMA node that can hold the whole
+        request is used; larger requests are spread over the nodes with the most free CPUs.
+        Returns the sorted list of CPUs, or None if not enough CPUs are free.
+        """
+        with self.lock:
+            if task_id in self.allocations:
+                raise CoreAllocatorException(f"Task {task_id} already has CPUs {self.allocations[task_id]}")
+            count = min(count, self.total_cpus)
+            if count > len(self.free_cpus):
+                self.logger.warning(f"Only {len(self.free_cpus)} CPUs free, cannot place {count} for task {task_id}")
+                return None
+            nodes = self._free_cpus_by_node()
+            fitting_nodes = [node for node, cpus in nodes.items() if len(cpus) >= count]
+            if fitting_nodes:
+                node = min(fitting_nodes, key=lambda n: (len(nodes[n]), n))
+                cpus = self._take_from(nodes[node], count)
+            else:
+                cpus = []
+                for node in sorted(nodes, key=lambda n: (-len(nodes[n]), n)):
+                    cpus.extend(self._take_from(nodes[node], count - len(cpus)))
+                    if len(cpus) == count:
+                        break
+            cpus = sorted(cpus)
+            self.free_cpus.difference_update(cpus)
+            self.allocations[task_id] = cpus
+            self.logger.info(f"Placed task {task_id} on CPUs {cpus}; {len(self.free_cpus)} CPUs free")
+            return cpus
+
+    def release(self, task_id: str):
+        with self.lock:
+            cpus = self.allocations.pop(task_id, None)
+            if cpus is not None:
+                self.free_cpus.update(cpus)
+                self.logger.info(f"Released CPUs {cpus} of task {task_id}; {len(self.free_cpus)} CPUs free")
+
+    def placement(self, cpus: list):
+        """Description of a CPU set as reported in the task result"""
+        return {
+            "cpus": cpus,
+            "physical_cores": len({self.topology.cpus[cpu].core for cpu in cpus}),
+            "numa_nodes": sorted({self.topology.cpus[cpu].numa_node for cpu in cpus})
+        }
+
+    @staticmethod
+    def get_core_allocator():
+        return CoreAllocator(CpuTopology.detect())
@@ -0,0 +1,164 @@
+"""
+Resource accounting that lets several pollers run solver tasks concurrently on one node.
+Each task reserves a number of cores and megabytes of memory from a shared pool before it
+starts solving and gives them back once it is finished.
+"""
+import logging
+import os
+import threading
+from dataclasses import dataclass
+
+
+class ResourcePoolException(Exception):
+    """Exception for ResourcePool errors"""
+
+
+@dataclass
+class TaskResources:
+    """Resources requested by a single task"""
+    cores: int = 1
+    memory_mb: int = 0
+    exclusive: bool = False
+    # whether the task is held to its cores; tasks that did not ask for cores on a node they do not
+    # share may use all of it
+    cores_reserved: bool = False
+
+    @staticmethod
+    def from_request(solver_request: dict, default_cores: int = None):
+        """
+        Build the resource request of a task from its solver request message.
+        Expected (optional) message structure:
+        {
+            "resources": {
+                "cores": 1,
+                "memoryMb": 4096,
+                "exclusive": false
+            }
+        }
+        Distributed tasks (num_workers > 0) are exclusive by default since the task end
+        notification cleans up every solver process on the worker nodes.
+        Tasks without a cores request get default_cores reserved, or none if it is None.
+        """
+        resources = solver_request.get("resources") or {}
+        cores_reserved = "cores" in resources or default_cores is not None
+        try:
+            cores = int(resources.get("cores", default_cores or 1))
+            memory_mb = int(resources.get("memoryMb", 0))
+        except (TypeError, ValueError):
+            raise ResourcePoolException(f"Invalid resource request: {resources}")
+        if cores < 1 or memory_mb < 0:
+            raise ResourcePoolException(f"Invalid resource request: {resources}")
+        exclusive = bool(resources.get("exclusive", solver_request.get("num_workers", 0) > 0))
+        return TaskResources(cores, memory_mb, exclusive, cores_reserved)
+
+
+class ResourcePool:
+    """
+    Pool of cores and memory shared by all pollers running on a node.
+    Exclusive tasks wait until the node is idle and keep every other task out while they run.
+    A waiting exclusive task blocks new non-exclusive tasks so it cannot be starved.
+    """
+
+    def __init__(self, total_cores: int, total_memory_mb: int = 0, default_cores: int = 1):
+        self.total_cores = total_cores
+        self.total_memory_mb = total_memory_mb
+        # cores reserved by tasks that do not request any
+        self.default_cores = default_cores
+        self.free_cores = total_cores
+        self.free_memory_mb = total_memory_mb
+        self.active_tasks = 0
+        self.exclusive_active = False
+        self.exclusive_waiting = 0
+        self.condition = threading.Condition()
+        self.logger = logging.getLogger("ResourcePool")
+        self.logger.setLevel(logging.DEBUG)
+
+    def _clamp(self, resources: TaskResources):
+        """Requests larger than the node would never be scheduled, so they are capped at the node size"""
+        cores = min(resources.cores, self.total_cores)
+        memory_mb = resources.memory_mb
+        if self.total_memory_mb:
+            memory_mb = min(memory_mb, self.total_memory_mb)
+        return cores, memory_mb
+
+    def _fits(self, resources: TaskResources):
+        if self.exclusive_active:
+            return False
+        if resources.exclusive:
+            return self.active_tasks == 0
+        if self.exclusive_waiting > 0:
+            return False
+        cores, memory_mb = self._clamp(resources)
+        if cores > self.free_cores:
+            return False
+        if self.total_memory_mb and memory_mb > self.free_memory_mb:
+            return False
+        return True
+
+    def acquire(self, resources: TaskResources, timeout: float = None):
+        """
+        Block until the requested resources are available and reserve them.
+        Returns False if the timeout expired before the resources could be reserved.
+        """
+        with self.condition:
+            if resources.exclusive:
+                self.exclusive_waiting += 1
+            try:
+                if not self.condition.wait_for(lambda: self._fits(resources), timeout=timeout):
+                    return False
+            finally:
+                if resources.exclusive:
+                    self.exclusive_waiting -= 1
+            if resources.exclusive:
+                self.exclusive_active = True
+                self.free_cores = 0
+                self.free_memory_mb = 0
+            else:
+                cores, memory_mb = self._clamp(resources)
+                self.free_cores -= cores
+                if self.total_memory_mb:
+                    self.free_memory_mb -= memory_mb
+            self.active_tasks += 1
+            self.logger.info(f"Reserved {resources}; {self.free_cores} cores and "
+                             f"{self.free_memory_mb} MB free, {self.active_tasks} tasks active")
+            return True
+
+    def release(self, resources: TaskResources):
+        """Give the resources of a finished task back to the pool"""
+        with self.condition:
+            if self.active_tasks == 0:
+                raise ResourcePoolException("Released resources that were never acquired")
+            if resources.exclusive:
+                self.exclusive_active = False
+                self.free_cores = self.total_cores
+                self.free_memory_mb = self.total_memory_mb
+            else:
+                cores, memory_mb = self._clamp(resources)
+                self.free_cores += cores
+                if self.total_memory_mb:
+                    self.free_memory_mb += memory_mb
+            self.active_tasks -= 1
+            self.logger.info(f"Released {resources}; {self.free_cores} cores and "
+                             f"{self.free_memory_mb} MB free, {self.active_tasks} tasks active")
+            self.condition.notify_all()
+
+    @staticmethod
+    def get_total_memory_mb():
+        try:
+            with open("/proc/meminfo") as meminfo:
+                for line in meminfo:
+                    if line.startswith("MemTotal:"):
+                        return int(line.split()[1]) // 1024
+        except OSError:
+            pass
+        return 0
+
+    @staticmethod
+    def get_resource_pool(poller_count: int = 1):
+        """
+        Build the pool for this node; SATCOMP_LEADER_CORES and SATCOMP_LEADER_MEMORY_MB override detection.
+        Tasks that do not request cores get an even share of the node among the pollers.
+        """
+        total_cores = int(os.getenv("SATCOMP_LEADER_CORES", len(os.sched_getaffinity(0))))
+        total_memory_mb = int(os.getenv("SATCOMP_LEADER_MEMORY_MB", ResourcePool.get_total_memory_mb()))
+        return ResourcePool(total_cores, total_memory_mb, max(1, total_cores // poller_count))
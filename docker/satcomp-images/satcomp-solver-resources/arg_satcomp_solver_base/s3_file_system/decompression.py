@@ -0,0 +1,154 @@
+"""Streaming decompression of compressed formula files (.xz, .gz, .bz2, .zst)"""
+import bz2
+import lzma
+import ntpath
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DECOMPRESSION_ERRORS = (lzma.LZMAError, zlib.error, OSError, EOFError)
+if zstandard is not None:
+    DECOMPRESSION_ERRORS += (zstandard.ZstdError,)
+
+# Compressed input is read in small chunks, and decompressed output is written in pieces of at most
+# OUTPUT_CHUNK_SIZE, so that highly compressible formulas stay within bounded memory
+CHUNK_SIZE = 64 * 1024
+OUTPUT_CHUNK_SIZE = 1024 * 1024
+HEADER_SIZE = 6
+
+COMPRESSION_SUFFIXES = {
+    ".xz": "xz",
+    ".lzma": "xz",
+    ".gz": "gzip",
+    ".bz2": "bzip2",
+    ".zst": "zstd",
+    ".zstd": "zstd",
+}
+
+COMPRESSION_MAGIC = {
+    b"\xfd7zXZ\x00": "xz",
+    b"\x1f\x8b": "gzip",
+    b"BZh": "bzip2",
+    b"\x28\xb5\x2f\xfd": "zstd",
+}
+
+
+class DecompressionException(Exception):
+    """Exception for formula decompression errors"""
+
+
+def detect_compression(file_name: str, header: bytes):
+    """Return the compression format of a file from its magic bytes, falling back to its suffix"""
+    for magic, compression in COMPRESSION_MAGIC.items():
+        if header.startswith(magic):
+            return compression
+    for suffix, compression in COMPRESSION_SUFFIXES.items():
+        if file_name.endswith(suffix):
+            return compression
+    return None
+
+
+def decompressed_file_name(file_name: str):
+    """Name of the decompressed file: the compressed file name without its compression suffix"""
+    file_name = ntpath.basename(file_name)
+    for suffix in COMPRESSION_SUFFIXES:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return "decompressed_" + file_name
+
+
+def _new_decompressor(compression: str):
+    if compression == "xz":
+        return lzma.LZMADecompressor()
+    if compression == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == "bzip2":
+        return bz2.BZ2Decompressor()
+    raise DecompressionException(f"Unsupported compression format {compression}")
+
+
+def _bounded_decompress(decompressor, data: bytes):
+    """Decompress data, yielding the output in pieces of at most OUTPUT_CHUNK_SIZE bytes"""
+    if hasattr(decompressor, "unconsumed_tail"):
+        # zlib keeps the input it did not get to in unconsumed_tail
+        yield decompressor.decompress(data, OUTPUT_CHUNK_SIZE)
+        while decompressor.unconsumed_tail and not decompressor.eof:
+            yield decompressor.decompress(decompressor.unconsumed_tail, OUTPUT_CHUNK_SIZE)
+    else:
+        # lzma and bz2 buffer the input themselves until needs_input
+        yield decompressor.decompress(data, OUTPUT_CHUNK_SIZE)
+        while not decompressor.eof and not decompressor.needs_input:
+            yield decompressor.decompress(b"", OUTPUT_CHUNK_SIZE)
+
+
+class _TeeReader:
+    """Reader over source that first returns header, counts what it returns and copies it to tee_handle"""
+
+    def __init__(self, source, tee_handle=None, header: bytes = b""):
+        self.source = source
+        self.tee_handle = tee_handle
+        self.header = header
+        self.bytes_read = 0
+
+    def read(self, size: int = CHUNK_SIZE):
+        if self.header:
+            chunk, self.header = self.header, b""
+        else:
+            chunk = self.source.read(size)
+        self.bytes_read += len(chunk)
+        if chunk and self.tee_handle is not None:
+            self.tee_handle.write(chunk)
+        return chunk
+
+
+def _decompress_zstd(reader: _TeeReader, out_handle):
+    if zstandard is None:
+        raise DecompressionException("zstandard module is not installed; cannot decompress .zst formulas")
+    # the decompressobj of zstandard returns all output of its input at once, its stream reader does not;
+    # the stream reader ends quietly at the end of the input though, so truncated zstd streams go unnoticed
+    with zstandard.ZstdDecompressor().stream_reader(reader, read_size=CHUNK_SIZE, read_across_frames=True,
+                                                    closefd=False) as zstd_reader:
+        output = zstd_reader.read(OUTPUT_CHUNK_SIZE)
+        while output:
+            out_handle.write(output)
+            output = zstd_reader.read(OUTPUT_CHUNK_SIZE)
+
+
+def decompress_stream(source, compression: str, out_handle, tee_handle=None, header: bytes = b""):
+    """
+    Decompress everything read from source into out_handle in a single pass, holding at most
+    OUTPUT_CHUNK_SIZE bytes of decompressed output in memory.
+    Compressed bytes are also copied to tee_handle if one is given. Concatenated streams
+    (e.g. multi-member gzip files) are decompressed one after the other.
+    Returns the number of compressed bytes read.
+    """
+    reader = _TeeReader(source, tee_handle, header)
+    if compression == "zstd":
+        try:
+            _decompress_zstd(reader, out_handle)
+        except DECOMPRESSION_ERRORS as e:
+            raise DecompressionException(f"Failed to decompress {compression} stream: {e}")
+        return reader.bytes_read
+    decompressor = _new_decompressor(compression)
+    chunk = reader.read(CHUNK_SIZE)
+    try:
+        while chunk:
+            data = chunk
+            while data:
+                if decompressor.eof:
+                    # the previous stream ended, the remaining data starts a new one
+                    decompressor = _new_decompressor(compression)
+                for output in _bounded_decompress(decompressor, data):
+                    out_handle.write(output)
+                data = decompressor.unused_data if decompressor.eof else b""
+            chunk = reader.read(CHUNK_SIZE)
+        if not decompressor.eof:
+            raise DecompressionException(f"Compressed {compression} stream is truncated")
+        if hasattr(decompressor, "flush"):
+            out_handle.write(decompressor.flush())
+    except DECOMPRESSION_ERRORS as e:
+        raise DecompressionException(f"Failed to decompress {compression} stream: {e}")
+    return reader.bytes_read
@@ -0,0 +1,100 @@
+"""On-disk cache of problem files downloaded from S3, keyed by bucket, key and ETag"""
+import fcntl
+import hashlib
+import logging
+import ntpath
+import os
+import shutil
+import threading
+
+# ioctl request that clones (reflinks) a file on filesystems supporting copy-on-write (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+class FormulaCache:
+    """
+    Content-addressed cache of formula files with a size cap and least-recently-used eviction.
+    Tasks get their own reflink (on copy-on-write filesystems) or copy of a cached file, never a
+    hardlink, so a solver that writes to or truncates its formula cannot corrupt the cache entry
+    shared with later tasks. Re-running the same formula thus costs a local copy instead of a download.
+    """
+
+    def __init__(self, s3_client, cache_directory: str, max_bytes: int):
+        self.s3_client = s3_client
+        self.cache_directory = cache_directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entry_locks = {}
+        self.logger = logging.getLogger("FormulaCache")
+        self.logger.setLevel(logging.DEBUG)
+        os.makedirs(cache_directory, exist_ok=True)
+
+    def _entry_lock(self, entry_name: str):
+        with self.lock:
+            return self.entry_locks.setdefault(entry_name, threading.Lock())
+
+    def _entry_name(self, bucket_name: str, file_path: str, etag: str):
+        digest = hashlib.sha256(f"{bucket_name}/{file_path}/{etag}".encode("UTF-8")).hexdigest()
+        # keep the original file name so that suffixes such as .cnf.xz survive
+        return f"{digest}-{ntpath.basename(file_path)}"
+
+    def fetch(self, bucket_name: str, file_path: str, download_dest: str):
+        """
+        Place s3://bucket_name/file_path at download_dest, downloading it only on a cache miss.
+        Returns whether the file was downloaded from S3.
+        """
+        etag = self.s3_client.head_object(Bucket=bucket_name, Key=file_path)["ETag"].strip('"')
+        entry_name = self._entry_name(bucket_name, file_path, etag)
+        cached_path = os.path.join(self.cache_directory, entry_name)
+        with self._entry_lock(entry_name):
+            downloaded = not os.path.exists(cached_path)
+            if not downloaded:
+                self.logger.info("Cache hit for s3://%s/%s (ETag %s)", bucket_name, file_path, etag)
+                os.utime(cached_path)
+            else:
+                self.logger.info("Cache miss for s3://%s/%s (ETag %s)", bucket_name, file_path, etag)
+                partial_path = cached_path + ".partial"
+                try:
+                    self.s3_client.download_file(bucket_name, file_path, partial_path)
+                    os.chmod(partial_path, 0o444)
+                    os.replace(partial_path, cached_path)
+                finally:
+                    if os.path.exists(partial_path):
+                        os.remove(partial_path)
+            self._clone(cached_path, download_dest)
+        self.evict(keep=cached_path)
+        return downloaded
+
+    @staticmethod
+    def _clone(cached_path: str, download_dest: str):
+        with open(cached_path, "rb") as source, open(download_dest, "wb") as dest:
+            try:
+                fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+                return
+            except OSError:
+                pass
+            shutil.copyfileobj(source, dest, 1024 * 1024)
+
+    def evict(self, keep: str = None):
+        """Remove least recently used entries until the cache fits into max_bytes"""
+        with self.lock:
+            entries = []
+            for entry in os.scandir(self.cache_directory):
+                if entry.is_file() and not entry.name.endswith(".partial"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.name))
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                path = os.path.join(self.cache_directory, name)
+                entry_lock = self.entry_locks.get(name)
+                if path == keep or (entry_lock is not None and entry_lock.locked()):
+                    # being downloaded or copied into a task directory right now
+                    continue
+                self.logger.info("Evicting %s (%d bytes) from formula cache", path, size)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
@@ -2,10 +2,31 @@
 import logging
 import ntpath
 import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
+from arg_satcomp_solver_base.s3_file_system.decompression import DecompressionException, HEADER_SIZE, \
+    decompress_stream, decompressed_file_name, detect_compression
+from arg_satcomp_solver_base.metrics.metrics import MetricsRegistry
+from arg_satcomp_solver_base.s3_file_system.formula_cache import FormulaCache
+
+MB = 1024 * 1024
+
+METRICS = MetricsRegistry.get_registry()
+S3_TRANSFERS = METRICS.counter("satcomp_s3_transfers_total", "Files downloaded from and uploaded to S3, by outcome")
+S3_TRANSFER_BYTES = METRICS.counter("satcomp_s3_transfer_bytes_total", "Bytes downloaded from and uploaded to S3",
+                                    unit="Bytes")
+S3_TRANSFER_SECONDS = METRICS.histogram("satcomp_s3_transfer_seconds", "Time to download or upload a single file")
+FORMULA_CACHE_HITS = METRICS.counter("satcomp_formula_cache_hits_total", "Formulas served from the local formula cache")
+FORMULA_CACHE_HIT_BYTES = METRICS.counter("satcomp_formula_cache_hit_bytes_total",
+                                          "Bytes served from the local formula cache instead of S3", unit="Bytes")
+
 
 class S3FileSystemException(Exception):
     """Exception for S3FileSystem errors"""
@@ -13,12 +34,46 @@ class S3FileSystemException(Exception):
 
 class S3FileSystem:
     """Class to represent an S3 storage"""
+    # Files uploaded concurrently by upload_directory_tree
+    max_upload_workers = 8
+    # Directory trees uploaded concurrently in the background by upload_directory_tree_async
+    max_async_uploads = 2
 
-    def __init__(self, s3_client):
+    def __init__(self, s3_client, transfer_config: TransferConfig = None, formula_cache: FormulaCache = None):
         self.s3_client = s3_client
+        self.formula_cache = formula_cache
+        if transfer_config is None:
+            transfer_config = TransferConfig(multipart_threshold=16 * MB, multipart_chunksize=16 * MB,
+                                             max_concurrency=4, use_threads=True)
+        self.transfer_config = transfer_config
+        self.file_upload_executor = ThreadPoolExecutor(max_workers=self.max_upload_workers,
+                                                       thread_name_prefix="S3FileUpload")
+        self.directory_upload_executor = ThreadPoolExecutor(max_workers=self.max_async_uploads,
+                                                            thread_name_prefix="S3DirectoryUpload")
         self.logger = logging.getLogger("S3FileSystem")
         self.logger.setLevel(logging.DEBUG)
 
+    @staticmethod
+    def _record_transfer(direction: str, start_time: float, path: str = None):
+        """Count a finished transfer of path; a transfer without a path failed"""
+        if path is None:
+            S3_TRANSFERS.inc(direction=direction, outcome="error")
+            return
+        S3_TRANSFERS.inc(direction=direction, outcome="ok")
+        S3_TRANSFER_SECONDS.observe(time.perf_counter() - start_time, direction=direction)
+        try:
+            S3_TRANSFER_BYTES.inc(os.path.getsize(path), direction=direction)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _record_cache_hit(path: str):
+        FORMULA_CACHE_HITS.inc()
+        try:
+            FORMULA_CACHE_HIT_BYTES.inc(os.path.getsize(path))
+        except OSError:
+            pass
+
     def download_file(self, problem_uri: str, download_dest_folder: str):
         """
         Function to download file based on user provided url
@@ -36,24 +91,96 @@ class S3FileSystem:
         file_name = ntpath.basename(file_path)
         download_dest = os.path.join(download_dest_folder, file_name)
 
+        start_time = time.perf_counter()
         try:
             self.logger.debug('Downloading file %s from bucket %s to destination %s', file_path, bucket_name, download_dest)
-            self.s3_client.download_file(bucket_name, file_path, download_dest)
-        except ClientError as e:
+            if self.formula_cache is not None:
+                downloaded = self.formula_cache.fetch(bucket_name, file_path, download_dest)
+            else:
+                self.s3_client.download_file(bucket_name, file_path, download_dest)
+                downloaded = True
+        except (ClientError, OSError) as e:
+            self._record_transfer("download", start_time)
             self.logger.error("Failed to download file from s3")
             self.logger.exception(e)
             raise S3FileSystemException(f"Failed to download file from s3 with download destination {download_dest}")
 
+        # cache hits did not transfer anything from S3
+        if downloaded:
+            self._record_transfer("download", start_time, download_dest)
+        else:
+            self._record_cache_hit(download_dest)
         return download_dest
 
+    def download_and_decompress_file(self, problem_uri: str, download_dest_folder: str):
+        """
+        Download a formula and decompress it (xz, gzip, bzip2 or zstd) in a single streaming pass.
+        Compression is detected from the magic bytes or the key suffix. The compressed original is
+        kept next to the decompressed file.
+        Returns a tuple (original path, decompressed path); both are the same for uncompressed formulas.
+        @param download_dest_folder: folder to download the problem to
+        @type problem_uri: s3 uri that is in the form of s3://bucket_name/path_to_file
+        """
+        if problem_uri is None:
+            raise S3FileSystemException('s3 uri is empty')
+
+        if self.formula_cache is not None:
+            # the compressed formula is copied from the local cache, so decompress from there
+            original_dest = self.download_file(problem_uri, download_dest_folder)
+            try:
+                with open(original_dest, "rb") as source:
+                    return original_dest, self._decompress(source, original_dest, download_dest_folder)
+            except (DecompressionException, OSError) as e:
+                self.logger.exception(e)
+                raise S3FileSystemException(f"Failed to decompress {original_dest}")
+
+        parsed_uri = urlparse(problem_uri, allow_fragments=False)
+        bucket_name = parsed_uri.netloc
+        file_path = parsed_uri.path.lstrip('/')
+        original_dest = os.path.join(download_dest_folder, ntpath.basename(file_path))
+        start_time = time.perf_counter()
+        try:
+            self.logger.debug('Streaming file %s from bucket %s to destination %s', file_path, bucket_name, original_dest)
+            body = self.s3_client.get_object(Bucket=bucket_name, Key=file_path)["Body"]
+            with open(original_dest, "wb") as tee_handle:
+                decompressed_dest = self._decompress(body, original_dest, download_dest_folder, tee_handle)
+            self._record_transfer("download", start_time, original_dest)
+            return original_dest, decompressed_dest
+        except (ClientError, DecompressionException, OSError) as e:
+            self._record_transfer("download", start_time)
+            self.logger.error("Failed to download and decompress file from s3")
+            self.logger.exception(e)
+            raise S3FileSystemException(f"Failed to download file from s3 with download destination {original_dest}")
+
+    def _decompress(self, source, original_dest: str, download_dest_folder: str, tee_handle=None):
+        """Decompress source into download_dest_folder if it is compressed, returning the path to read"""
+        header = source.read(HEADER_SIZE)
+        compression = detect_compression(original_dest, header)
+        if compression is None:
+            if tee_handle is not None:
+                tee_handle.write(header)
+                shutil.copyfileobj(source, tee_handle, MB)
+            return original_dest
+        decompressed_dest = os.path.join(download_dest_folder, decompressed_file_name(original_dest))
+        start_time = time.perf_counter()
+        with open(decompressed_dest, "wb") as out_handle:
+            compressed_bytes = decompress_stream(source, compression, out_handle, tee_handle, header)
+            decompressed_bytes = out_handle.tell()
+        self.logger.info('Decompressed %s (%s, %d bytes) to %s (%d bytes) in %.3f s', original_dest, compression,
+                         compressed_bytes, decompressed_dest, decompressed_bytes, time.perf_counter() - start_time)
+        return decompressed_dest
+
     def upload_file(self, local_file_path: str, bucket_name: str, object_name: str):
+        start_time = time.perf_counter()
         try: 
             if object_name.startswith('/'):
                 object_name = object_name[1:]
             self.logger.debug('Uploading file %s to bucket %s and file path %s', local_file_path, bucket_name, object_name)
-            self.s3_client.upload_file(local_file_path, bucket_name, object_name)
-        except ClientError as e:
-            self.logger.error("Failed to download file from s3")
+            self.s3_client.upload_file(local_file_path, bucket_name, object_name, Config=self.transfer_config)
+            self._record_transfer("upload", start_time, local_file_path)
+        except (ClientError, S3UploadFailedError) as e:
+            self._record_transfer("upload", start_time)
+            self.logger.error("Failed to upload file to s3")
             self.logger.exception(e)
             raise S3FileSystemException(f"Failed to upload file to s3 with upload destination {bucket_name}/{object_name}")
 
@@ -71,22 +198,71 @@ class S3FileSystem:
         self.upload_file(local_file_path, bucket_name, object_name)
 
 
-    def upload_directory_tree(self, local_dir_path: str, s3_uri: str): 
-        self.logger
+    def _timed_upload_file(self, local_file_path: str, bucket_name: str, object_name: str):
+        start_time = time.perf_counter()
+        self.upload_file(local_file_path, bucket_name, object_name)
+        elapsed = time.perf_counter() - start_time
+        file_bytes = os.path.getsize(local_file_path)
+        self.logger.debug('Uploaded %s (%d bytes) in %.3f s', local_file_path, file_bytes, elapsed)
+        return {
+            "file": local_file_path,
+            "bytes": file_bytes,
+            "elapsed_seconds": elapsed
+        }
+
+    def upload_directory_tree(self, local_dir_path: str, s3_uri: str):
+        """
+        Upload all files below local_dir_path to s3, several files at a time.
+        Returns per-file and total transfer statistics.
+        """
         problem_uri = urlparse(s3_uri, allow_fragments=False)
         bucket_name = problem_uri.netloc
         object_name_base = problem_uri.path
-        
-        # iterate through all files and upload them to s3
+
+        start_time = time.perf_counter()
+        futures = []
         for root, dirs, files in os.walk(local_dir_path):
             for file in files:
                 file_name = os.path.join(root, file)
                 object_name = os.path.join(object_name_base, file_name)
-                self.upload_file(file_name, bucket_name, object_name)
+                futures.append(self.file_upload_executor.submit(self._timed_upload_file, file_name, bucket_name, object_name))
+
+        uploaded_files = []
+        failures = []
+        for future in as_completed(futures):
+            try:
+                uploaded_files.append(future.result())
+            except (S3FileSystemException, OSError) as e:
+                failures.append(e)
+        elapsed = time.perf_counter() - start_time
+        total_bytes = sum(f["bytes"] for f in uploaded_files)
+        report = {
+            "files": uploaded_files,
+            "total_bytes": total_bytes,
+            "elapsed_seconds": elapsed,
+            "bytes_per_second": total_bytes / elapsed if elapsed > 0 else 0
+        }
+        self.logger.info('Uploaded %d files (%d bytes) from %s in %.3f s (%.1f MB/s)', len(uploaded_files),
+                         total_bytes, local_dir_path, elapsed, report["bytes_per_second"] / MB)
+        if failures:
+            raise S3FileSystemException(f"Failed to upload {len(failures)} of {len(futures)} files "
+                                        f"from {local_dir_path}: {failures[0]}")
+        return report
 
+    def upload_directory_tree_async(self, local_dir_path: str, s3_uri: str):
+        """Upload a directory tree in the background. Returns a Future holding the upload report."""
+        return self.directory_upload_executor.submit(self.upload_directory_tree, local_dir_path, s3_uri)
 
     @staticmethod
     def get_s3_file_system():
         import boto3
-        s3 = boto3.client('s3')
-        return S3FileSystem(s3)
+        from botocore.config import Config
+        # every concurrent file upload may open max_concurrency connections for its parts
+        s3 = boto3.client('s3', config=Config(max_pool_connections=S3FileSystem.max_upload_workers * 4))
+        formula_cache = None
+        # Size cap of the local formula cache in MB; 0 disables caching
+        cache_mb = int(os.getenv('SATCOMP_FORMULA_CACHE_MB', '0'))
+        if cache_mb > 0:
+            cache_directory = os.getenv('SATCOMP_FORMULA_CACHE_DIR', '/tmp/formula_cache')
+            formula_cache = FormulaCache(s3, cache_directory, cache_mb * MB)
+        return S3FileSystem(s3, formula_cache=formula_cache)
@@ -4,44 +4,108 @@ import boto3
 from botocore.exceptions import ClientError
 import os
 import argparse
+import fnmatch
 import sys
 import json
 import time   
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass
 
 sys.path.append('../')
-from arg_satcomp_solver_base.sqs_queue.sqs_queue import SqsQueue
+from arg_satcomp_solver_base.sqs_queue.result_router import ResultRouter, new_request_id
+from arg_satcomp_solver_base.sqs_queue.sqs_queue import REQUEST_ID_ATTRIBUTE, SqsQueue, SqsQueueException
 
 
 class SolverTimeoutException(Exception):
     pass
 
 
-class S3ProblemStore:
-    """Class to represent S3 storage location"""
+# the leader uploads task directories (logs, solver output) back to the bucket under tmp/
+DEFAULT_EXCLUDE_PREFIXES = ("tmp/",)
+
 
-    def __init__(self, s3_resource, formula_bucket, logger):
+class S3ProblemStore:
+    """Class to represent S3 storage location.
+    Problems are listed lazily, page by page, so that solving can start before the listing is complete.
+    Keys under exclude_prefixes (by default the tmp/ directory the leader uploads task results to)
+    are never listed as problems."""
+    ORDERS = ("listing", "size-asc", "size-desc")
+
+    def __init__(self, s3_resource, formula_bucket, logger, prefix = "", suffixes = None, glob_pattern = None,
+                 exclude_prefixes = DEFAULT_EXCLUDE_PREFIXES, order = "listing", manifest_file = None):
         self.s3_resource = s3_resource
         self.logger = logger
         self.formula_bucket = formula_bucket
-
-    def list_cnf_file_s3_path_pairs(self):
+        self.prefix = prefix or ""
+        self.suffixes = tuple(suffixes) if suffixes else None
+        self.glob_pattern = glob_pattern
+        self.exclude_prefixes = tuple(exclude_prefixes or ())
+        if order not in self.ORDERS:
+            raise ValueError(f"Unknown problem order {order}; expected one of {self.ORDERS}")
+        self.order = order
+        self.manifest_file = manifest_file
+
+    def _is_problem(self, key):
+        if not key.startswith(self.prefix) or key.endswith("/"):
+            return False
+        if self.exclude_prefixes and key.startswith(self.exclude_prefixes):
+            return False
+        if self.suffixes and not key.endswith(self.suffixes):
+            return False
+        if self.glob_pattern and not fnmatch.fnmatchcase(key, self.glob_pattern):
+            return False
+        return True
+
+    def _list_bucket(self):
+        """Yield (key, size) for every object under the prefix, one listing page at a time"""
         try:
             self.logger.debug(f'Attempting to list files for bucket {self.formula_bucket}')
             bkt = self.s3_resource.Bucket(self.formula_bucket)
-            pairs = [(bkt_object.key, f's3://{self.formula_bucket}/{bkt_object.key}') for bkt_object in bkt.objects.all()]
-            return pairs
+            for bkt_object in bkt.objects.filter(Prefix=self.prefix).page_size(1000):
+                yield bkt_object.key, bkt_object.size
         except ClientError as e:
             self.logger.error(f"Failed to list s3 bucket objects from {self.formula_bucket}")
             self.logger.exception(e)
             raise
 
+    def _read_manifest(self):
+        """Yield (key, size) for every problem in the manifest: one key or s3:// URI per line, optionally
+        followed by whitespace and the size in bytes; blank lines and lines starting with # are ignored"""
+        bucket_prefix = f's3://{self.formula_bucket}/'
+        with open(self.manifest_file, "r") as manifest:
+            for line in manifest:
+                fields = line.split()
+                if not fields or fields[0].startswith("#"):
+                    continue
+                key = fields[0]
+                if key.startswith("s3://"):
+                    if not key.startswith(bucket_prefix):
+                        self.logger.warning(f"Skipping manifest entry {key} outside of bucket {self.formula_bucket}")
+                        continue
+                    key = key[len(bucket_prefix):]
+                yield key, int(fields[1]) if len(fields) > 1 else 0
+
+    def iter_problems(self):
+        """Yield (key, s3 uri, size) for every problem, lazily unless the problems are ordered by size"""
+        objects = self._read_manifest() if self.manifest_file else self._list_bucket()
+        problems = ((key, size) for key, size in objects if self._is_problem(key))
+        if self.order != "listing":
+            # ordering needs the complete listing before the first problem can be handed out
+            problems = sorted(problems, key=lambda problem: problem[1], reverse=self.order == "size-desc")
+        for key, size in problems:
+            yield key, f's3://{self.formula_bucket}/{key}', size
+
+    def list_cnf_file_s3_path_pairs(self):
+        for key, s3_uri, _ in self.iter_problems():
+            yield key, s3_uri
+
     def get_bucket(self):
         return self.formula_bucket
 
     @staticmethod
-    def get_s3_file_system(session, formula_bucket, logger):
+    def get_s3_file_system(session, formula_bucket, logger, **listing_options):
         s3 = session.resource('s3')
-        return S3ProblemStore(s3, formula_bucket, logger)
+        return S3ProblemStore(s3, formula_bucket, logger, **listing_options)
 
 
 
@@ -50,74 +114,299 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 # maximum retries on non-success (other than timeout)
 RETRIES_MAX = 2
 TIMEOUT = 1030
+# time allowed on top of the solver timeout, counted from the moment a leader starts solving a problem,
+# for its result to come back before the problem is given up
+RESPONSE_SLACK_SECONDS = 30
+# how often the deadlines of in-flight problems are checked while waiting for results
+DEADLINE_CHECK_SECONDS = 5
+
+
+@dataclass
+class InFlightProblem:
+    """A problem that has been sent to the solver and whose result has not come back yet"""
+    input_file: str
+    s3_uri: str
+    request_id: str
+    attempts: int
+    result: Future
+    # time.monotonic() at which the problem was put on the queue
+    submitted_at: float
+
+
+class ResultsJournal:
+    """Append-only JSON Lines store of problem results.
+    Each result is appended as one {"key": ..., "result": ...} line and fsync'ed, so recording a result
+    costs O(1) and a crash can at most lose the line being written. An in-memory index maps each key to
+    the offset of its latest line; only the keys are parsed when an existing journal is reopened.
+    export() writes the results in the format of the results JSON file."""
+    KEY_PREFIX = '{"key": '
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+        self.index = {}
+        self.handle = None
+
+    def open(self, clean = False):
+        mode = "w+b" if clean or not os.path.exists(self.path) else "r+b"
+        self.handle = open(self.path, mode)
+        self._load_index()
+        return self
+
+    def _load_index(self):
+        decoder = json.JSONDecoder()
+        offset = 0
+        self.handle.seek(0)
+        for line in self.handle:
+            if not line.endswith(b"\n"):
+                # a line cut short by a crash; it is overwritten by the next append
+                self.logger.warning(f"Dropping incomplete last entry of results journal {self.path}")
+                break
+            try:
+                key, _ = decoder.raw_decode(line[len(self.KEY_PREFIX):].decode("UTF-8"))
+            except ValueError:
+                self.logger.warning(f"Skipping unreadable entry at offset {offset} of results journal {self.path}")
+            else:
+                self.index[key] = offset
+            offset += len(line)
+        self.handle.seek(offset)
+        self.handle.truncate()
+
+    def import_results(self, results: dict):
+        """Add the entries of an existing results JSON file"""
+        for key, result_json in results.items():
+            self.append(key, result_json, sync = False)
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, key):
+        offset = self.index.get(key)
+        if offset is None:
+            return None
+        with open(self.path, "rb") as reader:
+            reader.seek(offset)
+            return json.loads(reader.readline())["result"]
+
+    def append(self, key, result_json, sync = True):
+        line = (self.KEY_PREFIX + json.dumps(key) + ', "result": ' + json.dumps(result_json) + "}\n").encode("UTF-8")
+        offset = self.handle.tell()
+        self.handle.write(line)
+        if sync:
+            self.handle.flush()
+            os.fsync(self.handle.fileno())
+        self.index[key] = offset
+
+    def export(self, json_file):
+        """Write all results (latest entry per key) as one JSON object; the file is replaced atomically"""
+        results = {}
+        with open(self.path, "rb") as reader:
+            for line in reader:
+                if line.endswith(b"\n"):
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    results[entry["key"]] = entry["result"]
+        export_file = json_file + ".tmp"
+        with open(export_file, "w") as result_file:
+            json.dump(results, result_file, indent=4)
+        os.replace(export_file, json_file)
+        self.logger.info(f"Exported {len(results)} results to {json_file}")
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
 
 
 class ProblemRunner: 
-    """Class to run a problem set through a distributed solver"""
-    def __init__(self, problem_queue, result_queue, s3_problem_store, args, logger):
+    """Class to run a problem set through a distributed solver.
+    Up to max_in_flight problems are outstanding at any time; every submission gets a request id that the
+    leader echoes in its result, and a ResultRouter hands each result to its problem in whatever order they arrive."""
+    def __init__(self, problem_queue, result_queue, s3_problem_store, args, logger, result_router: ResultRouter = None):
         self.num_workers = args.num_workers
         self.clean_first = args.clean_first
         self.json_file = args.json_file
+        self.journal = ResultsJournal(args.journal_file or args.json_file + ".jsonl", logger)
+        self.max_in_flight = max(1, args.max_in_flight)
+        self.task_timeout = args.task_timeout
+        # by default a problem may wait for every problem ahead of it in the window to be solved one after the other
+        self.queue_timeout = args.queue_timeout or self.max_in_flight * (self.task_timeout + RESPONSE_SLACK_SECONDS)
+        self.formula_language = args.format
         self.s3_problem_store = s3_problem_store
         self.problem_queue = problem_queue
         self.result_queue = result_queue
+        self.result_router = result_router or ResultRouter(result_queue)
         self.logger = logger
-
-
-    def run_one_problem(self, s3_uri): 
-        msg = {"s3_uri": s3_uri, "num_workers": self.num_workers}
-        msg_str = json.dumps(msg, indent = 4)           
-
-        done = False
-        retries = 0
-        while not done: 
-            self.problem_queue.put_message(msg_str)
-            start_time = time.perf_counter()
-            result = self.result_queue.get_message()
-
-            while result is None:
-                self.logger.info(f"Awaiting completion for file: {s3_uri}")
-                end_time = time.perf_counter()
-                if end_time - start_time > TIMEOUT:
-                    raise SolverTimeoutException(f"Client exceeded max time waiting for response ({str(TIMEOUT)}).  Did leader crash?")
-                result = self.result_queue.get_message()
-
-            result_json = json.loads(result.read())
-            result.delete()
-            print(f"Problem {s3_uri} completed!  result is: {json.dumps(result_json, indent=4)}")
-
-            if result_json["driver"]["timed_out"]:
-                done = True
+        self.in_flight = {}
+        self.unanswered = []
+
+    def _problem_message(self, s3_uri, request_id):
+        return json.dumps({
+            "formula": {
+                "value": s3_uri,
+                "language": self.formula_language
+            },
+            "solverConfig": {
+                "solverName": "",
+                "solverOptions": [],
+                "taskTimeoutSeconds": self.task_timeout
+            },
+            "num_workers": self.num_workers,
+            "requestId": request_id
+        }, indent = 4)
+
+    def _submit(self, input_file, s3_uri, attempts = 0):
+        request_id = new_request_id()
+        self.logger.info(f'attempting to solve file: {s3_uri} (request {request_id})')
+        result = self.result_router.expect(request_id)
+        self.problem_queue.put_message(self._problem_message(s3_uri, request_id), {REQUEST_ID_ATTRIBUTE: request_id})
+        self.in_flight[request_id] = InFlightProblem(input_file, s3_uri, request_id, attempts, result, time.monotonic())
+
+    def _submit_batch(self, problems):
+        """
+        Submit new (input_file, s3_uri) problems with as few SendMessageBatch calls as possible.
+        Returns the problems that were not put on the queue, to be submitted again; raises SqsQueueException
+        if none of them were.
+        """
+        submissions = []
+        for input_file, s3_uri in problems:
+            request_id = new_request_id()
+            self.logger.info(f'attempting to solve file: {s3_uri} (request {request_id})')
+            submissions.append((input_file, s3_uri, request_id, self.result_router.expect(request_id)))
+        failed = set(self.problem_queue.put_messages(
+            [(self._problem_message(s3_uri, request_id), {REQUEST_ID_ATTRIBUTE: request_id})
+             for (_, s3_uri, request_id, _) in submissions]))
+        submitted_at = time.monotonic()
+        rejected = []
+        for index, (input_file, s3_uri, request_id, result) in enumerate(submissions):
+            if index in failed:
+                self.result_router.abandon(request_id)
+                rejected.append((input_file, s3_uri))
+                continue
+            self.in_flight[request_id] = InFlightProblem(input_file, s3_uri, request_id, 0, result, submitted_at)
+        if rejected and len(rejected) == len(submissions):
+            raise SqsQueueException(f"Failed to put any of {len(submissions)} problems on the problem queue")
+        if rejected:
+            self.logger.warning(f"{len(rejected)} of {len(submissions)} problems were not put on the problem queue; "
+                                f"submitting them again")
+        return rejected
+
+    def _deadline(self, problem):
+        """
+        Time by which the result of problem must arrive: the solver timeout after a leader started it, or
+        queue_timeout after its submission while no leader has reported starting it (a leader may also drop
+        a problem before starting it)
+        """
+        started_at = self.result_router.started_at(problem.request_id)
+        if started_at is None:
+            return problem.submitted_at + self.queue_timeout
+        return started_at + self.task_timeout + RESPONSE_SLACK_SECONDS
+
+    def _is_done(self, problem, result_json):
+        """A problem is done once it is solved, timed out, or has used up its retries"""
+        if result_json["driver"].get("timed_out"):
+            return True
+        output = result_json["solver"].get("output") or {}
+        result = str(output.get("result", "")).lower()
+        return result == "unsatisfiable" or result == "satisfiable" or problem.attempts + 1 >= RETRIES_MAX
+
+    def _receive_results(self):
+        """Wait a little while for results and return the (problem, result) pairs that came back"""
+        wait([problem.result for problem in self.in_flight.values()], timeout = DEADLINE_CHECK_SECONDS,
+             return_when = FIRST_COMPLETED)
+        completed = []
+        for problem in [problem for problem in self.in_flight.values() if problem.result.done()]:
+            del self.in_flight[problem.request_id]
+            result_json = problem.result.result()
+            print(f"Problem {problem.s3_uri} completed!  result is: {json.dumps(result_json, indent=4)}")
+            completed.append((problem, result_json))
+        return completed
+
+    def _expire_problems(self):
+        """Give up on problems whose result did not arrive by their deadline; the run continues with the others"""
+        now = time.monotonic()
+        expired = [problem for problem in self.in_flight.values() if self._deadline(problem) < now]
+        for problem in expired:
+            del self.in_flight[problem.request_id]
+            started = self.result_router.started_at(problem.request_id) is not None
+            self.result_router.abandon(problem.request_id)
+            if problem.attempts + 1 < RETRIES_MAX:
+                if started:
+                    self.logger.error(f"No result for {problem.s3_uri} within {self.task_timeout + RESPONSE_SLACK_SECONDS} "
+                                      f"seconds of its start.  Did leader crash?  Resubmitting")
+                else:
+                    self.logger.error(f"No leader started {problem.s3_uri} within {self.queue_timeout} seconds of its "
+                                      f"submission.  Did leader drop it?  Resubmitting")
+                self._submit(problem.input_file, problem.s3_uri, problem.attempts + 1)
             else:
-                result = (result_json["solver"]["output"]["result"]).lower()
-                retries = retries + 1
-                
-                if result == "unsatisfiable" or result == "satisfiable" or retries >= RETRIES_MAX:
-                    done = True
-        
-        return result_json
+                self.logger.error(f"No result for {problem.s3_uri} after {problem.attempts + 1} attempts.  Giving up")
+                self.unanswered.append(problem.s3_uri)
+
+    def _open_journal(self):
+        fresh = self.clean_first or not os.path.exists(self.journal.path)
+        self.journal.open(clean = self.clean_first)
+        if fresh and os.path.exists(self.json_file) and not self.clean_first:
+            # carry over the results of a run made before the journal existed
+            self.logger.info(f"Importing results from {self.json_file} into {self.journal.path}")
+            with open(self.json_file, "r") as result_file:
+                self.journal.import_results(json.load(result_file))
 
     def run_problems(self):
-        results = {}
-        if os.path.exists(self.json_file) and not self.clean_first:     
-            with open(self.json_file, "r") as result_file:
-                results = json.load(result_file)
+        self._open_journal()
+        try:
+            self._run_pending_problems()
+        finally:
+            self.journal.export(self.json_file)
+            self.journal.close()
 
+    def _unsolved_problems(self):
         for (input_file, s3_uri) in self.s3_problem_store.list_cnf_file_s3_path_pairs():
-            self.logger.info(f'attempting to solve file: {s3_uri}')
-
             # skip previously solved files (unless 'clean' flag is true)
-            if input_file in results:
-                print(f"Problem {s3_uri} is cached from earlier run.  Result is: {json.dumps(results[input_file], indent=4)}")
+            if input_file in self.journal:
+                print(f"Problem {s3_uri} is cached from earlier run.  Result is: {json.dumps(self.journal.get(input_file), indent=4)}")
                 continue
+            yield input_file, s3_uri
+
+    def _run_pending_problems(self):
+        # problems are pulled from the listing only when there is room in the in-flight window
+        pending = self._unsolved_problems()
+        listing_done = False
+        # problems the problem queue did not accept, which are submitted again before new ones
+        rejected = []
+
+        if not self.result_router.is_alive():
+            self.result_router.start()
+        while not listing_done or self.in_flight or rejected:
+            batch, rejected = rejected, []
+            while not listing_done and len(self.in_flight) + len(batch) < self.max_in_flight:
+                problem = next(pending, None)
+                if problem is None:
+                    listing_done = True
+                    break
+                batch.append(problem)
+            if batch:
+                rejected = self._submit_batch(batch)
+            if not self.in_flight:
+                continue
+            self.logger.info(f"Awaiting completion for {len(self.in_flight)} problems")
 
-            result_json = self.run_one_problem(s3_uri)
-
-            # write answer (overwrite existing file)
-            results[input_file] = result_json
+            for problem, result_json in self._receive_results():
+                if not self._is_done(problem, result_json):
+                    self._submit(problem.input_file, problem.s3_uri, problem.attempts + 1)
+                    continue
+                self.journal.append(problem.input_file, result_json)
+            self._expire_problems()
+        self.result_router.stop()
 
-            with open(self.json_file, "w") as result_file:
-                json.dump(results, result_file, indent=4)
+        if self.unanswered:
+            raise SolverTimeoutException(f"Client exceeded max time waiting for response for {self.unanswered}.  Did leader crash?")
 
 def init_argparse() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
@@ -132,9 +421,21 @@ def init_argparse() -> argparse.ArgumentParser:
     parser.add_argument('--result-queue', required=True, type=str, help='Name of the result SQS queue (receives outputs from solver) ')
     parser.add_argument('--s3-bucket', required=True, type=str, help='Name of the s3 bucket')
     parser.add_argument('--num-workers', required=True, type=int, help='Number of workers in the cluster')
+    parser.add_argument('--task-timeout', type=int, default=TIMEOUT - RESPONSE_SLACK_SECONDS, help=f'Solver timeout per problem in seconds (default: {TIMEOUT - RESPONSE_SLACK_SECONDS})')
+    parser.add_argument('--format', type=str, default="", help='Problem format passed to the solver (default: empty string)')
+    parser.add_argument('--max-in-flight', type=int, default=1, help='Number of problems submitted to the solver at the same time (default: 1)')
+    parser.add_argument('--queue-timeout', type=int, help='Seconds a problem may wait for a leader to start solving it before it is resubmitted (default: max-in-flight * (task-timeout + 30))')
     parser.add_argument('--verbose', type=int, help='Set the verbosity level of output: 0 = ERROR, 1 = INFO, 2 = DEBUG (default: 0)')
     parser.add_argument('--clean-first', type=bool, help='Clean the output file prior to run (default: False)')
     parser.add_argument('--purge-queues', type=bool, help='Purge queues and wait one minute prior to start?')
+    parser.add_argument('--prefix', type=str, default="", help='Only solve problems whose key starts with this prefix')
+    parser.add_argument('--suffix', type=str, action='append', help='Only solve problems whose key ends with this suffix (repeatable, e.g. --suffix .cnf --suffix .cnf.xz)')
+    parser.add_argument('--glob', type=str, help='Only solve problems whose key matches this glob pattern')
+    parser.add_argument('--exclude-prefix', type=str, action='append', help='Never solve keys starting with this prefix (repeatable; default: tmp/, where results are uploaded; --exclude-prefix "" disables it)')
+    parser.add_argument('--order', choices=S3ProblemStore.ORDERS, default="listing", help='Order in which problems are submitted (default: listing order; size orders list the whole bucket first)')
+    parser.add_argument('--manifest', type=str, help='Local file listing the problem keys or s3:// URIs to solve, instead of listing the bucket')
+    parser.add_argument('--journal-file', type=str, help='Path of the append-only results journal (default: <json_file>.jsonl)')
+    parser.add_argument('--export-only', action='store_true', help='Only write the results journal out to the json file, without running problems')
     parser.add_argument('json_file', help='Path to json file containing results')
     return parser
 
@@ -153,6 +454,12 @@ def main():
             logger.setLevel(logging.ERROR)
 
         logger.debug('command line arguments: ' + str(args))
+
+        if args.export_only:
+            journal = ResultsJournal(args.journal_file or args.json_file + ".jsonl", logger).open()
+            journal.export(args.json_file)
+            journal.close()
+            return
         
         session = boto3.Session(profile_name=args.profile)
         s3 = session.resource('s3')
@@ -160,7 +467,12 @@ def main():
         # create AWS access objects
         problem_queue = SqsQueue.get_sqs_queue_from_session(session, args.problem_queue)
         result_queue = SqsQueue.get_sqs_queue_from_session(session, args.result_queue)
-        s3_problem_store = S3ProblemStore.get_s3_file_system(session, args.s3_bucket, logger)
+        s3_problem_store = S3ProblemStore.get_s3_file_system(session, args.s3_bucket, logger, prefix=args.prefix,
+                                                             suffixes=args.suffix, glob_pattern=args.glob,
+                                                             exclude_prefixes=DEFAULT_EXCLUDE_PREFIXES if args.exclude_prefix is None
+                                                             else [prefix for prefix in args.exclude_prefix if prefix],
+                                                             order=args.order,
+                                                             manifest_file=args.manifest)
         problem_runner = ProblemRunner(problem_queue, result_queue, s3_problem_store, args, logger)
         
         if args.purge_queues:
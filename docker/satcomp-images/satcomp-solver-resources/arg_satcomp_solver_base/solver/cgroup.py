@@ -0,0 +1,181 @@
+"""
+cgroup v2 isolation of solver runs.
+Every solve gets its own cgroup below the container's cgroup root, with memory.max and cpu.max
+set from the task's resource request, so that a runaway solver is killed on its own instead of
+taking the whole leader container (and its pollers) down.
+"""
+import logging
+import os
+import signal
+import time
+from dataclasses import dataclass
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+CPU_PERIOD_MICROS = 100000
+# leaf cgroup the base container processes are moved to, since cgroup v2 does not allow
+# a cgroup that has processes of its own to delegate controllers to child cgroups
+SUPERVISOR_CGROUP = "satcomp-supervisor"
+
+
+class CgroupException(Exception):
+    """Exception for cgroup setup and limit errors"""
+
+
+@dataclass
+class CgroupLimits:
+    """Limits applied to a solver cgroup; 0 means unlimited"""
+    memory_max_bytes: int = 0
+    cpu_cores: float = 0
+
+
+class TaskCgroup:
+    """cgroup holding the process group of a single solver run"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.logger = logging.getLogger("TaskCgroup")
+        self.logger.setLevel(logging.DEBUG)
+
+    def _write(self, file_name: str, value: str):
+        try:
+            with open(os.path.join(self.path, file_name), "w") as control_file:
+                control_file.write(value)
+        except OSError as e:
+            raise CgroupException(f"Failed to write {value} to {file_name} of cgroup {self.path}: {e}")
+
+    def _read_key_values(self, file_name: str):
+        values = {}
+        try:
+            with open(os.path.join(self.path, file_name)) as control_file:
+                for line in control_file:
+                    key, value = line.split()
+                    values[key] = int(value)
+        except OSError:
+            pass
+        return values
+
+    def apply_limits(self, limits: CgroupLimits):
+        if limits.memory_max_bytes > 0:
+            self._write("memory.max", str(limits.memory_max_bytes))
+            # without this the limit only pushes the solver into swap
+            if os.path.exists(os.path.join(self.path, "memory.swap.max")):
+                self._write("memory.swap.max", "0")
+        if limits.cpu_cores > 0:
+            self._write("cpu.max", f"{int(limits.cpu_cores * CPU_PERIOD_MICROS)} {CPU_PERIOD_MICROS}")
+
+    def wrap_command(self, cmd: list):
+        """
+        Command that moves itself into this cgroup before exec'ing cmd, so that every process
+        the solver starts is accounted to the cgroup from the start
+        """
+        return ["/bin/sh", "-c", 'echo $$ > "$0/cgroup.procs" && exec "$@"', self.path] + cmd
+
+    def memory_limit_exceeded(self):
+        """True if a process of the cgroup was killed by the OOM killer for hitting memory.max"""
+        return self._read_key_values("memory.events").get("oom_kill", 0) > 0
+
+    def stats(self):
+        stats = {}
+        cpu_stat = self._read_key_values("cpu.stat")
+        if "usage_usec" in cpu_stat:
+            stats["cpu_usage_seconds"] = cpu_stat["usage_usec"] / 1000000
+        if "nr_throttled" in cpu_stat:
+            stats["cpu_throttled_periods"] = cpu_stat["nr_throttled"]
+        try:
+            # memory.peak only exists on kernels >= 5.19
+            with open(os.path.join(self.path, "memory.peak")) as memory_peak:
+                stats["memory_peak_bytes"] = int(memory_peak.read())
+        except (OSError, ValueError):
+            pass
+        stats["oom_kills"] = self._read_key_values("memory.events").get("oom_kill", 0)
+        return stats
+
+    def _pids(self):
+        try:
+            with open(os.path.join(self.path, "cgroup.procs")) as procs:
+                return [int(pid) for pid in procs.read().split()]
+        except OSError:
+            return []
+
+    def kill(self):
+        """Kill every process left in the cgroup, including descendants that left the solver's process group"""
+        if os.path.exists(os.path.join(self.path, "cgroup.kill")):
+            self._write("cgroup.kill", "1")
+            return
+        for pid in self._pids():
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def destroy(self, timeout: float = 10):
+        self.kill()
+        deadline = time.monotonic() + timeout
+        while self._pids() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        try:
+            os.rmdir(self.path)
+        except OSError as e:
+            self.logger.error(f"Failed to remove cgroup {self.path}: {e}")
+
+
+class CgroupManager:
+    """Creates per-task cgroups below the container's cgroup root"""
+
+    def __init__(self, root: str = CGROUP_ROOT, default_memory_mb: int = 0):
+        self.root = root
+        self.default_memory_mb = default_memory_mb
+        self.logger = logging.getLogger("CgroupManager")
+        self.logger.setLevel(logging.DEBUG)
+
+    def setup(self):
+        """Enable the memory and cpu controllers for child cgroups of the root"""
+        try:
+            with open(os.path.join(self.root, "cgroup.controllers")) as controllers_file:
+                controllers = controllers_file.read().split()
+        except OSError:
+            raise CgroupException(f"{self.root} is not a cgroup v2 hierarchy")
+        missing = {"memory", "cpu"} - set(controllers)
+        if missing:
+            raise CgroupException(f"cgroup controllers {missing} are not available in {self.root}")
+        supervisor_path = os.path.join(self.root, SUPERVISOR_CGROUP)
+        try:
+            os.makedirs(supervisor_path, exist_ok=True)
+            with open(os.path.join(self.root, "cgroup.procs")) as procs:
+                pids = procs.read().split()
+            for pid in pids:
+                try:
+                    with open(os.path.join(supervisor_path, "cgroup.procs"), "w") as supervisor_procs:
+                        supervisor_procs.write(pid)
+                except ProcessLookupError:
+                    pass
+            with open(os.path.join(self.root, "cgroup.subtree_control"), "w") as subtree_control:
+                subtree_control.write("+memory +cpu")
+        except OSError as e:
+            raise CgroupException(f"Failed to delegate cgroup controllers in {self.root}: {e}")
+        self.logger.info(f"Solver runs are isolated in cgroups below {self.root}")
+
+    def limits_for(self, cores: int = 0, memory_mb: int = 0):
+        """Limits of a task; tasks that do not request memory get the configured default"""
+        memory_mb = memory_mb or self.default_memory_mb
+        return CgroupLimits(memory_mb * 1024 * 1024, cores)
+
+    def create(self, name: str, limits: CgroupLimits):
+        path = os.path.join(self.root, f"satcomp-task-{name}")
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            raise CgroupException(f"Failed to create cgroup {path}: {e}")
+        task_cgroup = TaskCgroup(path)
+        try:
+            task_cgroup.apply_limits(limits)
+        except CgroupException:
+            task_cgroup.destroy()
+            raise
+        self.logger.info(f"Created cgroup {path} with {limits}")
+        return task_cgroup
+
+    @staticmethod
+    def get_cgroup_manager():
+        """Cgroup manager for this container; SATCOMP_SOLVER_MEMORY_MB is the memory limit of tasks that do not request one"""
+        return CgroupManager(CGROUP_ROOT, int(os.getenv("SATCOMP_SOLVER_MEMORY_MB", "0")))
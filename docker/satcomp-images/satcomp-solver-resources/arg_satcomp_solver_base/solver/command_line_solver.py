@@ -6,12 +6,19 @@ import logging
 import os
 from json import JSONDecodeError
 
+from arg_satcomp_solver_base.resources.core_allocator import CoreAllocator
+from arg_satcomp_solver_base.resources.resource_pool import TaskResources
+from arg_satcomp_solver_base.solver.cgroup import CgroupException, CgroupManager
+from arg_satcomp_solver_base.solver.persistent_solver import PersistentSolverException, SolverServerPool
 from arg_satcomp_solver_base.solver.solver import Solver
 from arg_satcomp_solver_base.solver.run_command import CommandRunner
+from arg_satcomp_solver_base.solver.log_storage import LogStoragePolicy
 
 from arg_satcomp_solver_base.utils import FileOperations
 
 FAILED_TO_WRITE_PROBLEM_TEXT = "Failed to write problem text to file"
+# Solvers may keep their best result so far in this file; it is reported if they never write solver_out.json
+PARTIAL_RESULT_FILE = "solver_partial_out.json"
 
 
 class SolverException(Exception):
@@ -27,20 +34,57 @@ class CommandLineSolver(Solver):
 
     DEFAULT_TIMEOUT_SECONDS: int = 3600
 
-    def __init__(self, solver_command: str):
+    def __init__(self, solver_command: str, capture_mode: str = "lines", mirror_lines_per_second: float = 10,
+                 log_storage: LogStoragePolicy = None, cgroup_manager: CgroupManager = None,
+                 core_allocator: CoreAllocator = None, timeout_escalation: tuple = None, solver_server_command: str = None):
         self.solver_command = solver_command
-        self.command_runner = CommandRunner(self.stdout_target_loc, self.stderr_target_loc)
+        self.cgroup_manager = cgroup_manager
+        self.core_allocator = core_allocator
+        self.command_runner = CommandRunner(self.stdout_target_loc, self.stderr_target_loc,
+                                            capture_mode, mirror_lines_per_second, log_storage, timeout_escalation)
         self.file_operations = FileOperations()
         self.logger = logging.getLogger("CommandLineSolver")
         self.logger.setLevel(logging.DEBUG)
-
-    def _save_input_json(self, formula_file: str, directory_path: str, workers: list, formula_language: str, solver_argument_list: list, timeout_seconds: str):
+        self.solver_server_pool = None
+        if solver_server_command:
+            if cgroup_manager is not None:
+                # a long-lived server cannot be moved into the cgroup of every task
+                self.logger.warning("Cgroup isolation is enabled, running the solver script per task instead of "
+                                    f"the solver server {solver_server_command}")
+            elif core_allocator is not None:
+                # nor be pinned to the CPUs placed for every task
+                self.logger.warning("CPU pinning is enabled, running the solver script per task instead of "
+                                    f"the solver server {solver_server_command}")
+            else:
+                self.solver_server_pool = SolverServerPool.get_solver_server_pool(solver_server_command,
+                                                                                  self.command_runner)
+
+    def warm(self, count: int):
+        """Start count solver servers ahead of the first tasks, if the solver provides a solver server"""
+        if self.solver_server_pool is not None:
+            self.solver_server_pool.warm(count)
+
+    def _run_solver(self, request_directory_path: str, timeout: int, task_uuid: str, resources: TaskResources,
+                    cpus: list):
+        """Solve on a warm solver server if there is one, otherwise run the solver script"""
+        if self.solver_server_pool is not None and self.solver_server_pool.supported:
+            try:
+                return self.solver_server_pool.run(task_uuid, request_directory_path, timeout)
+            except PersistentSolverException:
+                pass
+        return self._run_command(self.solver_command, [request_directory_path],
+                                 request_directory_path, timeout, task_uuid, resources, cpus)
+
+    def _save_input_json(self, formula_file: str, directory_path: str, workers: list, formula_language: str, solver_argument_list: list, timeout_seconds: str,
+                         original_formula_file: str = None, cpus: list = None):
         input_json = {
             "formula_file": formula_file,
+            "original_formula_file": original_formula_file or formula_file,
             "worker_node_ips": list(map(lambda w: w["nodeIp"], workers)),
             "formula_language": formula_language, 
             "solver_argument_list": solver_argument_list,
             "timeout_seconds": timeout_seconds,
+            "cpus": cpus,
         }
         try:
             self.file_operations.write_json_file(os.path.join(directory_path, "input.json"), input_json)
@@ -48,21 +92,52 @@ class CommandLineSolver(Solver):
             self.logger.exception(e)
             raise SolverException(FAILED_TO_WRITE_PROBLEM_TEXT)
 
-    def _run_command(self, cmd: str, arguments: list, output_directory: str, timeout: int):
-        """Run a command as a subprocess and save logs"""
+    def _run_command(self, cmd: str, arguments: list, output_directory: str, timeout: int, task_uuid: str = None,
+                     resources: TaskResources = None, cpus: list = None):
+        """Run a command as a subprocess and save logs, in its own cgroup if isolation is enabled"""
         cmd_list = [cmd]
         if arguments is not None:
             cmd_list.extend(arguments)
-        process_result = self.command_runner.run(cmd_list, output_directory, timeout)
+        task_cgroup = self._create_cgroup(task_uuid, resources)
+        try:
+            process_result = self.command_runner.run(cmd_list, output_directory, timeout, task_cgroup, cpus)
+        finally:
+            if task_cgroup is not None:
+                task_cgroup.destroy()
         return process_result
 
-    def _get_solver_result(self, request_directory_path):
+    def _allocate_cpus(self, task_uuid: str, resources: TaskResources):
+        if self.core_allocator is None:
+            return None
+        resources = resources or TaskResources()
+        # a task that did not reserve cores runs alone on the node, so it is placed on all of it
+        whole_node = resources.exclusive or not resources.cores_reserved
+        count = self.core_allocator.total_cpus if whole_node else resources.cores
+        cpus = self.core_allocator.allocate(task_uuid, count)
+        if cpus is None:
+            self.logger.warning(f"Could not place task {task_uuid} on {count} free CPUs, running it unpinned")
+        return cpus
+
+    def _create_cgroup(self, task_uuid: str, resources: TaskResources):
+        if self.cgroup_manager is None or task_uuid is None:
+            return None
+        resources = resources or TaskResources()
+        # exclusive tasks and tasks that did not reserve cores have the whole node, so only their memory is limited
+        cores = resources.cores if resources.cores_reserved and not resources.exclusive else 0
+        try:
+            return self.cgroup_manager.create(task_uuid, self.cgroup_manager.limits_for(cores, resources.memory_mb))
+        except CgroupException as e:
+            self.logger.error("Failed to create cgroup, running solver without isolation")
+            self.logger.exception(e)
+            return None
+
+    def _get_solver_result(self, request_directory_path, result_file: str = "solver_out.json"):
         try:
-            raw_solver_result = self.file_operations.read_json_file(os.path.join(request_directory_path, "solver_out.json"))
+            raw_solver_result = self.file_operations.read_json_file(os.path.join(request_directory_path, result_file))
         except FileNotFoundError:
-            self.logger.error("Solver did not generate output JSON")
+            self.logger.error(f"Solver did not generate output JSON {result_file}")
         except JSONDecodeError as e:
-            self.logger.error("Solver output not valid json")
+            self.logger.error(f"Solver output {result_file} not valid json")
             self.logger.exception(e)
         else:
             return raw_solver_result
@@ -70,25 +145,48 @@ class CommandLineSolver(Solver):
         # since it is user provided and may not work
         return None
 
-    def solve(self, formula_file: str, request_directory_path: str, workers: list, task_uuid: str, timeout: int, formula_language: str, solver_argument_list: list):
+    def solve(self, formula_file: str, request_directory_path: str, workers: list, task_uuid: str, timeout: int, formula_language: str, solver_argument_list: list,
+              original_formula_file: str = None, resources: TaskResources = None):
         """Solve implementation that shells out to a subprocess"""
-   
-        self._save_input_json(formula_file, request_directory_path, workers, formula_language, solver_argument_list, timeout)
-
-        if not timeout:
-            timeout = CommandLineSolver.DEFAULT_TIMEOUT_SECONDS
+        cpus = self._allocate_cpus(task_uuid, resources)
         try:
-            process_result = self._run_command(self.solver_command, [request_directory_path],
-                                               request_directory_path, timeout)
-        except FileNotFoundError:
-            self.logger.error(f"Failed to execute solver script at path: {self.solver_command}. "
-                              f"Solver executable does not exist")
-            raise SolverException(f"Failed to execute solver script at path: {self.solver_command}. "
+            self._save_input_json(formula_file, request_directory_path, workers, formula_language, solver_argument_list, timeout,
+                                  original_formula_file, cpus)
+
+            if not timeout:
+                timeout = CommandLineSolver.DEFAULT_TIMEOUT_SECONDS
+            try:
+                process_result = self._run_solver(request_directory_path, timeout, task_uuid, resources, cpus)
+            except FileNotFoundError:
+                self.logger.error(f"Failed to execute solver script at path: {self.solver_command}. "
                                   f"Solver executable does not exist")
-
-        solver_result = self._get_solver_result(request_directory_path)
+                raise SolverException(f"Failed to execute solver script at path: {self.solver_command}. "
+                                      f"Solver executable does not exist")
+        finally:
+            if cpus is not None:
+                self.core_allocator.release(task_uuid)
+
+        # a solver server may send its result along with its response
+        solver_result = process_result.get("result") or self._get_solver_result(request_directory_path)
+        partial_result = False
+        if solver_result is None and process_result.get("timed_out"):
+            self.logger.info("Harvesting partial solver result")
+            solver_result = self._get_solver_result(request_directory_path, PARTIAL_RESULT_FILE)
+            partial_result = solver_result is not None
         self.logger.info(solver_result)
-        if solver_result is None:
+        if process_result.get("memory_limit_exceeded"):
+            self.logger.error("Solver was killed for exceeding its memory limit")
+            task_state = {
+                "status": "MEMORY_LIMIT_EXCEEDED",
+                "message": "Solver was killed for exceeding its memory limit"
+            }
+        elif process_result.get("timed_out"):
+            task_state = {
+                "status": "TIMED_OUT",
+                "message": f"Solver exceeded its timeout of {timeout} seconds and was stopped with "
+                           f"{process_result.get('termination_signal')}"
+            }
+        elif solver_result is None:
             task_state = {
                 "status": "FAILED",
                 "message": "Error retrieving solver result"
@@ -97,9 +195,9 @@ class CommandLineSolver(Solver):
             task_state = process_result.get("task_state")
 
         solver_runtime_millis = None
-        run_time_ns = process_result.get("run_time_ns")
-        if run_time_ns:
-            solver_runtime_millis = round(process_result.get("run_time_ns") / 1000000)
+        elapsed_time = process_result.get("elapsed_time")
+        if elapsed_time is not None:
+            solver_runtime_millis = round(elapsed_time * 1000)
         """
         Our output includes the stdout and stderr logs of the driver (the /satcomp/solver executable),
         as well as whatever JSON output is provided once that solver finishes.
@@ -110,10 +208,16 @@ class CommandLineSolver(Solver):
                 "stdout": os.path.join(request_directory_path, process_result.get("stdout")),
                 "stderr": os.path.join(request_directory_path, process_result.get("stderr")),
                 "return_code": process_result.get("return_code"),
-                "solver_runtime_millis": solver_runtime_millis
+                "solver_runtime_millis": solver_runtime_millis,
+                "timed_out": process_result.get("timed_out"),
+                "termination_signal": process_result.get("termination_signal"),
+                "resource_usage": process_result.get("resource_usage"),
+                "placement": self.core_allocator.placement(cpus) if cpus is not None else None,
+                "persistent": process_result.get("persistent", False)
             },
             "solver": {
                 "output": solver_result,
+                "partial": partial_result,
                 "request_directory_path": request_directory_path
             },
             "task_state": task_state
@@ -0,0 +1,100 @@
+"""
+Helpers for capturing solver output without per-line Python overhead.
+Output is copied in large binary chunks (or written straight to the log file by the kernel), and
+only a rate-limited sample of it is mirrored to the container log.
+"""
+import os
+import threading
+import time
+
+CHUNK_SIZE = 1024 * 1024
+# Longest part of a single line mirrored to the container log; output without newlines would otherwise
+# be mirrored as one record of up to CHUNK_SIZE bytes
+MAX_MIRRORED_LINE_BYTES = 4 * 1024
+
+
+class LogMirror:
+    """Mirrors solver output to a logger at no more than lines_per_second lines per second, each
+    cut to max_line_bytes. Lines over budget are dropped and only counted."""
+
+    def __init__(self, logger, stream_name: str, lines_per_second: float, max_line_bytes: int = MAX_MIRRORED_LINE_BYTES):
+        self.logger = logger
+        self.stream_name = stream_name
+        self.lines_per_second = lines_per_second
+        self.max_line_bytes = max_line_bytes
+        self.tokens = lines_per_second
+        self.last_refill = time.monotonic()
+        self.suppressed_lines = 0
+        self.suppressed_bytes = 0
+        self.lock = threading.Lock()
+
+    def offer(self, data: bytes):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.lines_per_second, self.tokens + (now - self.last_refill) * self.lines_per_second)
+            self.last_refill = now
+            budget = int(self.tokens)
+            if budget == 0:
+                self.suppressed_lines += data.count(b"\n")
+                return
+            pieces = data.split(b"\n", budget)
+            if len(pieces) > budget:
+                self.suppressed_lines += pieces.pop().count(b"\n")
+            for piece in pieces:
+                if len(piece) > self.max_line_bytes:
+                    self.suppressed_bytes += len(piece) - self.max_line_bytes
+                    piece = piece[:self.max_line_bytes]
+                if piece:
+                    self.logger.info(f"{self.stream_name}: {piece.decode('UTF-8', errors='replace')}")
+            self.tokens -= len(pieces)
+
+    def close(self):
+        if self.suppressed_lines:
+            self.logger.info(f"{self.stream_name}: {self.suppressed_lines} lines not mirrored to the container log")
+        if self.suppressed_bytes:
+            self.logger.info(f"{self.stream_name}: {self.suppressed_bytes} bytes of long lines not mirrored "
+                             f"to the container log")
+
+
+def copy_stream(stream, file_handle, mirror: LogMirror = None):
+    """Copy a binary pipe to a file in large chunks until the writer closes it"""
+    fd = stream.fileno()
+    while True:
+        chunk = os.read(fd, CHUNK_SIZE)
+        if not chunk:
+            break
+        file_handle.write(chunk)
+        if mirror is not None:
+            mirror.offer(chunk)
+    file_handle.flush()
+
+
+class FileTailMirror(threading.Thread):
+    """Thread that periodically mirrors new content of a log file written directly by the solver.
+    At most max_bytes are read per interval; anything beyond is skipped."""
+
+    def __init__(self, path: str, mirror: LogMirror, interval: float = 1.0, max_bytes: int = 64 * 1024):
+        threading.Thread.__init__(self)
+        self.path = path
+        self.mirror = mirror
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.stopped = threading.Event()
+        self.setDaemon(True)
+
+    def run(self):
+        with open(self.path, "rb") as file_handle:
+            while not self.stopped.wait(self.interval):
+                self._poll(file_handle)
+            self._poll(file_handle)
+
+    def _poll(self, file_handle):
+        data = file_handle.read(self.max_bytes)
+        if data:
+            self.mirror.offer(data)
+        if len(data) == self.max_bytes:
+            file_handle.seek(0, os.SEEK_END)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
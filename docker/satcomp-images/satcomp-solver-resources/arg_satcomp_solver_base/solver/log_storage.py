@@ -0,0 +1,143 @@
+"""
+Size-bounded and compressed storage of solver logs.
+A bounded log keeps the first head_bytes and the last tail_bytes of the output and replaces the
+middle by a truncation marker; the tail is kept in two rotating segment files next to the log,
+so disk usage stays bounded while the solver runs.
+"""
+import gzip
+import os
+import shutil
+from dataclasses import dataclass
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COPY_BUFFER_SIZE = 1024 * 1024
+TRUNCATION_MARKER = "\n[... {} bytes truncated by the base container ...]\n"
+
+
+class LogStorageException(Exception):
+    """Exception for log storage errors"""
+
+
+@dataclass
+class LogStoragePolicy:
+    """Per-log limits; a head_bytes or tail_bytes of 0 means the log is not truncated"""
+    head_bytes: int = 0
+    tail_bytes: int = 0
+    compression: str = None
+
+    @property
+    def bounded(self):
+        return self.head_bytes > 0 or self.tail_bytes > 0
+
+
+class BoundedLogWriter:
+    """File-like object keeping the head and the tail of everything written to it"""
+
+    def __init__(self, path: str, head_bytes: int, tail_bytes: int):
+        self.path = path
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.head_handle = open(path, "wb")
+        self.written_bytes = 0
+        self.segment_paths = [f"{path}.tail.0", f"{path}.tail.1"]
+        self.segment_index = 0
+        self.segment_handle = None
+        self.segment_bytes = 0
+        self.closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("UTF-8")
+        head_free = self.head_bytes - self.written_bytes
+        self.written_bytes += len(data)
+        if head_free > 0:
+            self.head_handle.write(data[:head_free])
+            data = data[head_free:]
+        if data and self.tail_bytes > 0:
+            self._write_tail(data)
+
+    def _write_tail(self, data: bytes):
+        if self.segment_handle is None:
+            self.segment_handle = open(self.segment_paths[self.segment_index], "wb")
+        if self.segment_bytes >= self.tail_bytes:
+            # the current segment alone holds a full tail, so the older one can be dropped
+            self.segment_handle.close()
+            self.segment_index = 1 - self.segment_index
+            self.segment_handle = open(self.segment_paths[self.segment_index], "wb")
+            self.segment_bytes = 0
+        self.segment_handle.write(data)
+        self.segment_bytes += len(data)
+
+    def flush(self):
+        self.head_handle.flush()
+        if self.segment_handle is not None:
+            self.segment_handle.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.segment_handle is not None:
+            self.segment_handle.close()
+        # the tail is the last tail_bytes of the older segment followed by the newer one
+        segment_paths = [path for path in (self.segment_paths[1 - self.segment_index],
+                                           self.segment_paths[self.segment_index]) if os.path.exists(path)]
+        tail_total = sum(os.path.getsize(path) for path in segment_paths)
+        skip = max(0, tail_total - self.tail_bytes)
+        kept_bytes = min(self.head_bytes, self.written_bytes) + tail_total - skip
+        truncated_bytes = self.written_bytes - kept_bytes
+        if truncated_bytes > 0:
+            self.head_handle.write(TRUNCATION_MARKER.format(truncated_bytes).encode("UTF-8"))
+        for segment_path in segment_paths:
+            segment_size = os.path.getsize(segment_path)
+            if skip >= segment_size:
+                skip -= segment_size
+            else:
+                with open(segment_path, "rb") as segment:
+                    segment.seek(skip)
+                    shutil.copyfileobj(segment, self.head_handle, COPY_BUFFER_SIZE)
+                skip = 0
+            os.remove(segment_path)
+        self.head_handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def truncate_log(path: str, head_bytes: int, tail_bytes: int):
+    """Apply head+tail retention to a log file that was written without limits"""
+    size = os.path.getsize(path)
+    if size <= head_bytes + tail_bytes:
+        return
+    truncated_path = path + ".truncated"
+    with open(path, "rb") as source, open(truncated_path, "wb") as dest:
+        dest.write(source.read(head_bytes))
+        dest.write(TRUNCATION_MARKER.format(size - head_bytes - tail_bytes).encode("UTF-8"))
+        source.seek(size - tail_bytes)
+        shutil.copyfileobj(source, dest, COPY_BUFFER_SIZE)
+    os.replace(truncated_path, path)
+
+
+def compress_log(path: str, compression: str):
+    """Compress a log file in place, returning the path of the compressed file"""
+    if compression == "gzip":
+        compressed_path = path + ".gz"
+        with open(path, "rb") as source, gzip.open(compressed_path, "wb", compresslevel=6) as dest:
+            shutil.copyfileobj(source, dest, COPY_BUFFER_SIZE)
+    elif compression == "zstd":
+        if zstandard is None:
+            raise LogStorageException("zstandard module is not installed; cannot compress logs with zstd")
+        compressed_path = path + ".zst"
+        with open(path, "rb") as source, open(compressed_path, "wb") as dest:
+            zstandard.ZstdCompressor().copy_stream(source, dest)
+    else:
+        raise LogStorageException(f"Unsupported log compression {compression}")
+    os.remove(path)
+    return compressed_path
@@ -0,0 +1,318 @@
+"""
+Persistent solver servers.
+Instead of forking /competition/solver for every task, the base container can keep solver wrapper
+processes running and hand them tasks over their stdin. The protocol is one JSON object per line:
+
+  server -> base, once it is ready:  {"ready": true}
+  base -> server, for every task:    {"task_id": "...", "request_directory": "...", "timeout_seconds": 60}
+  server -> base, once it is done:   {"task_id": "...", "return_code": 0, "result": {...}}
+
+input.json is written to the request directory just as for the solver script, and "result" is
+optional: without it the result is read from solver_out.json in the request directory. Every other
+line the server prints, on stdout or stderr, goes to the logs of the task it is solving, captured
+with the same capture mode and log storage policy as the solver script. A server that exceeds the
+task timeout is stopped and a fresh one is started for the next task.
+"""
+import json
+import logging
+import os
+import queue
+import signal
+import subprocess
+import threading
+import time
+
+from arg_satcomp_solver_base.solver.run_command import CommandRunner
+
+DEFAULT_STARTUP_TIMEOUT_SECONDS = 30
+# /proc/<pid>/stat fields after the command name: utime, stime, cutime and cstime in clock ticks
+PROC_STAT_CPU_FIELDS = slice(11, 15)
+
+
+class PersistentSolverException(Exception):
+    """Exception for solver servers that cannot be started or do not speak the protocol"""
+
+
+class SolverServer:
+    """One running solver server process, solving one task at a time"""
+
+    def __init__(self, command: str, startup_timeout: float = DEFAULT_STARTUP_TIMEOUT_SECONDS,
+                 timeout_escalation: tuple = CommandRunner.DEFAULT_TIMEOUT_ESCALATION):
+        self.logger = logging.getLogger("SolverServer")
+        self.logger.setLevel(logging.DEBUG)
+        self.timeout_escalation = timeout_escalation
+        self.messages = queue.Queue()
+        # log files of the task being solved; output between tasks only goes to the container log
+        self.log_handles = {"STDOUT": None, "STDERR": None}
+        # rate-limited mirrors of the task being solved, or None to log every line
+        self.mirrors = None
+        self.log_lock = threading.Lock()
+        try:
+            self.proc = subprocess.Popen([command], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE, universal_newlines=True, bufsize=1,
+                                         start_new_session=True)
+        except OSError as e:
+            raise PersistentSolverException(f"Failed to start solver server {command}: {e}")
+        self.readers = [threading.Thread(target=self._read_stdout, daemon=True),
+                        threading.Thread(target=self._read_stream, args=(self.proc.stderr, "STDERR"), daemon=True)]
+        for reader in self.readers:
+            reader.start()
+        try:
+            message = self.messages.get(timeout=startup_timeout)
+        except queue.Empty:
+            message = None
+        if not message or not message.get("ready"):
+            self.stop()
+            raise PersistentSolverException(f"Solver server {command} did not report ready "
+                                            f"within {startup_timeout} seconds")
+        self.logger.info(f"Solver server {command} ready with pid {self.proc.pid}")
+
+    @staticmethod
+    def _parse_message(line: str):
+        """The protocol message on this line, or None for ordinary output"""
+        if not line.startswith("{"):
+            return None
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            return None
+        if isinstance(message, dict) and ("ready" in message or "task_id" in message):
+            return message
+        return None
+
+    def _log(self, str_name: str, line: str):
+        with self.log_lock:
+            handle = self.log_handles[str_name]
+            if handle is not None:
+                handle.write(line)
+            mirrors = self.mirrors
+        if mirrors is None:
+            self.logger.info(f"{str_name}: {line}")
+        elif mirrors[str_name] is not None:
+            mirrors[str_name].offer(line.encode("UTF-8"))
+
+    def _read_stdout(self):
+        for line in self.proc.stdout:
+            message = self._parse_message(line)
+            if message is not None:
+                self.messages.put(message)
+            else:
+                self._log("STDOUT", line)
+        # the server exited
+        self.messages.put(None)
+
+    def _read_stream(self, stream, str_name: str):
+        for line in stream:
+            self._log(str_name, line)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def cpu_times(self):
+        """
+        (user, system) CPU seconds used so far by the server and the processes it waited for, or None
+        if they cannot be read
+        """
+        try:
+            with open(f"/proc/{self.proc.pid}/stat") as stat:
+                # the command name may contain spaces, so the fields are counted from its closing parenthesis
+                fields = stat.read().rsplit(")", 1)[1].split()
+            utime, stime, cutime, cstime = map(int, fields[PROC_STAT_CPU_FIELDS])
+        except (OSError, IndexError, ValueError):
+            return None
+        ticks_per_second = os.sysconf("SC_CLK_TCK")
+        return (utime + cutime) / ticks_per_second, (stime + cstime) / ticks_per_second
+
+    def solve(self, task_id: str, request_directory: str, timeout: float, stdout_handle, stderr_handle,
+              mirrors: dict = None):
+        """
+        Hand a task to the server and wait for its response. Returns the response, or None if the
+        server exited or timed out; the caller tells the two apart with alive() and stop().
+        Output is mirrored to the container log through mirrors (by stream name), or line by line if None.
+        """
+        with self.log_lock:
+            self.log_handles = {"STDOUT": stdout_handle, "STDERR": stderr_handle}
+            self.mirrors = mirrors
+        try:
+            request = {"task_id": task_id, "request_directory": request_directory, "timeout_seconds": timeout}
+            try:
+                self.proc.stdin.write(json.dumps(request) + "\n")
+                self.proc.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                return None
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                try:
+                    message = self.messages.get(timeout=remaining)
+                except queue.Empty:
+                    return None
+                if message is None:
+                    return None
+                if message.get("task_id") == task_id:
+                    return message
+                self.logger.warning(f"Ignoring solver server message for another task: {message}")
+        finally:
+            # wait for the output the server wrote before it answered
+            for reader in self.readers:
+                if not self.alive():
+                    reader.join(timeout=1)
+            with self.log_lock:
+                self.log_handles = {"STDOUT": None, "STDERR": None}
+                self.mirrors = None
+
+    def _signal(self, sig):
+        # the server leads its own session, so its process group id is its pid
+        try:
+            os.killpg(self.proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def stop(self):
+        """Stop the server with the timeout escalation schedule, ending in SIGKILL; returns the signal that stopped it"""
+        if not self.alive():
+            return None
+        for sig, grace_seconds in self.timeout_escalation:
+            self._signal(sig)
+            try:
+                self.proc.wait(timeout=grace_seconds)
+                return sig.name
+            except subprocess.TimeoutExpired:
+                pass
+        self._signal(signal.SIGKILL)
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.logger.error("Solver server did not exit after sigkill")
+        return signal.SIGKILL.name
+
+
+class SolverServerPool:
+    """
+    Solver servers kept warm across tasks. A task takes an idle server (or starts one) and gives
+    it back when done, so concurrent pollers each get their own server. A task whose server cannot
+    be started runs the solver script instead; once max_start_failures servers in a row failed to
+    start or to speak the protocol, the pool marks itself unsupported and the solver runs its
+    script for every task.
+    """
+    max_start_failures = 3
+
+    def __init__(self, command: str, command_runner: CommandRunner,
+                 startup_timeout: float = DEFAULT_STARTUP_TIMEOUT_SECONDS):
+        self.command = command
+        self.command_runner = command_runner
+        self.startup_timeout = startup_timeout
+        self.idle = []
+        self.supported = True
+        self.start_failures = 0
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("SolverServerPool")
+        self.logger.setLevel(logging.DEBUG)
+
+    def _start_server(self):
+        try:
+            server = SolverServer(self.command, self.startup_timeout, self.command_runner.timeout_escalation)
+        except PersistentSolverException as e:
+            with self.lock:
+                self.start_failures += 1
+                start_failures = self.start_failures
+            self.logger.error(f"Failed to start solver server {self.command} ({start_failures} failures in a row)")
+            self.logger.exception(e)
+            if start_failures >= self.max_start_failures:
+                self.logger.error(f"Solver server {self.command} is unusable, running the solver script per task instead")
+                self.supported = False
+            raise
+        with self.lock:
+            self.start_failures = 0
+        return server
+
+    def warm(self, count: int):
+        """Start servers ahead of the first tasks"""
+        servers = []
+        try:
+            for _ in range(count):
+                servers.append(self._start_server())
+        except PersistentSolverException:
+            return
+        finally:
+            with self.lock:
+                self.idle.extend(servers)
+
+    def _acquire(self):
+        with self.lock:
+            while self.idle:
+                server = self.idle.pop()
+                if server.alive():
+                    return server
+        return self._start_server()
+
+    def _release(self, server: SolverServer):
+        if server.alive():
+            with self.lock:
+                self.idle.append(server)
+
+    def _mirrors(self):
+        """Mirrors for the capture mode; lines capture logs every line"""
+        if self.command_runner.capture_mode == "lines":
+            return None
+        return {"STDOUT": self.command_runner.make_mirror("STDOUT"), "STDERR": self.command_runner.make_mirror("STDERR")}
+
+    @staticmethod
+    def _resource_usage(elapsed: float, cpu_before, cpu_after):
+        usage = {"wall_time_seconds": elapsed}
+        if cpu_before is not None and cpu_after is not None:
+            usage["user_cpu_seconds"] = cpu_after[0] - cpu_before[0]
+            usage["system_cpu_seconds"] = cpu_after[1] - cpu_before[1]
+        return usage
+
+    def run(self, task_id: str, request_directory: str, timeout: float):
+        """Solve a task on a warm server; returns the same fields as CommandRunner.run plus the streamed result"""
+        server = self._acquire()
+        stdout_path = os.path.join(request_directory, self.command_runner.stdout_target_loc)
+        stderr_path = os.path.join(request_directory, self.command_runner.stderr_target_loc)
+        mirrors = self._mirrors()
+        with self.command_runner.open_log(stdout_path, text=True) as stdout_handle, \
+                self.command_runner.open_log(stderr_path, text=True) as stderr_handle:
+            cpu_before = server.cpu_times()
+            start_time = time.perf_counter()
+            response = server.solve(task_id, request_directory, timeout, stdout_handle, stderr_handle, mirrors)
+            elapsed = time.perf_counter() - start_time
+            # an exited server has been reaped, which discards its /proc entry
+            cpu_after = server.cpu_times()
+            timed_out = response is None and server.alive()
+            termination_signal = server.stop() if timed_out else None
+        for mirror in (mirrors or {}).values():
+            if mirror is not None:
+                mirror.close()
+        if response is not None:
+            return_code = response.get("return_code", 0)
+        elif timed_out:
+            elapsed = timeout
+            return_code = CommandRunner.TIMEOUT_RETURNCODE
+        else:
+            self.logger.error(f"Solver server exited while solving task {task_id}")
+            return_code = server.proc.returncode
+        self._release(server)
+        return {
+            "stdout": self.command_runner.store_log(stdout_path, self.command_runner.stdout_target_loc, truncate=False),
+            "stderr": self.command_runner.store_log(stderr_path, self.command_runner.stderr_target_loc, truncate=False),
+            "return_code": return_code,
+            "output_directory": request_directory,
+            "elapsed_time": elapsed,
+            "timed_out": timed_out,
+            "termination_signal": termination_signal,
+            "resource_usage": self._resource_usage(elapsed, cpu_before, cpu_after),
+            "memory_limit_exceeded": False,
+            "result": response.get("result") if response is not None else None,
+            "persistent": True
+        }
+
+    @staticmethod
+    def get_solver_server_pool(command: str, command_runner: CommandRunner,
+                               startup_timeout: float = DEFAULT_STARTUP_TIMEOUT_SECONDS):
+        """Pool for the solver server at command, or None if the solver does not provide one"""
+        if not os.access(command, os.X_OK):
+            return None
+        return SolverServerPool(command, command_runner, startup_timeout)
@@ -0,0 +1,65 @@
+"""
+Resource accounting for solver processes.
+The solver is reaped with wait4 so that its rusage (which includes every descendant it waited for)
+is available once it exits.
+"""
+import os
+import subprocess
+import threading
+
+# ru_inblock / ru_oublock are counted in 512-byte blocks
+RUSAGE_BLOCK_SIZE = 512
+
+
+def exit_status_to_return_code(status: int):
+    """Convert a wait status to a return code the way subprocess.Popen does"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class ProcessReaper(threading.Thread):
+    """Thread that waits for a process with wait4 and records its return code and resource usage"""
+
+    def __init__(self, proc: subprocess.Popen):
+        threading.Thread.__init__(self)
+        self.proc = proc
+        self.return_code = None
+        self.rusage = None
+        self.setDaemon(True)
+
+    def run(self):
+        try:
+            _, status, self.rusage = os.wait4(self.proc.pid, 0)
+            self.return_code = exit_status_to_return_code(status)
+            # let Popen know the process is gone so that it never waits for it again
+            self.proc.returncode = self.return_code
+        except ChildProcessError:
+            self.return_code = self.proc.returncode
+
+    def wait(self, timeout: float = None):
+        """Wait for the process to exit; raises subprocess.TimeoutExpired like Popen.wait"""
+        self.join(timeout)
+        if self.is_alive():
+            raise subprocess.TimeoutExpired(self.proc.args, timeout)
+        return self.return_code
+
+    def resource_usage(self, wall_time_seconds: float):
+        """
+        Resource usage of the process and the descendants it waited for.
+        max_rss_kb is the peak resident set size of the largest single process.
+        bytes_read and bytes_written count I/O that reached the storage layer (not the page cache).
+        """
+        usage = {"wall_time_seconds": wall_time_seconds}
+        if self.rusage is None:
+            return usage
+        usage.update({
+            "user_cpu_seconds": self.rusage.ru_utime,
+            "system_cpu_seconds": self.rusage.ru_stime,
+            "max_rss_kb": self.rusage.ru_maxrss,
+            "voluntary_context_switches": self.rusage.ru_nvcsw,
+            "involuntary_context_switches": self.rusage.ru_nivcsw,
+            "bytes_read": self.rusage.ru_inblock * RUSAGE_BLOCK_SIZE,
+            "bytes_written": self.rusage.ru_oublock * RUSAGE_BLOCK_SIZE
+        })
+        return usage
@@ -1,28 +1,75 @@
 import logging
 import os
+import shutil
 import time
 import subprocess
 import threading
 import signal
 from dataclasses import dataclass
 
+from arg_satcomp_solver_base.solver.log_capture import FileTailMirror, LogMirror, copy_stream
+from arg_satcomp_solver_base.resources.core_allocator import pin_command
+from arg_satcomp_solver_base.solver.cgroup import TaskCgroup
+from arg_satcomp_solver_base.solver.resource_usage import ProcessReaper
+from arg_satcomp_solver_base.solver.log_storage import BoundedLogWriter, LogStorageException, LogStoragePolicy, \
+    compress_log, truncate_log
 from arg_satcomp_solver_base.utils import FileOperations
 
 
 @dataclass
 class CommandRunner:
-    TIMEOUT_RETURNCODE = -100 
+    """Runs a command in its own process group and captures its output.
+    Capture modes:
+      lines  - read output line by line, logging every line (default)
+      chunks - copy output to the log files in large binary chunks
+      direct - let the process write straight to the log files
+    In chunks and direct mode only mirror_lines_per_second lines per second are mirrored to the log.
+    An optional log_storage policy bounds the size of the log files and compresses them once the command ends.
+    On timeout the process group gets each signal of timeout_escalation in turn, followed by SIGKILL."""
+    TIMEOUT_RETURNCODE = -100
+    DEFAULT_TIMEOUT_ESCALATION = ((signal.SIGTERM, 10),)
+    CAPTURE_MODES = ("lines", "chunks", "direct")
     stdout_target_loc: str
     stderr_target_loc: str
+    capture_mode: str
+    mirror_lines_per_second: float
+    log_storage: LogStoragePolicy
+    timeout_escalation: tuple
     file_operations: FileOperations = FileOperations()
 
-    def __init__(self, stdout_target_loc, stderr_target_loc):
+    def __init__(self, stdout_target_loc, stderr_target_loc, capture_mode="lines", mirror_lines_per_second=10,
+                 log_storage: LogStoragePolicy = None, timeout_escalation: tuple = None):
         self.logger = logging.getLogger("RunCommand")
         self.logger.setLevel(logging.DEBUG)
         self.stdout_target_loc = stdout_target_loc
         self.stderr_target_loc = stderr_target_loc
+        if capture_mode not in self.CAPTURE_MODES:
+            raise ValueError(f"Unknown capture mode {capture_mode}; expected one of {self.CAPTURE_MODES}")
+        self.capture_mode = capture_mode
+        self.mirror_lines_per_second = mirror_lines_per_second
+        self.log_storage = log_storage or LogStoragePolicy()
+        self.timeout_escalation = timeout_escalation if timeout_escalation is not None else self.DEFAULT_TIMEOUT_ESCALATION
         os.environ['PYTHONUNBUFFERED'] = "1"
 
+    @staticmethod
+    def parse_timeout_escalation(schedule: str):
+        """
+        Parse an escalation schedule such as "INT:5,TERM:10" (send SIGINT, wait 5 seconds, send SIGTERM,
+        wait 10 seconds) into a tuple of (signal, seconds) steps. SIGKILL always follows the last step.
+        """
+        steps = []
+        for step in schedule.split(","):
+            if not step.strip():
+                continue
+            try:
+                name, grace_seconds = step.split(":")
+                name = name.strip().upper()
+                sig = signal.Signals[name if name.startswith("SIG") else "SIG" + name]
+                steps.append((sig, float(grace_seconds)))
+            except (KeyError, ValueError):
+                raise ValueError(f"Invalid timeout escalation step '{step}'; expected SIGNAL:SECONDS")
+        return tuple(steps)
+
     def process_stream(self, stream, str_name, file_handle):
         line = stream.readline()
         while line != "":
@@ -30,41 +77,147 @@ class CommandRunner:
             file_handle.write(line)
             line = stream.readline()
 
-    def run(self, cmd: list, output_directory: str, time_out: int):
+    def make_mirror(self, str_name):
+        """Rate-limited mirror of a stream to the container log, or None if nothing is mirrored"""
+        if self.mirror_lines_per_second <= 0:
+            return None
+        return LogMirror(self.logger, str_name, self.mirror_lines_per_second)
+
+    def _start_capture(self, cmd: list, stdout_path: str, stdout_handle, stderr_path: str, stderr_handle):
+        """Start the process and the threads capturing its output"""
+        if self.capture_mode == "direct":
+            proc = subprocess.Popen(cmd, stdout=stdout_handle, stderr=stderr_handle, start_new_session=True)
+            mirrors = [self.make_mirror("STDOUT"), self.make_mirror("STDERR")]
+            threads = [FileTailMirror(path, mirror) for path, mirror in zip([stdout_path, stderr_path], mirrors)
+                       if mirror is not None]
+        elif self.capture_mode == "chunks":
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+            mirrors = [self.make_mirror("STDOUT"), self.make_mirror("STDERR")]
+            threads = [threading.Thread(target = copy_stream, args=(proc.stdout, stdout_handle, mirrors[0])),
+                       threading.Thread(target = copy_stream, args=(proc.stderr, stderr_handle, mirrors[1]))]
+        else:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True, start_new_session=True)
+            mirrors = []
+            threads = [threading.Thread(target = self.process_stream, args=(proc.stdout, "STDOUT", stdout_handle)),
+                       threading.Thread(target = self.process_stream, args=(proc.stderr, "STDERR", stderr_handle))]
+        for thread in threads:
+            thread.start()
+        return proc, threads, [mirror for mirror in mirrors if mirror is not None]
+
+    def _stop_capture(self, threads: list, mirrors: list):
+        for thread in threads:
+            if isinstance(thread, FileTailMirror):
+                thread.stop()
+            else:
+                thread.join()
+        for mirror in mirrors:
+            mirror.close()
+
+    def open_log(self, path: str, text: bool = None):
+        """Open a log file for output copied by the base container, keeping only the head and tail the
+        log storage policy allows. Text defaults to the capture mode (lines writes text, chunks bytes)."""
+        if self.log_storage.bounded:
+            return BoundedLogWriter(path, self.log_storage.head_bytes, self.log_storage.tail_bytes)
+        if text is None:
+            text = self.capture_mode == "lines"
+        return open(path, "w" if text else "wb")
+
+    def _open_log(self, path: str):
+        # in direct mode the process writes to the file itself, so it is truncated after the run instead
+        if self.capture_mode == "direct":
+            return open(path, "wb")
+        return self.open_log(path)
+
+    def store_log(self, path: str, target_loc: str, truncate: bool = None):
+        """Apply the log storage policy to a finished log, returning its (possibly renamed) location.
+        Logs that were written without bounds (direct capture mode by default) are truncated here."""
+        if truncate is None:
+            truncate = self.capture_mode == "direct"
+        if self.log_storage.bounded and truncate:
+            truncate_log(path, self.log_storage.head_bytes, self.log_storage.tail_bytes)
+        if self.log_storage.compression:
+            try:
+                compressed_path = compress_log(path, self.log_storage.compression)
+            except (LogStorageException, OSError) as e:
+                self.logger.error(f"Failed to compress log {path}; keeping it uncompressed")
+                self.logger.exception(e)
+                return target_loc
+            return target_loc + compressed_path[len(path):]
+        return target_loc
+
+    def _signal_process_group(self, proc, sig):
+        # the process leads its own session, so its process group id is its pid
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            self.logger.info("Process group already exited")
+
+    def _escalate(self, proc, reaper: ProcessReaper):
+        """
+        Stop a process group that ran past its timeout by walking the escalation schedule and
+        finally sending SIGKILL. Returns the return code and the name of the signal that stopped it.
+        """
+        for sig, grace_seconds in self.timeout_escalation:
+            self.logger.info(f"Timeout expired for process.  Signalling process group w/{sig.name}, "
+                             f"waiting {grace_seconds} seconds for a graceful shutdown")
+            self._signal_process_group(proc, sig)
+            try:
+                return reaper.wait(timeout = grace_seconds), sig.name
+            except subprocess.TimeoutExpired:
+                pass
+        self.logger.info("Process unresponsive.  Terminating process group w/sigkill")
+        self._signal_process_group(proc, signal.SIGKILL)
+        try:
+            # reap the killed process to collect its resource usage
+            reaper.wait(timeout = 10)
+        except subprocess.TimeoutExpired:
+            self.logger.error("Process did not exit after sigkill")
+        return self.TIMEOUT_RETURNCODE, signal.SIGKILL.name
+
+    def run(self, cmd: list, output_directory: str, time_out: int, task_cgroup: TaskCgroup = None, cpus: list = None):
         self.logger.info("Running command: %s", str(cmd))
-        with open(os.path.join(output_directory, self.stdout_target_loc), "w") as stdout_handle:
-            with open(os.path.join(output_directory, self.stderr_target_loc), "w") as stderr_handle:
+        if task_cgroup is not None or cpus:
+            # the launch wrappers would only fail once they are running, with an unhelpful exit code
+            if shutil.which(cmd[0]) is None:
+                raise FileNotFoundError(f"No such executable: {cmd[0]}")
+        if cpus:
+            cmd = pin_command(cmd, cpus)
+        if task_cgroup is not None:
+            cmd = task_cgroup.wrap_command(cmd)
+        stdout_path = os.path.join(output_directory, self.stdout_target_loc)
+        stderr_path = os.path.join(output_directory, self.stderr_target_loc)
+        with self._open_log(stdout_path) as stdout_handle:
+            with self._open_log(stderr_path) as stderr_handle:
                 try:
                     start_time = time.perf_counter()
-                    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                        universal_newlines=True, start_new_session=True)
-                    stdout_t = threading.Thread(target = self.process_stream, args=(proc.stdout, "STDOUT", stdout_handle))
-                    stderr_t = threading.Thread(target = self.process_stream, args=(proc.stderr, "STDERR", stderr_handle))
-                    stdout_t.start()
-                    stderr_t.start()
-                    return_code = proc.wait(timeout = time_out)
+                    proc, capture_threads, mirrors = self._start_capture(cmd, stdout_path, stdout_handle,
+                                                                         stderr_path, stderr_handle)
+                    reaper = ProcessReaper(proc)
+                    reaper.start()
+                    return_code = reaper.wait(timeout = time_out)
                     end_time = time.perf_counter()
                     elapsed = end_time - start_time
                     timed_out = False
+                    termination_signal = None
                 except subprocess.TimeoutExpired:
                     timed_out = True
                     elapsed = time_out
-                    self.logger.info("Timeout expired for process.  Terminating process group w/sigterm")
-                    os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
-                    # wait 10 seconds for a graceful shutdown.
-                    try:
-                        return_code = proc.wait(timeout = 10)
-                    except subprocess.TimeoutExpired:
-                        self.logger.info("Process unresponsive.  Terminating process group w/sigkill")
-                        os.killpg(os.getpgid(proc.pid), signal.SIGKILL)
-                        return_code = self.TIMEOUT_RETURNCODE
-                stdout_t.join()
-                stderr_t.join()
+                    return_code, termination_signal = self._escalate(proc, reaper)
+                self._stop_capture(capture_threads, mirrors)
+        resource_usage = reaper.resource_usage(elapsed)
+        memory_limit_exceeded = False
+        if task_cgroup is not None:
+            resource_usage["cgroup"] = task_cgroup.stats()
+            memory_limit_exceeded = task_cgroup.memory_limit_exceeded()
         return {
-            "stdout": self.stdout_target_loc,
-            "stderr": self.stderr_target_loc,
+            "stdout": self.store_log(stdout_path, self.stdout_target_loc),
+            "stderr": self.store_log(stderr_path, self.stderr_target_loc),
             "return_code": return_code,
             "output_directory": output_directory,
             "elapsed_time": elapsed,
-            "timed_out": timed_out
+            "timed_out": timed_out,
+            "termination_signal": termination_signal,
+            "resource_usage": resource_usage,
+            "memory_limit_exceeded": memory_limit_exceeded
         }
@@ -1,8 +1,11 @@
 from dataclasses import dataclass
 
+from arg_satcomp_solver_base.resources.resource_pool import TaskResources
+
 
 @dataclass
 class Solver:
     """Solver interface"""
-    def solve(self, formula_file: str, request_directory_path: str, workers: list, task_uuid: str, timeout: int, formula_language: str, solver_argument_list: list):
+    def solve(self, formula_file: str, request_directory_path: str, workers: list, task_uuid: str, timeout: int, formula_language: str, solver_argument_list: list,
+              original_formula_file: str = None, resources: TaskResources = None):
         """Interface for solve command"""
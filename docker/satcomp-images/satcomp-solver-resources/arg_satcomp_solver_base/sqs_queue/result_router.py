@@ -0,0 +1,144 @@
+"""
+Client side demultiplexer for the solver output queue.
+Every submitted problem carries a request id; the leader echoes it in the result (as request_id in the
+body and as the RequestId message attribute). The router receives results in the background and
+completes the future of the caller that is waiting for that request id, so that several problems (and
+several clients) can be outstanding on the same output queue at once.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+from botocore.exceptions import ClientError
+
+from arg_satcomp_solver_base.sqs_queue.sqs_queue import MESSAGE_TYPE_ATTRIBUTE, REQUEST_ID_ATTRIBUTE, \
+    STARTED_MESSAGE_TYPE, SqsQueue, SqsQueueException
+
+
+def new_request_id():
+    return str(uuid.uuid4())
+
+
+class ResultRouter(threading.Thread):
+    """Thread routing result messages to the callers waiting for them.
+    Results of requests this router never expected are released back to the queue for other clients,
+    hidden for longer every time they come back; once such a result has been received more than
+    max_foreign_receives times nobody is waiting for it any more (e.g. it is left over from an earlier
+    run) and it is deleted. Results of requests that were abandoned (e.g. retried) are deleted."""
+    error_sleep_time = 1
+    release_delay_seconds = 2
+    max_release_delay_seconds = 300
+    max_foreign_receives = 10
+
+    def __init__(self, result_queue: SqsQueue):
+        threading.Thread.__init__(self)
+        self.result_queue = result_queue
+        self.waiting = {}
+        # monotonic time at which a leader last reported starting each waiting request
+        self.start_times = {}
+        self.abandoned = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.logger = logging.getLogger("ResultRouter")
+        self.logger.setLevel(logging.DEBUG)
+        self.setDaemon(True)
+
+    def expect(self, request_id: str):
+        """Register interest in the result of request_id before the problem is sent; returns a Future of the result JSON"""
+        future = Future()
+        with self.lock:
+            self.waiting[request_id] = future
+        return future
+
+    def abandon(self, request_id: str):
+        """Stop waiting for request_id; a result that still arrives for it is discarded"""
+        with self.lock:
+            future = self.waiting.pop(request_id, None)
+            self.start_times.pop(request_id, None)
+            self.abandoned.add(request_id)
+        if future is not None:
+            future.cancel()
+
+    def started_at(self, request_id: str):
+        """time.monotonic() at which a leader started solving request_id, or None if it is still queued"""
+        with self.lock:
+            return self.start_times.get(request_id)
+
+    @staticmethod
+    def _request_id(message, result_json: dict):
+        request_id = message.attribute(REQUEST_ID_ATTRIBUTE)
+        if request_id is None and isinstance(result_json, dict):
+            request_id = result_json.get("request_id")
+        return request_id
+
+    def _route(self, message):
+        try:
+            result_json = json.loads(message.read())
+        except json.JSONDecodeError:
+            self.logger.error(f"Discarding result that is not valid JSON: {message.read()}")
+            message.delete()
+            return
+        request_id = self._request_id(message, result_json)
+        if message.attribute(MESSAGE_TYPE_ATTRIBUTE) == STARTED_MESSAGE_TYPE:
+            self._route_started(message, request_id)
+            return
+        with self.lock:
+            future = self.waiting.pop(request_id, None)
+            self.start_times.pop(request_id, None)
+            abandoned = request_id in self.abandoned
+            self.abandoned.discard(request_id)
+        if future is not None:
+            message.delete()
+            future.set_result(result_json)
+        elif abandoned or request_id is None:
+            self.logger.info(f"Discarding result of request {request_id} that nobody is waiting for")
+            message.delete()
+        else:
+            self._release_foreign(message, request_id)
+
+    def _route_started(self, message, request_id: str):
+        with self.lock:
+            waiting = request_id in self.waiting
+            if waiting:
+                # a redelivered problem is started again, which restarts its clock
+                self.start_times[request_id] = time.monotonic()
+            abandoned = request_id in self.abandoned
+        if waiting or abandoned or request_id is None:
+            message.delete()
+        else:
+            self._release_foreign(message, request_id)
+
+    def _release_foreign(self, message, request_id: str):
+        if message.receive_count() > self.max_foreign_receives:
+            self.logger.info(f"Discarding result of request {request_id} that was received "
+                             f"{message.receive_count()} times without being claimed")
+            message.delete()
+        else:
+            # the result of another client sharing the output queue
+            message.release(self._release_delay(message.receive_count()))
+
+    def _release_delay(self, receive_count: int):
+        """Visibility timeout of a released result, doubling with every receive"""
+        return min(self.max_release_delay_seconds, self.release_delay_seconds * 2 ** (receive_count - 1))
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                messages = self.result_queue.get_messages()
+            except SqsQueueException as e:
+                self.logger.exception(e)
+                time.sleep(self.error_sleep_time)
+                continue
+            for message in messages:
+                try:
+                    self._route(message)
+                except ClientError as e:
+                    self.logger.error("Failed to delete or release result message")
+                    self.logger.exception(e)
+
+    def stop(self):
+        """Stop receiving results; the current long poll finishes first"""
+        self.stopped.set()
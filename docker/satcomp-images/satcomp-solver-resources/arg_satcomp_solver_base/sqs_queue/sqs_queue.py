@@ -1,27 +1,125 @@
 """Implementation of classes for interacting with SQS"""
 import logging
+import threading
+import time
+from collections import deque
 
 from botocore.exceptions import ClientError
 
+from arg_satcomp_solver_base.metrics.metrics import MetricsRegistry
+
+# SQS accepts at most 10 messages per receive_message / send_message_batch call
+MAX_BATCH_SIZE = 10
+# Message attribute carrying the id that correlates a problem message with its result message
+REQUEST_ID_ATTRIBUTE = "RequestId"
+# Message attribute marking messages on the output queue that are not results; the leader sends a
+# STARTED_MESSAGE_TYPE message when it starts solving a problem
+MESSAGE_TYPE_ATTRIBUTE = "MessageType"
+STARTED_MESSAGE_TYPE = "started"
+
+METRICS = MetricsRegistry.get_registry()
+SQS_REQUESTS = METRICS.counter("satcomp_sqs_requests_total", "SQS API calls by queue, operation and outcome")
+SQS_MESSAGES = METRICS.counter("satcomp_sqs_messages_total", "SQS messages received, sent and deleted by queue")
+
+
+def to_message_attributes(attributes: dict):
+    """Convert a dict of strings to the SQS MessageAttributes structure"""
+    return {name: {'DataType': 'String', 'StringValue': str(value)} for name, value in attributes.items()}
+
 
 class SqsQueueException(Exception):
     """Exception for SqsQueue errors"""
 
 
+class MessageLease(threading.Thread):
+    """Thread that keeps a message invisible to other consumers while it is being processed
+    by extending its visibility timeout periodically. If the consumer dies the heartbeat stops
+    and SQS redelivers the message once the visibility timeout expires."""
+
+    def __init__(self, message, visibility_timeout: int):
+        threading.Thread.__init__(self)
+        self.message = message
+        self.visibility_timeout = visibility_timeout
+        self.heartbeat_interval = max(1, visibility_timeout // 3)
+        self.stopped = threading.Event()
+        self.logger = logging.getLogger("MessageLease")
+        self.logger.setLevel(logging.DEBUG)
+        self.setDaemon(True)
+
+    def run(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            try:
+                self.message.change_visibility(self.visibility_timeout)
+            except ClientError as e:
+                self.logger.error("Failed to extend lease on message with receipt handle: %s",
+                                  self.message.msg.receipt_handle)
+                self.logger.exception(e)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+
 class QueueMessage:
     """Class to represent an SQS message"""
 
-    def __init__(self, msg, queue_resource):
+    def __init__(self, msg, queue_resource, queue_name: str = ""):
         self.logger = logging.getLogger("QueueMessage")
         self.logger.setLevel(logging.DEBUG)
         self.queue_resource = queue_resource
+        self.queue_name = queue_name
         self.msg = msg
+        self.lease = None
 
     def read(self):
         return self.msg.body
 
+    def attribute(self, name: str):
+        """String value of a message attribute, or None if the message does not carry it"""
+        message_attributes = self.msg.message_attributes or {}
+        return message_attributes.get(name, {}).get("StringValue")
+
+    def receive_count(self):
+        """Number of times this message has been received (including this one)"""
+        attributes = self.msg.attributes or {}
+        return int(attributes.get("ApproximateReceiveCount", 1))
+
+    def change_visibility(self, visibility_timeout: int):
+        """Hide the message from other consumers for visibility_timeout seconds from now"""
+        self.msg.change_visibility(VisibilityTimeout=visibility_timeout)
+
+    def start_lease(self, visibility_timeout: int):
+        """Keep the message invisible with a background heartbeat until it is deleted or released"""
+        self.logger.info("Leasing message with receipt handle %s for %d seconds at a time",
+                         self.msg.receipt_handle, visibility_timeout)
+        try:
+            self.change_visibility(visibility_timeout)
+        except ClientError as e:
+            self.logger.error("Failed to lease message from SQS queue")
+            self.logger.exception(e)
+            raise SqsQueueException("Failed to lease message from SQS queue")
+        self.lease = MessageLease(self, visibility_timeout)
+        self.lease.start()
+
+    def stop_lease(self):
+        if self.lease is not None:
+            self.lease.stop()
+            self.lease = None
+
+    def release(self, visibility_timeout: int = 0):
+        """Stop the lease and make the message visible again (after visibility_timeout seconds) so that it is redelivered"""
+        self.stop_lease()
+        self.logger.info("Releasing message with receipt handle: %s", self.msg.receipt_handle)
+        try:
+            self.change_visibility(visibility_timeout)
+        except ClientError as ex:
+            self.logger.error("Failed to release message to SQS queue")
+            self.logger.exception(ex)
+            raise ex
+
     def delete(self):
-        
+        self.stop_lease()
         self.logger.info("Deleting message with receipt handle: %s", self.msg.receipt_handle)
         msg_txt = self.msg.body
         try:
@@ -32,49 +130,144 @@ class QueueMessage:
                 },
             ])
         except ClientError as ex:
+            SQS_REQUESTS.inc(queue=self.queue_name, operation="DeleteMessageBatch", outcome="error")
             self.logger.error("Failed to delete message from SQS queue")
             self.logger.exception(ex)
             raise ex
         else:
+            SQS_REQUESTS.inc(queue=self.queue_name, operation="DeleteMessageBatch", outcome="ok")
+            SQS_MESSAGES.inc(queue=self.queue_name, direction="deleted")
             return msg_txt
 
 
 class SqsQueue:
-    """Class to represent an SQS queue"""
-    def __init__(self, queue_resource, queue_name):
+    """Class to represent an SQS queue.
+    If lease_seconds is set, received messages are leased: they stay invisible while a heartbeat
+    runs and must be deleted by the consumer once processing is complete."""
+    def __init__(self, queue_resource, queue_name, lease_seconds: int = 0):
         self.queue_resource = queue_resource
         self.queue_name = queue_name
+        self.lease_seconds = lease_seconds
         self.logger = logging.getLogger("SqsQueue")
 
+    @property
+    def lease_mode(self):
+        return self.lease_seconds > 0
+
     def get_message(self):
         """Get a single message off the queue if it exists"""
+        messages = self.get_messages(1)
+        if len(messages) == 0:
+            return None
+        return messages[0]
+
+    def get_messages(self, max_messages: int = MAX_BATCH_SIZE, lease_seconds: int = None):
+        """Get up to max_messages (at most 10) messages off the queue in one call.
+        Received messages are leased for lease_seconds (defaults to the queue lease setting); messages
+        that cannot be leased are released for redelivery instead of being returned."""
+        if lease_seconds is None:
+            lease_seconds = self.lease_seconds
         try:
-            self.logger.info("Trying to get message from queue %s", self.queue_name)
+            self.logger.info("Trying to get up to %d messages from queue %s", max_messages, self.queue_name)
             messages = self.queue_resource.receive_messages(
                 AttributeNames=['All'],
                 MessageAttributeNames=['All'],
-                MaxNumberOfMessages=1,
+                MaxNumberOfMessages=min(max_messages, MAX_BATCH_SIZE),
                 WaitTimeSeconds=20,
             )
         except ClientError as e:
+            SQS_REQUESTS.inc(queue=self.queue_name, operation="ReceiveMessage", outcome="error")
             self.logger.error("Failed to get message from SQS queue")
             self.logger.exception(e)
             raise SqsQueueException(f"Failed to get message from SQS queue {self.queue_name}")
-        if messages is None or len(messages) == 0:
-            return None
-        return QueueMessage(messages[0], self.queue_resource)
+        SQS_REQUESTS.inc(queue=self.queue_name, operation="ReceiveMessage", outcome="ok")
+        if messages is None:
+            return []
+        SQS_MESSAGES.inc(len(messages), queue=self.queue_name, direction="received")
+        queue_messages = [QueueMessage(msg, self.queue_resource, self.queue_name) for msg in messages]
+        if lease_seconds:
+            return [message for message in queue_messages if self._lease(message, lease_seconds)]
+        return queue_messages
+
+    def _lease(self, message: QueueMessage, lease_seconds: int):
+        """Start the lease of a received message, releasing it if that fails; returns whether it is leased"""
+        try:
+            message.start_lease(lease_seconds)
+            return True
+        except SqsQueueException:
+            pass
+        try:
+            message.release()
+        except ClientError:
+            # it reappears once the visibility timeout of the queue expires
+            pass
+        return False
 
-    def put_message(self, msg):
-        """Put a single message on the queue"""
+    def put_message(self, msg, attributes: dict = None):
+        """Put a single message on the queue, with optional string message attributes"""
         try:
             self.logger.info("Trying to put message onto queue %s", self.queue_name)
-            messages = self.queue_resource.send_message(
-                MessageBody=msg
-            )
+            if attributes:
+                messages = self.queue_resource.send_message(
+                    MessageBody=msg,
+                    MessageAttributes=to_message_attributes(attributes)
+                )
+            else:
+                messages = self.queue_resource.send_message(
+                    MessageBody=msg
+                )
         except ClientError as e:
+            SQS_REQUESTS.inc(queue=self.queue_name, operation="SendMessage", outcome="error")
             self.logger.error("Failed to put message on SQS queue")
             self.logger.exception(e)
             raise SqsQueueException(f"Failed to put message on SQS queue {self.queue_name}")
+        SQS_REQUESTS.inc(queue=self.queue_name, operation="SendMessage", outcome="ok")
+        SQS_MESSAGES.inc(queue=self.queue_name, direction="sent")
+
+    def put_messages(self, messages: list):
+        """Put several (body, attributes) messages on the queue, batching them 10 at a time.
+        Returns the positions in messages of the entries that were not put on the queue, so that the caller
+        can send them again; a batch whose request fails as a whole counts as failed entirely."""
+        failed_entries = []
+        for batch_start in range(0, len(messages), MAX_BATCH_SIZE):
+            entries = []
+            for index, (msg, attributes) in enumerate(messages[batch_start:batch_start + MAX_BATCH_SIZE], batch_start):
+                entry = {'Id': str(index), 'MessageBody': msg}
+                if attributes:
+                    entry['MessageAttributes'] = to_message_attributes(attributes)
+                entries.append(entry)
+            try:
+                self.logger.info("Trying to put %d messages onto queue %s", len(entries), self.queue_name)
+                response = self.queue_resource.send_messages(Entries=entries)
+            except ClientError as e:
+                SQS_REQUESTS.inc(queue=self.queue_name, operation="SendMessageBatch", outcome="error")
+                self.logger.error("Failed to put messages on SQS queue")
+                self.logger.exception(e)
+                failed_entries.extend(int(entry['Id']) for entry in entries)
+                continue
+            SQS_REQUESTS.inc(queue=self.queue_name, operation="SendMessageBatch", outcome="ok")
+            failed = response.get('Failed', [])
+            SQS_MESSAGES.inc(len(entries) - len(failed), queue=self.queue_name, direction="sent")
+            if failed:
+                self.logger.error(f"Failed to put {len(failed)} of {len(entries)} messages on SQS queue: {failed}")
+                failed_entries.extend(int(entry['Id']) for entry in failed)
+        return sorted(failed_entries)
+
+    def message_counts(self):
+        """Approximate number of messages waiting in the queue (visible) and being processed (in_flight)"""
+        try:
+            self.queue_resource.reload()
+        except ClientError as e:
+            SQS_REQUESTS.inc(queue=self.queue_name, operation="GetQueueAttributes", outcome="error")
+            self.logger.error(f"Failed to get attributes of queue {self.queue_name}")
+            self.logger.exception(e)
+            raise SqsQueueException(f"Failed to get attributes of SQS queue {self.queue_name}")
+        SQS_REQUESTS.inc(queue=self.queue_name, operation="GetQueueAttributes", outcome="ok")
+        attributes = self.queue_resource.attributes
+        return {
+            "visible": int(attributes.get("ApproximateNumberOfMessages", 0)),
+            "in_flight": int(attributes.get("ApproximateNumberOfMessagesNotVisible", 0))
+        }
 
     def purge(self): 
         try:
@@ -86,15 +279,71 @@ class SqsQueue:
             raise SqsQueueException(f"Failed to purge queue {self.queue_name}")
 
     @staticmethod
-    def get_sqs_queue(queue_name: str):
+    def get_sqs_queue(queue_name: str, lease_seconds: int = 0):
         import boto3
         sqs = boto3.resource('sqs')
         queue = sqs.get_queue_by_name(QueueName=queue_name)
-        return SqsQueue(queue, queue_name)
+        return SqsQueue(queue, queue_name, lease_seconds)
 
     @staticmethod
     def get_sqs_queue_from_session(session, queue_name: str):
         import boto3
         sqs = session.resource('sqs')
         queue = sqs.get_queue_by_name(QueueName=queue_name)
-        return SqsQueue(queue, queue_name)
\ No newline at end of file
+        return SqsQueue(queue, queue_name)
+
+
+class PrefetchingSqsQueue(threading.Thread):
+    """Thread that receives messages from an SQS queue in batches and keeps them in a bounded
+    local buffer, so that pollers can pick up their next task without waiting on SQS.
+    Buffered messages are leased so that they stay invisible to other consumers until they are
+    handed out; a message handed out by a queue that is not in lease mode still holds its lease
+    until the poller deletes it."""
+    error_sleep_time = 1
+
+    def __init__(self, sqs_queue: SqsQueue, buffer_size: int, buffer_lease_seconds: int = 60):
+        threading.Thread.__init__(self)
+        self.sqs_queue = sqs_queue
+        self.queue_name = sqs_queue.queue_name
+        self.buffer_size = buffer_size
+        self.lease_seconds = sqs_queue.lease_seconds or buffer_lease_seconds
+        self.buffer = deque()
+        self.condition = threading.Condition()
+        self.logger = logging.getLogger("PrefetchingSqsQueue")
+        self.logger.setLevel(logging.DEBUG)
+        self.setDaemon(True)
+
+    @property
+    def lease_mode(self):
+        return self.sqs_queue.lease_mode
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.buffer) < self.buffer_size)
+                free_slots = self.buffer_size - len(self.buffer)
+            try:
+                messages = self.sqs_queue.get_messages(free_slots, self.lease_seconds)
+            except SqsQueueException as e:
+                self.logger.exception(e)
+                time.sleep(self.error_sleep_time)
+                continue
+            with self.condition:
+                self.buffer.extend(messages)
+                self.condition.notify_all()
+            self.logger.info(f"Prefetched {len(messages)} messages; {len(self.buffer)} buffered")
+
+    def get_message(self, wait_time_seconds: int = 20):
+        """Hand out the next buffered message, waiting up to wait_time_seconds for one to arrive"""
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.buffer) > 0, timeout=wait_time_seconds):
+                return None
+            message = self.buffer.popleft()
+            self.condition.notify_all()
+        return message
+
+    def put_message(self, msg, attributes: dict = None):
+        self.sqs_queue.put_message(msg, attributes)
+
+    def put_messages(self, messages: list):
+        return self.sqs_queue.put_messages(messages)
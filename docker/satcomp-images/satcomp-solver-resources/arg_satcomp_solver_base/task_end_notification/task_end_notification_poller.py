@@ -1,38 +1,116 @@
+import logging
 import threading
+import time
 import polling2
 
+from arg_satcomp_solver_base.metrics.metrics import MetricsRegistry
 from arg_satcomp_solver_base.solver.run_command import CommandRunner
+from arg_satcomp_solver_base.task_end_notification.task_end_notification_server import TaskEndNotificationClient
 from arg_satcomp_solver_base.task_end_notification.task_end_notifier import TaskEndNotifier
 
+METRICS = MetricsRegistry.get_registry()
+TASK_END_NOTIFICATIONS = METRICS.counter("satcomp_task_end_notifications_total",
+                                         "Task end notifications received by source (push or table scan)")
+CLEANUP_SECONDS = METRICS.histogram("satcomp_cleanup_seconds", "Run time of the worker cleanup script")
 
 class TaskEndNotificationPoller(threading.Thread):
+    """Thread that runs the worker cleanup script whenever the leader finishes a task.
+    Notifications are pushed by the leader over a long-poll connection. While the leader endpoint cannot be
+    reached, the poller scans the TaskEndNotification table every half second, looks the leader up again
+    (it may have been replaced) and retries the endpoint every fallback_poll_timeout seconds."""
     task_end_notifier: TaskEndNotifier
     command_runner: CommandRunner
+    notification_client: TaskEndNotificationClient
     previous_notification_id: str = None
+    # how long to poll the table before trying to reconnect to the leader endpoint
+    fallback_poll_timeout = 10
+    # participant script run after every task, and the directory its logs are written to
+    cleanup_command = "/competition/cleanup"
+    cleanup_output_directory = "/tmp"
 
-    def __init__(self, task_end_notifier: TaskEndNotifier, command_runner: CommandRunner):
+    def __init__(self, task_end_notifier: TaskEndNotifier, command_runner: CommandRunner,
+                 notification_client: TaskEndNotificationClient = None, leader_lookup=None):
         threading.Thread.__init__(self)
         self.task_end_notifier = task_end_notifier
         self.command_runner = command_runner
+        self.notification_client = notification_client
+        # callable returning the IP address of the current leader, or None if there is none
+        self.leader_lookup = leader_lookup
+        self.logger = logging.getLogger("TaskEndNotificationPoller")
+        self.logger.setLevel(logging.DEBUG)
 
     def run(self):
         while True:
             self.wait_for_notification()
-            self.command_runner.run(cmd=["/competition/cleanup"], output_directory="/tmp", time_out = 10)
+            start_time = time.monotonic()
+            self.command_runner.run(cmd=[self.cleanup_command], output_directory=self.cleanup_output_directory, time_out = 10)
+            CLEANUP_SECONDS.observe(time.monotonic() - start_time)
 
-    @polling2.poll_decorator(check_success=lambda has_notification: has_notification, step=0.5, poll_forever=True)
     def wait_for_notification(self):
-        return self._check_for_notification()
+        if self.notification_client is None:
+            return self._poll_for_notification(timeout=None)
+        while True:
+            try:
+                if self._wait_for_pushed_notification():
+                    return True
+            except (OSError, ValueError) as e:
+                self.logger.warning(f"Task end notification endpoint unavailable ({e}); "
+                                    f"falling back to table scans")
+                self._refresh_leader()
+                try:
+                    return self._poll_for_notification(timeout=self.fallback_poll_timeout)
+                except polling2.TimeoutException:
+                    pass
+
+    def _refresh_leader(self):
+        if self.leader_lookup is None:
+            return
+        try:
+            leader_ip = self.leader_lookup()
+        except Exception as e:
+            self.logger.error("Failed to look up the current leader")
+            self.logger.exception(e)
+            return
+        if leader_ip is not None and leader_ip != self.notification_client.leader_ip:
+            self.logger.info(f"Leader changed from {self.notification_client.leader_ip} to {leader_ip}")
+            self.notification_client.leader_ip = leader_ip
+
+    def _wait_for_pushed_notification(self):
+        notification_id = self.notification_client.wait_for_notification(self.previous_notification_id)
+        if notification_id is not None:
+            self.previous_notification_id = notification_id
+            TASK_END_NOTIFICATIONS.inc(source="push")
+            return True
+        return False
+
+    def _poll_for_notification(self, timeout):
+        return polling2.poll(self._check_for_notification, check_success=lambda has_notification: has_notification,
+                             step=0.5, timeout=timeout, poll_forever=timeout is None)
 
     def _check_for_notification(self):
         notification_id = self.task_end_notifier.check_for_task_end(self.previous_notification_id)
         if notification_id is not None:
             self.previous_notification_id = notification_id
+            TASK_END_NOTIFICATIONS.inc(source="scan")
             return True
         return False
 
     @staticmethod
-    def get_task_end_notification_poller():
+    def latest_leader_ip(node_manifest):
+        """IP address of the most recently reporting ready leader in the node manifest, or None"""
+        leader_nodes = node_manifest.get_all_ready_leader_nodes()
+        if not leader_nodes:
+            return None
+        return max(leader_nodes, key=lambda node: node['lastModified'])['nodeIp']
+
+    @staticmethod
+    def get_task_end_notification_poller(leader_ip: str = None, node_manifest=None):
         task_end_notifier = TaskEndNotifier.get_task_end_notifier()
         command_runner = CommandRunner("stdout.log", "stderr.log")
-        return TaskEndNotificationPoller(task_end_notifier, command_runner)
+        notification_client = None
+        leader_lookup = None
+        if leader_ip is not None:
+            notification_client = TaskEndNotificationClient(leader_ip)
+            if node_manifest is not None:
+                leader_lookup = lambda: TaskEndNotificationPoller.latest_leader_ip(node_manifest)
+        return TaskEndNotificationPoller(task_end_notifier, command_runner, notification_client, leader_lookup)
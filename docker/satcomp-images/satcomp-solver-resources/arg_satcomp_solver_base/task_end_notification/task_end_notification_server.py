@@ -0,0 +1,129 @@
+"""
+Long-poll HTTP endpoint on the leader that pushes task end notifications to the workers.
+Workers wait on GET /task-end?after=<last notification id> and are answered as soon as the
+leader publishes a new notification, instead of scanning the TaskEndNotification table.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from http.client import HTTPConnection, HTTPException
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TASK_END_NOTIFICATION_PORT = int(os.getenv("SATCOMP_TASK_END_PORT", "8155"))
+# Longest time a worker request is held open before it is answered with "no notification"
+MAX_LONG_POLL_SECONDS = 30
+
+
+class TaskEndNotificationServer(threading.Thread):
+    """Thread serving task end notifications published by the leader to long-polling workers"""
+
+    def __init__(self, port: int = TASK_END_NOTIFICATION_PORT, notification_expiration_time=5):
+        threading.Thread.__init__(self)
+        self.port = port
+        self.notification_expiration_time = notification_expiration_time
+        self.notification_id = None
+        self.notification_time = 0
+        self.condition = threading.Condition()
+        self.logger = logging.getLogger("TaskEndNotificationServer")
+        self.logger.setLevel(logging.DEBUG)
+        self.setDaemon(True)
+        self.http_server = ThreadingHTTPServer(("", port), self._make_handler())
+        self.http_server.daemon_threads = True
+        # port 0 binds an ephemeral port
+        self.port = self.http_server.server_address[1]
+
+    def publish(self, notification_id: str):
+        """Wake up every worker waiting for a task end notification"""
+        with self.condition:
+            self.notification_id = notification_id
+            self.notification_time = time.time()
+            self.condition.notify_all()
+        self.logger.info(f"Published task end notification {notification_id}")
+
+    def _has_new_notification(self, previous_notification_id: str):
+        if self.notification_id is None or self.notification_id == previous_notification_id:
+            return False
+        # like the table scan, a worker that has not seen any notification yet ignores stale ones
+        if previous_notification_id is None:
+            return self.notification_time > time.time() - self.notification_expiration_time
+        return True
+
+    def wait_for_notification(self, previous_notification_id: str, timeout: float):
+        """Return the current notification id once it differs from previous_notification_id, or None on timeout"""
+        with self.condition:
+            if self.condition.wait_for(lambda: self._has_new_notification(previous_notification_id), timeout=timeout):
+                return self.notification_id
+            return None
+
+    def _make_handler(self):
+        server = self
+
+        class TaskEndRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != "/task-end":
+                    self.send_error(404)
+                    return
+                query = parse_qs(url.query)
+                previous_notification_id = query.get("after", [None])[0]
+                try:
+                    timeout = min(float(query.get("timeout", [MAX_LONG_POLL_SECONDS])[0]), MAX_LONG_POLL_SECONDS)
+                except ValueError:
+                    self.send_error(400)
+                    return
+                notification_id = server.wait_for_notification(previous_notification_id, timeout)
+                body = json.dumps({"notificationId": notification_id}).encode("UTF-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                server.logger.debug(format, *args)
+
+        return TaskEndRequestHandler
+
+    def run(self):
+        self.logger.info(f"Serving task end notifications on port {self.port}")
+        self.http_server.serve_forever()
+
+
+class TaskEndNotificationClient:
+    """Worker side of the long-poll task end notification endpoint"""
+
+    def __init__(self, leader_ip: str, port: int = TASK_END_NOTIFICATION_PORT, long_poll_seconds: int = 20,
+                 connect_timeout: float = 2):
+        # the leader may be replaced, in which case the poller points the client at the new one
+        self.leader_ip = leader_ip
+        self.port = port
+        self.long_poll_seconds = long_poll_seconds
+        self.connect_timeout = connect_timeout
+
+    def wait_for_notification(self, previous_notification_id: str = None):
+        """
+        Wait up to long_poll_seconds for a notification newer than previous_notification_id.
+        Returns the new notification id, or None if there was none.
+        Raises OSError if the leader cannot be reached within connect_timeout or fails to answer.
+        """
+        path = f"/task-end?timeout={self.long_poll_seconds}"
+        if previous_notification_id is not None:
+            path += f"&after={previous_notification_id}"
+        connection = HTTPConnection(self.leader_ip, self.port, timeout=self.connect_timeout)
+        try:
+            connection.connect()
+            # the leader holds the request open for up to long_poll_seconds
+            connection.sock.settimeout(self.long_poll_seconds + 10)
+            connection.request("GET", path)
+            response = connection.getresponse()
+            if response.status != 200:
+                raise OSError(f"Task end notification endpoint answered with status {response.status}")
+            return json.loads(response.read()).get("notificationId")
+        except HTTPException as e:
+            raise OSError(f"Invalid response from task end notification endpoint: {e}")
+        finally:
+            connection.close()
+
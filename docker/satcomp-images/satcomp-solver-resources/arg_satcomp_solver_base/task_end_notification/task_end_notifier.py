@@ -3,16 +3,24 @@ import uuid
 
 import boto3
 
+from arg_satcomp_solver_base.node_manifest.dynamodb_manifest import DYNAMODB_REQUESTS
+
+NOTIFICATION_TABLE = "TaskEndNotification"
+
 
 class TaskEndNotifier:
+    """Publishes task end notifications to the TaskEndNotification table and, if the leader runs a
+    TaskEndNotificationServer, pushes them to the long-polling workers as well"""
 
-    def __init__(self, table, notification_expiration_time=5):
+    def __init__(self, table, notification_expiration_time=5, notification_server=None):
         self.table = table
         self.node_expiration_time = notification_expiration_time
+        self.notification_server = notification_server
 
     def notify_task_end(self, leader_ip: str):
         current_time = int(time.time())
         notification_id = str(uuid.uuid4())
+        DYNAMODB_REQUESTS.inc(table=NOTIFICATION_TABLE, operation="UpdateItem")
         self.table.update_item(
             Key={
                 'leaderIp': leader_ip
@@ -23,6 +31,9 @@ class TaskEndNotifier:
                 ":lastModifiedVal": current_time
             }
         )
+        if self.notification_server is not None:
+            self.notification_server.publish(notification_id)
+        return notification_id
 
     def check_for_task_end(self, previous_notification_id=None):
         expiration_time = int(time.time() - self.node_expiration_time)
@@ -39,6 +50,7 @@ class TaskEndNotifier:
             attribute_values[":notificationId"] = previous_notification_id
             attribute_names["#notificationId"] = "notificationId"
 
+        DYNAMODB_REQUESTS.inc(table=NOTIFICATION_TABLE, operation="Scan")
         notifications = self.table.scan(
             Select="ALL_ATTRIBUTES",
             FilterExpression=filter_expression,
@@ -51,7 +63,7 @@ class TaskEndNotifier:
         return None
 
     @staticmethod
-    def get_task_end_notifier():
+    def get_task_end_notifier(notification_server=None):
         dynamodb_resource = boto3.resource("dynamodb")
-        table = dynamodb_resource.Table("TaskEndNotification")
-        return TaskEndNotifier(table)
+        table = dynamodb_resource.Table(NOTIFICATION_TABLE)
+        return TaskEndNotifier(table, notification_server=notification_server)
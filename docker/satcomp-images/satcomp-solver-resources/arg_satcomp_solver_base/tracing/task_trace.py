@@ -0,0 +1,227 @@
+"""
+Per-task timing spans.
+The poller records one span per phase of a task (SQS receive, worker wait, S3 download, solve,
+result publish, artifact upload, cleanup, ...). The spans finished before the result is published
+are sent along in the result message; the complete trace is handed to the exporters once the task
+(including a background artifact upload) is done.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from arg_satcomp_solver_base.metrics.metrics import MetricsRegistry
+
+try:
+    from opentelemetry import trace as opentelemetry_trace
+except ImportError:
+    opentelemetry_trace = None
+
+
+class TaskTraceException(Exception):
+    """Exception for task tracing errors"""
+
+
+class Span:
+    """A timed phase of a task; times are seconds since the epoch"""
+
+    def __init__(self, name: str, start_time: float, end_time: float = None, attributes: dict = None):
+        self.name = name
+        self.start_time = start_time
+        self.end_time = end_time
+        self.attributes = attributes or {}
+
+    @property
+    def duration_seconds(self):
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration_seconds": self.duration_seconds,
+            "attributes": self.attributes
+        }
+
+
+class TaskTrace:
+    """The spans of a single task.
+    A trace is complete once every part of the task that holds it open has called finish()."""
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.start_time = time.time()
+        self.end_time = None
+        self.attributes = {}
+        self.spans = []
+        self.open_parts = 1
+        self.lock = threading.Lock()
+
+    def set_attribute(self, name: str, value):
+        self.attributes[name] = value
+
+    def add_span(self, name: str, start_time: float, end_time: float, **attributes):
+        """Record a phase that was timed elsewhere"""
+        span = Span(name, start_time, end_time, attributes)
+        with self.lock:
+            self.spans.append(span)
+            self.start_time = min(self.start_time, start_time)
+        return span
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Time the enclosed block as a phase. The span is recorded even if the block raises."""
+        span = Span(name, time.time(), attributes=attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.attributes["error"] = type(e).__name__
+            raise
+        finally:
+            span.end_time = time.time()
+            with self.lock:
+                self.spans.append(span)
+
+    def phases(self):
+        """Seconds spent in each phase, summed over spans of the same name"""
+        durations = {}
+        with self.lock:
+            for span in self.spans:
+                if span.end_time is not None:
+                    durations[span.name] = durations.get(span.name, 0) + span.duration_seconds
+        return durations
+
+    def defer(self):
+        """Keep the trace open for a part of the task that finishes in the background"""
+        with self.lock:
+            self.open_parts += 1
+
+    def finish(self):
+        """Close one part of the task; returns True once the whole trace is complete"""
+        with self.lock:
+            self.open_parts -= 1
+            if self.open_parts > 0:
+                return False
+            self.end_time = time.time()
+            return True
+
+    def to_dict(self):
+        with self.lock:
+            spans = [span.to_dict() for span in self.spans]
+            end_time = self.end_time
+        return {
+            "trace_id": self.trace_id,
+            "start_time": self.start_time,
+            "end_time": end_time,
+            "duration_seconds": end_time - self.start_time if end_time is not None else None,
+            "attributes": self.attributes,
+            "phases": self.phases(),
+            "spans": spans
+        }
+
+
+class JsonLinesTraceExporter:
+    """Appends every complete trace to a file as one JSON line"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, task_trace: TaskTrace):
+        line = json.dumps(task_trace.to_dict())
+        with self.lock:
+            with open(self.path, "a") as trace_file:
+                trace_file.write(line + "\n")
+
+
+class OpenTelemetryTraceExporter:
+    """
+    Re-emits every complete trace as OpenTelemetry spans: a "satcomp.task" root span with one child
+    span per phase, all with their original timestamps. The spans go to the tracer provider configured
+    for the process (e.g. an OTLP exporter set up with opentelemetry-sdk).
+    """
+
+    def __init__(self, tracer=None):
+        if opentelemetry_trace is None:
+            raise TaskTraceException("opentelemetry-api is not installed; cannot export task traces to OpenTelemetry")
+        self.tracer = tracer or opentelemetry_trace.get_tracer("arg_satcomp_solver_base")
+
+    @staticmethod
+    def _nanoseconds(seconds: float):
+        return int(seconds * 1e9)
+
+    @staticmethod
+    def _attributes(attributes: dict):
+        """OpenTelemetry attribute values must be primitives"""
+        return {name: value if isinstance(value, (bool, int, float, str)) else json.dumps(value)
+                for name, value in attributes.items() if value is not None}
+
+    def export(self, task_trace: TaskTrace):
+        root = self.tracer.start_span("satcomp.task", start_time=self._nanoseconds(task_trace.start_time),
+                                      attributes=self._attributes(dict(task_trace.attributes,
+                                                                       trace_id=task_trace.trace_id)))
+        context = opentelemetry_trace.set_span_in_context(root)
+        for span in list(task_trace.spans):
+            if span.end_time is None:
+                continue
+            child = self.tracer.start_span(span.name, context=context, start_time=self._nanoseconds(span.start_time),
+                                           attributes=self._attributes(span.attributes))
+            child.end(end_time=self._nanoseconds(span.end_time))
+        root.end(end_time=self._nanoseconds(task_trace.end_time or time.time()))
+
+
+class MetricsTraceExporter:
+    """Records the duration of every complete task and of each of its phases in histograms"""
+
+    def __init__(self, registry: MetricsRegistry):
+        self.task_seconds = registry.histogram("satcomp_task_seconds", "Time from receiving a task to finishing it")
+        self.phase_seconds = registry.histogram("satcomp_task_phase_seconds", "Time spent in each phase of a task")
+
+    def export(self, task_trace: TaskTrace):
+        self.task_seconds.observe(task_trace.end_time - task_trace.start_time)
+        for phase, duration in task_trace.phases().items():
+            self.phase_seconds.observe(duration, phase=phase)
+
+
+class TaskTracer:
+    """Creates task traces and hands complete ones to the exporters.
+    An exporter is any object with an export(task_trace) method."""
+
+    def __init__(self, exporters: list = None):
+        self.exporters = list(exporters or [])
+        self.logger = logging.getLogger("TaskTracer")
+        self.logger.setLevel(logging.DEBUG)
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def start(self):
+        return TaskTrace()
+
+    def finish(self, task_trace: TaskTrace):
+        """Close one part of the task and export the trace once it is complete"""
+        if not task_trace.finish():
+            return
+        for exporter in self.exporters:
+            try:
+                exporter.export(task_trace)
+            except Exception as e:
+                # tracing must never take a poller down
+                self.logger.error(f"Failed to export trace {task_trace.trace_id} with {type(exporter).__name__}")
+                self.logger.exception(e)
+
+    @staticmethod
+    def get_task_tracer(trace_file: str = None, opentelemetry: bool = False):
+        """Tracer recording phase metrics, writing a JSON-lines trace file if trace_file is set and exporting to
+        OpenTelemetry if requested"""
+        exporters = [MetricsTraceExporter(MetricsRegistry.get_registry())]
+        if trace_file:
+            exporters.append(JsonLinesTraceExporter(trace_file))
+        if opentelemetry:
+            exporters.append(OpenTelemetryTraceExporter())
+        return TaskTracer(exporters)
@@ -10,17 +10,24 @@ import threading
 import uuid
 import time
 
+from arg_satcomp_solver_base.metrics.metrics import MetricsRegistry
 from arg_satcomp_solver_base.node_manifest.dynamodb_manifest import DynamodbManifest, NodeType
+from arg_satcomp_solver_base.node_manifest.heartbeat import Heartbeat
 from arg_satcomp_solver_base.utils import FileOperations
 
 
+WORKER_STATUS_ERRORS = MetricsRegistry.get_registry().counter(
+    "satcomp_worker_status_errors_total", "Failed reads of worker_node_status.json by reason")
+
+
 class WorkerTimeoutException(Exception):
     pass
 
 
 class WorkerStatusChecker(threading.Thread):
-    """Thread that runs in the background trying to get status of worker and
-    updates manifest every second. Throws an exception if status is not updated for given expiration time"""
+    """Thread that runs in the background trying to get status of worker every second and
+    updates manifest when it changes (and once per heartbeat lease interval otherwise).
+    Throws an exception if status is not updated for given expiration time"""
 
     worker_poll_sleep_time = 1
     file_operations: FileOperations = FileOperations()
@@ -32,6 +39,7 @@ class WorkerStatusChecker(threading.Thread):
         self.logger.setLevel(logging.DEBUG)
         self.expiration_time = expiration_time
         self.path = path
+        self.heartbeat = None
 
     def get_worker_info(self):
         input = os.path.join(self.path, "worker_node_status.json")
@@ -45,6 +53,7 @@ class WorkerStatusChecker(threading.Thread):
         local_ip_address = socket.gethostbyname(socket.gethostname())
         node_uuid = uuid.uuid4()
         self.logger.info(f"Registering node {node_uuid} with ip {local_ip_address}")
+        self.heartbeat = Heartbeat(self.node_manifest, str(node_uuid), local_ip_address, NodeType.WORKER.name)
         while True:
             try:
                 current_timestamp = int(time.time())
@@ -58,15 +67,18 @@ class WorkerStatusChecker(threading.Thread):
                 self.logger.info(f"Worker status updated time:  {worker_timestamp}")
 
                 if worker_timestamp < current_timestamp - self.expiration_time:
+                    WORKER_STATUS_ERRORS.inc(reason="stale")
                     raise WorkerTimeoutException("Timed out waiting for worker node status to update")
 
-                self.update_manifest(node_uuid, local_ip_address, status)
+                self.heartbeat.beat(status)
 
                 self.logger.info("#######################")
                 time.sleep(self.worker_poll_sleep_time)
 
             except FileNotFoundError:
+                WORKER_STATUS_ERRORS.inc(reason="missing")
                 self.logger.error("worker_node_status file is not generated")
             except json.JSONDecodeError as e:
+                WORKER_STATUS_ERRORS.inc(reason="invalid")
                 self.logger.error("Worker status file is not valid Json")
                 self.logger.exception(e)
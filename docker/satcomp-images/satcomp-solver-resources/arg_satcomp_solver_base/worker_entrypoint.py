@@ -12,6 +12,7 @@ from arg_satcomp_solver_base.node_manifest.dynamodb_manifest import DynamodbMani
 from arg_satcomp_solver_base.worker.worker import WorkerStatusChecker
 from arg_satcomp_solver_base.task_end_notification.task_end_notification_poller import TaskEndNotificationPoller
 from arg_satcomp_solver_base.utils import FileOperations
+from arg_satcomp_solver_base.metrics.metrics import start_metrics_publishing
 
 logging.getLogger("botocore").setLevel(logging.CRITICAL)
 logging.getLogger("boto3").setLevel(logging.CRITICAL)
@@ -19,6 +20,11 @@ logging.getLogger("boto3").setLevel(logging.CRITICAL)
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.DEBUG)
 
+# Port of the Prometheus /metrics endpoint; 0 disables the endpoint
+METRICS_PORT = int(os.getenv('SATCOMP_METRICS_PORT', '0'))
+# Seconds between CloudWatch embedded metric format lines written to stdout; 0 disables them
+METRICS_EMF_INTERVAL = float(os.getenv('SATCOMP_METRICS_EMF_INTERVAL', '0'))
+
 class PollerTimeoutException(Exception):
     pass
 
@@ -68,6 +74,9 @@ if __name__ == "__main__":
     logger = logging.getLogger("Worker Entrypoint")
     dir = "/competition"
 
+    logger.info("Starting metrics publishing")
+    start_metrics_publishing(METRICS_PORT, METRICS_EMF_INTERVAL, "SatComp", {"NodeType": "WORKER"})
+
     logger.info("Getting node manifest")
     node_manifest = DynamodbManifest.get_dynamodb_manifest()
 
@@ -84,6 +93,7 @@ if __name__ == "__main__":
     worker_status = WorkerStatusChecker(node_manifest, 5, dir)
     worker_status.start()
 
-    task_end_notification_poller = TaskEndNotificationPoller.get_task_end_notification_poller()
+    leader_ip = max(leaders, key=lambda node: node['lastModified'])['nodeIp']
+    task_end_notification_poller = TaskEndNotificationPoller.get_task_end_notification_poller(leader_ip, node_manifest)
     task_end_notification_poller.start()
 